@@ -31,17 +31,40 @@ import json
 import shutil
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from typing import Optional, Tuple, Union
-from os import remove
-from os.path import isfile, join, dirname, getsize
+from os import remove, replace
+from os.path import basename, isfile, join, dirname, getsize
 from subprocess import Popen
+from threading import Event, Lock, Thread
 
 import yaml
 from ovos_bus_client.message import Message
 from ovos_utils.log import LOG, log_deprecation
+from ovos_utils.xdg_utils import xdg_cache_home
 from ovos_plugin_manager.phal import PHALPlugin
-from neon_utils.web_utils import scrape_page_for_links
+
+from neon_phal_plugin_device_updater.github import GitHubClient
+from neon_phal_plugin_device_updater.legacy_index import DirectoryIndex
+from neon_phal_plugin_device_updater.mirrors import MirrorSelector
+from neon_phal_plugin_device_updater.network import AsyncNetwork
+from neon_phal_plugin_device_updater.profiling import HandlerProfiler
+from neon_phal_plugin_device_updater.rollout import is_admitted
+from neon_phal_plugin_device_updater.state import UpdateJournal, \
+    UpdateState, get_file_stat
+from neon_phal_plugin_device_updater.systemd import SystemdUnit, \
+    UnitTimeoutError
+from neon_phal_plugin_device_updater.verify import DEFAULT_CHUNK_SIZE, \
+    build_manifest, get_manifest_path, hash_file, load_manifest, \
+    save_manifest, verify_file
+
+
+class DownloadCancelledError(RuntimeError):
+    """
+    Raised when a download is cancelled or preempted by another download
+    """
 
 
 class DeviceUpdater(PHALPlugin):
@@ -54,25 +77,83 @@ class DeviceUpdater(PHALPlugin):
                                                      "/opt/neon/initramfs")
         self.release_repo = self.config.get("release_repo",
                                             "NeonGeckoCom/neon-os")
+        self.github_api_url = self.config.get("github_api_url",
+                                              "https://api.github.com")
+        self.github_raw_url = self.config.get(
+            "github_raw_url", "https://raw.githubusercontent.com")
         self.squashfs_path = self.config.get("squashfs_path",
                                              "/opt/neon/update.squashfs")
+        self.build_info_path = self.config.get("build_info_path",
+                                               "/opt/neon/build_info.json")
+        self.verify_chunk_size = self.config.get("verify_chunk_size",
+                                                 DEFAULT_CHUNK_SIZE)
+        self.verify_workers = self.config.get("verify_workers")
+        self._mirrors = MirrorSelector(
+            self.config.get("mirrors"),
+            cache_ttl=self.config.get("mirror_cache_ttl", 3600))
+        self.request_timeout = self.config.get("request_timeout", 10)
+        self.check_timeout = self.config.get("check_timeout", 30)
+        self.check_hedge_delay = self.config.get("check_hedge_delay", 2)
+        self._network = AsyncNetwork(timeout=self.request_timeout)
+        self._github = GitHubClient(
+            self.github_api_url, token=self.config.get("github_token"),
+            timeout=self.request_timeout,
+            reserve=self.config.get("github_quota_reserve", 10))
+        self._legacy_index = DirectoryIndex(
+            ".squashfs", max_age=self.config.get("legacy_index_ttl", 60),
+            timeout=self.request_timeout)
+
+        self._initramfs_unit = SystemdUnit(
+            self.config.get("initramfs_service", "update-initramfs"))
+        self.initramfs_timeout = self.config.get("initramfs_timeout", 300)
 
         self._default_branch = self.config.get("default_track") or "master"
         self._build_info = None
+        self._device_id = None
         self._initramfs_hash = None
+        self._initramfs_lock = Lock()
         self._downloading = False
+        self._download_lock = Lock()
+        self._cancel_download = Event()
+        self._download_target = None
+        self._download_size = None
+        # Smallest file accepted as an OS update
+        self.min_update_size = 100 * 1048576
+        self._journal = UpdateJournal(
+            self.config.get("state_path") or
+            join(dirname(self.initramfs_update_path),
+                 "device_updater_state.json"))
+        self._reconcile_state()
+
+        profile_config = self.config.get("profiling") or dict()
+        self._profiler = HandlerProfiler(
+            profile_config.get("path") or
+            join(xdg_cache_home(), "neon", "device_updater_profiles"),
+            max_profiles=profile_config.get("max_profiles", 20),
+            max_bytes=profile_config.get("max_bytes", 1048576),
+            trace_memory=profile_config.get("trace_memory", True)) if \
+            profile_config.get("enabled") else None
 
         # Register messagebus listeners
-        self.bus.on("neon.check_update_initramfs", self.check_update_initramfs)
+        handlers = {
+            "neon.check_update_initramfs": self.check_update_initramfs,
+            "neon.check_update_squashfs": self.check_update_squashfs,
+            "neon.update_squashfs": self.update_squashfs,
+            "neon.device_updater.check_update": self.check_update_available,
+            "neon.device_updater.get_build_info": self.get_build_info,
+            "neon.device_updater.get_download_status":
+                self.get_download_status,
+            "neon.device_updater.cancel_download": self.cancel_download,
+            "neon.device_updater.apply_update": self.apply_update,
+            "neon.device_updater.get_update_state": self.get_update_state
+        }
+        for msg_type, handler in handlers.items():
+            if self._profiler:
+                handler = self._profiler.wrap(msg_type, handler)
+            self.bus.on(msg_type, handler)
+        # The update runs in a thread that is profiled instead of the handler
         self.bus.on("neon.update_initramfs", self.update_initramfs)
-        self.bus.on("neon.check_update_squashfs", self.check_update_squashfs)
-        self.bus.on("neon.update_squashfs", self.update_squashfs)
-        self.bus.on("neon.device_updater.check_update",
-                    self.check_update_available)
-        self.bus.on("neon.device_updater.get_build_info",
-                    self.get_build_info)
-        self.bus.on("neon.device_updater.get_download_status",
-                    self.get_download_status)
+        self.bus.on("neon.device_updater.get_profile", self.get_profile)
 
     @property
     def squashfs_url(self):
@@ -110,13 +191,128 @@ class DeviceUpdater(PHALPlugin):
         """
         if self._build_info is None:
             try:
-                with open("/opt/neon/build_info.json") as f:
+                with open(self.build_info_path) as f:
                     self._build_info = json.load(f)
             except Exception as e:
                 LOG.error(f"Failed to get build info: {e}")
                 self._build_info = dict()
         return self._build_info
 
+    @property
+    def device_id(self) -> Optional[str]:
+        """
+        Get a unique identifier for this device, used for staged rollouts
+        """
+        if self._device_id is None:
+            self._device_id = self.config.get("device_id") or ""
+            if not self._device_id:
+                try:
+                    with open("/etc/machine-id") as f:
+                        self._device_id = f.read().strip()
+                except Exception as e:
+                    LOG.warning(f"Failed to get machine ID: {e}")
+        return self._device_id or None
+
+    def _check_rollout_admitted(self, update_meta: Optional[dict]) -> bool:
+        """
+        Check if this device is admitted to the staged rollout of an update.
+        A `rollout` spec in configuration overrides one in release metadata.
+        @param update_meta: release metadata for the update
+        @return: True if the update should be offered to this device
+        """
+        rollout = self.config.get("rollout") or \
+            (update_meta or dict()).get("rollout")
+        return is_admitted(self.device_id, rollout)
+
+    def _reconcile_state(self):
+        """
+        Reconcile the persisted update state with files on disk so that an
+        update interrupted by a restart resumes from the last completed step.
+        """
+        squashfs = self._journal.get("squashfs")
+        state = squashfs.get("state")
+        download_path = squashfs.get("download_path")
+        if state == UpdateState.STAGED:
+            if squashfs.get("base_os") and \
+                    squashfs["base_os"] == self.build_info.get("base_os"):
+                state = UpdateState.APPLIED
+            elif get_file_stat(self.squashfs_path) != \
+                    squashfs.get("staged_stat"):
+                LOG.warning("Staged squashfs changed or missing")
+                state = UpdateState.VERIFIED
+        if state == UpdateState.VERIFIED and \
+                get_file_stat(download_path) != squashfs.get("verified_stat"):
+            LOG.warning("Verified squashfs changed or missing")
+            state = UpdateState.DOWNLOADING
+        if state == UpdateState.DOWNLOADING and download_path:
+            if isfile(download_path) and load_manifest(download_path):
+                # Download completed before its state was saved
+                self._journal.transition(
+                    "squashfs", UpdateState.VERIFIED,
+                    verified_stat=get_file_stat(download_path))
+                state = UpdateState.VERIFIED
+            elif not isfile(f"{download_path}.download"):
+                state = UpdateState.CHECKED
+        if state and state != squashfs.get("state"):
+            self._journal.transition("squashfs", state)
+
+        initramfs = self._journal.get("initramfs")
+        if initramfs.get("state") == UpdateState.VERIFIED and \
+                not isfile(initramfs.get("download_path") or ""):
+            LOG.warning("Verified initramfs missing")
+            self._journal.transition("initramfs", UpdateState.CHECKED)
+        LOG.debug(f"Reconciled update state: "
+                  f"squashfs={self._journal.get('squashfs').get('state')}|"
+                  f"initramfs={self._journal.get('initramfs').get('state')}")
+
+    def _record_squashfs_checked(self, update_meta: dict):
+        """
+        Record an available squashFS update unless it is already in progress
+        @param update_meta: metadata for the available update
+        """
+        version = update_meta.get("build_version") or \
+            basename(update_meta.get("download_url") or "")
+        entry = self._journal.get("squashfs")
+        if entry.get("version") == version and \
+                entry.get("state") != UpdateState.APPLIED:
+            return
+        self._journal.transition("squashfs", UpdateState.CHECKED,
+                                 version=version,
+                                 base_os=update_meta.get("base_os"))
+
+    def _stage_squashfs(self, update_file: str,
+                        base_os: Optional[dict] = None):
+        """
+        Atomically copy a squashFS update to `squashfs_path` to be installed on
+        restart. This is skipped if the same file is already staged.
+        @param update_file: path to the verified update file
+        @param base_os: optional `base_os` metadata of the update
+        """
+        entry = self._journal.get("squashfs")
+        if entry.get("state") == UpdateState.STAGED and \
+                entry.get("download_path") == update_file and \
+                get_file_stat(self.squashfs_path) == entry.get("staged_stat"):
+            LOG.info(f"Update already staged: {update_file}")
+            return
+        temp_path = f"{self.squashfs_path}.tmp"
+        shutil.copyfile(update_file, temp_path)
+        replace(temp_path, self.squashfs_path)
+        self._record_squashfs_staged(update_file, base_os)
+
+    def _record_squashfs_staged(self, update_file: str,
+                                base_os: Optional[dict] = None):
+        """
+        Record that a squashFS update was staged
+        @param update_file: path to the staged update file
+        @param base_os: optional `base_os` metadata of the update
+        """
+        data = {"version": basename(update_file),
+                "download_path": update_file,
+                "staged_stat": get_file_stat(self.squashfs_path)}
+        if base_os:
+            data["base_os"] = base_os
+        self._journal.transition("squashfs", UpdateState.STAGED, **data)
+
     def _legacy_check_initramfs_update_available(self,
                                                  branch: str = None) -> bool:
         """
@@ -129,7 +325,8 @@ class DeviceUpdater(PHALPlugin):
         if not self.initramfs_url:
             raise RuntimeError("No initramfs_url configured")
         initramfs_url = self.initramfs_url.format(branch)
-        md5_request = requests.get(f"{initramfs_url}.md5")
+        md5_request = self._get_with_failover("initramfs",
+                                              f"{initramfs_url}.md5")
         if not md5_request.ok:
             LOG.warning(f"Unable to get md5 from {md5_request.url}; "
                         f"downloading latest initramfs")
@@ -165,7 +362,8 @@ class DeviceUpdater(PHALPlugin):
         else:
             initramfs_url = self.initramfs_url.format(branch)
             LOG.debug(f"Getting initramfs from {initramfs_url}")
-            initramfs_request = requests.get(initramfs_url)
+            initramfs_request = self._get_with_failover("initramfs",
+                                                        initramfs_url)
             if not initramfs_request.ok:
                 raise ConnectionError(f"Unable to get updated initramfs from: "
                                       f"{initramfs_url}")
@@ -177,6 +375,9 @@ class DeviceUpdater(PHALPlugin):
             LOG.info("initramfs not changed. Removing downloaded file.")
             remove(self.initramfs_update_path)
             return False
+        self._journal.transition("initramfs", UpdateState.VERIFIED,
+                                 version=new_hash,
+                                 download_path=self.initramfs_update_path)
         return True
 
     def _legacy_check_squashfs_update_available(self, track: str = None) \
@@ -188,17 +389,15 @@ class DeviceUpdater(PHALPlugin):
         @return: new version (filename) and download link if available, else None
         """
         track = track or self._default_branch
-        # Get all available update files from the configured URL
-        ext = '.squashfs'
+        # Get the newest update file from the configured URL
         prefix = self.build_info.get("base_os", {}).get("name", "")
         remote = self.squashfs_url.format(track)
-        links = scrape_page_for_links(remote)
-        valid_links = [(name, uri) for name, uri in links.items()
-                       if name.endswith(ext) and name.startswith(prefix)]
-        valid_links.sort(key=lambda k: k[0], reverse=True)
-        LOG.debug(f"Got versions from {remote}: {valid_links}")
-        newest_version = valid_links[0][0]
-        download_url = valid_links[0][1]
+        newest = self._legacy_index.get_newest(remote, prefix)
+        LOG.debug(f"Got newest version from {remote}: {newest}")
+        if not newest:
+            LOG.warning(f"No updates found at {remote} for: {prefix}")
+            return None
+        newest_version, download_url = newest
 
         # Parse time of latest and current OS Image
         installed_image_time = self.build_info.get("base_os", {}).get("time")
@@ -218,7 +417,8 @@ class DeviceUpdater(PHALPlugin):
         """
         Get the latest squashfs image if different from the installed version
         @param track: update track (subdirectory) to check
-        @return: path to downloaded update if present, else None
+        @return: path to downloaded update, or None if already updated
+        @raises DownloadCancelledError: if the download was cancelled
         """
         track = track or self._default_branch
         # Check for an available update
@@ -231,75 +431,521 @@ class DeviceUpdater(PHALPlugin):
         # Check if the updated version has already been downloaded
         download_path = join(dirname(self.initramfs_update_path),
                              newest_version)
+        return self._get_squashfs_update(download_url, download_path)
+
+    def _get_squashfs_download(self, update_metadata: dict) -> Tuple[str, str]:
+        """
+        Get the download URL and local path of a squashFS update
+        @param update_metadata: release metadata for the update
+        @return: download URL and local download path
+        """
+        platform = self.build_info['base_os']['platform']
+        download_url = update_metadata['download_url'].replace(
+            f"/{platform}/", f"/{platform}/updates/").replace(".img.xz",
+                                                              ".squashfs")
+        download_path = str(join(dirname(self.initramfs_update_path),
+                                 update_metadata['build_version']))
+        return download_url, download_path
+
+    @staticmethod
+    def _get_squashfs_md5(update_metadata: dict) -> Optional[str]:
+        """
+        Get the expected MD5 of a squashFS update from release metadata
+        @param update_metadata: release metadata for the update
+        @return: MD5 hex digest if specified in metadata, else None
+        """
+        return (update_metadata.get('squashfs') or dict()).get('md5')
+
+    def _get_squashfs_update(self, download_url: str, download_path: str,
+                             expected_md5: Optional[str] = None) -> str:
+        """
+        Get a verified squashFS update, downloading it if it has not already
+        been downloaded or if the existing download is invalid.
+        @param download_url: URL of the update file
+        @param download_path: local path to download the update to
+        @param expected_md5: optional MD5 of the update from release metadata
+        @return: path to downloaded update
+        @raises DownloadCancelledError: if the download was cancelled
+        @raises ConnectionError: if the update could not be downloaded
+        """
+        version = basename(download_path)
+        entry = self._journal.get("squashfs")
+        if entry.get("download_path") == download_path and \
+                entry.get("state") in (UpdateState.VERIFIED,
+                                       UpdateState.STAGED) and \
+                get_file_stat(download_path) == entry.get("verified_stat"):
+            LOG.info("Update already downloaded and verified")
+            return download_path
+        if isfile(download_path) and \
+                not self._verify_download(download_path, download_url):
+            LOG.warning(f"Removing invalid download: {download_path}")
+            self._remove_download(download_path)
         if isfile(download_path):
             LOG.info("Update already downloaded")
-            return download_path
+        else:
+            self._journal.transition("squashfs", UpdateState.DOWNLOADING,
+                                     version=version,
+                                     download_path=download_path,
+                                     download_url=download_url)
+            if not self._stream_download_file(download_url, download_path,
+                                              expected_md5):
+                raise ConnectionError(f"Failed to download {download_url}")
+        self._journal.transition("squashfs", UpdateState.VERIFIED,
+                                 version=version, download_path=download_path,
+                                 verified_stat=get_file_stat(download_path))
+        return download_path
+
+    def _download_initramfs(self, initramfs_url: str,
+                            expected_md5: str) -> str:
+        """
+        Download an initramfs image without installing it
+        @param initramfs_url: URL of the initramfs image
+        @param expected_md5: expected MD5 hash of the downloaded image
+        @return: path to the downloaded file
+        """
+        LOG.debug(f"Getting initramfs from {initramfs_url}")
+        resp = self._get_with_failover("initramfs", initramfs_url)
+        if not resp.ok:
+            raise ConnectionError(f"Unable to get updated initramfs from: "
+                                  f"{initramfs_url}")
+        new_hash = hashlib.md5(resp.content).hexdigest()
+        if new_hash != expected_md5:
+            raise ValueError(f"Downloaded initramfs hash ({new_hash}) does not "
+                             f"match expected ({expected_md5})")
+        download_path = f"{self.initramfs_update_path}.download"
+        with open(download_path, 'wb') as f:
+            f.write(resp.content)
+        self._journal.transition("initramfs", UpdateState.VERIFIED,
+                                 version=new_hash, download_path=download_path)
+        return download_path
+
+    def _apply_initramfs(self, message: Optional[Message] = None) -> bool:
+        """
+        Apply a downloaded initramfs update. This must be called while holding
+        `_initramfs_lock`.
+        @param message: optional Message to forward progress events from
+        @return: True if the update was applied
+        @raises UnitTimeoutError: if the service has not finished within
+            `initramfs_timeout`; it may still apply the update
+        """
+        return SystemdUnit.is_success(self._run_initramfs_service(message))
+
+    def _run_initramfs_service(self, message: Optional[Message] = None) \
+            -> dict:
+        """
+        Run the `update-initramfs` service to apply a downloaded update. The
+        service job is queued without blocking and its unit state is polled
+        until it finishes or `initramfs_timeout` is reached. If the deadline
+        passes, a `neon.update_initramfs.pending` event is emitted. This must be
+        called while holding `_initramfs_lock`.
+        @param message: optional Message to forward progress events from
+        @return: dict unit properties after the service finished
+        @raises UnitTimeoutError: if the service has not finished within
+            `initramfs_timeout`; it may still apply the update
+        """
+        LOG.debug("Updating initramfs")
+        try:
+            properties = self._initramfs_unit.run(
+                self.initramfs_timeout,
+                partial(self._emit_initramfs_progress, message))
+        except UnitTimeoutError as e:
+            LOG.warning(f"InitramFS update pending: {e}")
+            if message:
+                self.bus.emit(message.forward(
+                    "neon.update_initramfs.pending",
+                    {"state": e.properties.get("ActiveState"),
+                     "sub_state": e.properties.get("SubState")}))
+            raise
+        self._on_initramfs_finished(properties)
+        return properties
+
+    def _wait_for_initramfs_service(self, initial: dict,
+                                    message: Optional[Message] = None) -> dict:
+        """
+        Wait for an `update-initramfs` service job that did not finish within
+        `initramfs_timeout` to finish. This must be called while holding
+        `_initramfs_lock`.
+        @param initial: unit properties from before the job was queued
+        @param message: optional Message to forward progress events from
+        @return: dict unit properties after the service finished
+        """
+        properties = self._initramfs_unit.wait(
+            initial, None, partial(self._emit_initramfs_progress, message))
+        self._on_initramfs_finished(properties)
+        return properties
+
+    def _emit_initramfs_progress(self, message: Optional[Message],
+                                 properties: dict):
+        """
+        Emit the state of the `update-initramfs` service
+        @param message: Message to forward the progress event from, if any
+        @param properties: current unit properties
+        """
+        if message:
+            self.bus.emit(message.forward(
+                "neon.update_initramfs.progress",
+                {"state": properties.get("ActiveState"),
+                 "sub_state": properties.get("SubState")}))
 
-        return self._stream_download_file(download_url, download_path)
+    def _on_initramfs_finished(self, properties: dict):
+        """
+        Record the result of a finished `update-initramfs` service job
+        @param properties: unit properties after the service finished
+        """
+        if SystemdUnit.is_success(properties):
+            # Only invalidate the cached hash once the update is confirmed
+            self._initramfs_hash = None
+            LOG.info(f"Updated initramfs: {self.initramfs_hash}")
+            self._journal.transition("initramfs", UpdateState.APPLIED)
+        else:
+            LOG.error(self._get_initramfs_error(properties))
+
+    @staticmethod
+    def _get_initramfs_error(properties: dict) -> str:
+        """
+        Describe a failed `update-initramfs` service run
+        @param properties: unit properties after the service finished
+        @return: string error message
+        """
+        return f"Update service failed: result={properties.get('Result')}|" \
+               f"status={properties.get('ExecMainStatus')}"
 
-    def _stream_download_file(self, download_url: str,
-                              download_path: str) -> Optional[str]:
+    def _stream_download_file(self, download_url: str, download_path: str,
+                              expected_md5: Optional[str] = None) \
+            -> Optional[str]:
         """
         Download a remote resource to a local path and return the path to the
         written file. This will provide some trivial validation that the output
-        file is an OS update.
+        file is an OS update. A partial download left by a cancelled or failed
+        request is resumed if the server supports range requests. A request for
+        a different `download_path` preempts any download already in progress.
         @param download_url: URL of file to download
         @param download_path: path of output file
-        @return: actual path to output file
+        @param expected_md5: optional MD5 the downloaded file must match
+        @return: actual path to output file, or None if the download failed
+        @raises DownloadCancelledError: if the download was cancelled
+        """
+        queued = self._download_lock.locked()
+        preempt = queued and self._download_target != download_path
+        if preempt:
+            LOG.info(f"Preempting download of {self._download_target}")
+            self._cancel_download.set()
+        with self._download_lock:
+            if queued and not preempt and self._cancel_download.is_set():
+                # The download this request was waiting on was cancelled
+                raise DownloadCancelledError(f"Download of {download_path} "
+                                             f"was cancelled")
+            self._cancel_download.clear()
+            if isfile(download_path):
+                LOG.info(f"Update already downloaded to {download_path}")
+                return download_path
+            self._download_target = download_path
+            self._download_size = None
+            self._downloading = True
+            try:
+                return self._do_stream_download(download_url, download_path,
+                                                expected_md5)
+            finally:
+                self._downloading = False
+                self._download_target = None
+
+    def _do_stream_download(self, download_url: str, download_path: str,
+                            expected_md5: Optional[str] = None) \
+            -> Optional[str]:
+        """
+        Perform a download for `_stream_download_file`. This must be called
+        while holding `_download_lock`. If a transfer fails, the download is
+        resumed from the next configured mirror. Partial files are kept so an
+        interrupted download may be resumed. The completed file must match the
+        size reported by the server, and `expected_md5` if specified, before
+        its manifest is written.
+        @param download_url: URL of file to download
+        @param download_path: path of output file
+        @param expected_md5: optional MD5 the downloaded file must match
+        @return: actual path to output file, or None if the download failed
+        @raises DownloadCancelledError: if the download was cancelled
         """
         # Download the update
         LOG.info(f"Downloading update from {download_url}")
         temp_dl_path = f"{download_path}.download"
-        self._downloading = True
         try:
-            with requests.get(download_url, stream=True) as stream:
-                with open(temp_dl_path, 'wb') as f:
-                    for chunk in stream.iter_content(4096):
-                        if chunk:
-                            f.write(chunk)
-            # Update should be > 100MiB
-            file_mib = getsize(temp_dl_path) / 1048576
-            if file_mib < 100:
-                LOG.error(f"Downloaded file is too small ({file_mib}MiB)")
+            complete = None
+            for url in self._mirrors.get_urls("squashfs", download_url):
+                try:
+                    complete = self._stream_to_file(url, temp_dl_path)
+                    break
+                except Exception as e:
+                    LOG.warning(f"Download from {url} failed: {e}")
+                    self._mirrors.report_failure("squashfs", url)
+            if complete is None:
+                raise ConnectionError(f"Unable to download {download_url}")
+            if not complete:
+                raise DownloadCancelledError(f"Download cancelled. Partial "
+                                             f"file kept at {temp_dl_path}")
+            file_size = getsize(temp_dl_path)
+            if self._download_size is not None and \
+                    file_size != self._download_size:
+                LOG.error(f"Downloaded {file_size} bytes but expected "
+                          f"{self._download_size}")
+                remove(temp_dl_path)
+                return
+            if file_size < self.min_update_size:
+                LOG.error(f"Downloaded file is too small "
+                          f"({file_size / 1048576}MiB)")
                 remove(temp_dl_path)
-                self._downloading = False
                 return
+            if expected_md5:
+                file_md5 = hash_file(temp_dl_path)
+                if file_md5 != expected_md5:
+                    LOG.error(f"Downloaded file hash ({file_md5}) does not "
+                              f"match expected ({expected_md5})")
+                    remove(temp_dl_path)
+                    return
+            manifest = build_manifest(temp_dl_path, self.verify_chunk_size,
+                                      workers=self.verify_workers)
+            manifest["url"] = download_url
+            save_manifest(download_path, manifest)
             shutil.move(temp_dl_path, download_path)
             LOG.info(f"Saved download to {download_path}")
-            self._downloading = False
             return download_path
+        except DownloadCancelledError as e:
+            LOG.info(e)
+            raise
         except Exception as e:
             LOG.exception(e)
             if isfile(temp_dl_path):
-                remove(temp_dl_path)
-        self._downloading = False
+                LOG.info(f"Partial file kept at {temp_dl_path}")
+
+    def _stream_to_file(self, url: str, temp_dl_path: str) -> bool:
+        """
+        Stream a remote resource to a local file, resuming from the end of any
+        existing partial file if the server supports range requests. The total
+        size reported by the server is kept in `_download_size`, and a server
+        reporting a different size is treated as a failed transfer.
+        @param url: URL of file to download
+        @param temp_dl_path: path of partial output file
+        @return: True if the download completed, False if it was cancelled
+        """
+        headers = dict()
+        resume_from = getsize(temp_dl_path) if isfile(temp_dl_path) else 0
+        if resume_from:
+            headers["Range"] = f"bytes={resume_from}-"
+        with requests.get(url, stream=True, headers=headers,
+                          timeout=self.request_timeout) as stream:
+            self._check_download_size(url, stream, resume_from)
+            if resume_from and stream.status_code == 416:
+                if self._download_size is not None and \
+                        resume_from != self._download_size:
+                    # The partial file is not a prefix of this resource
+                    remove(temp_dl_path)
+                    raise ConnectionError(f"Partial download is larger than "
+                                          f"{url} ({self._download_size})")
+                LOG.info("Partial download already complete")
+                return True
+            if not stream.ok:
+                raise ConnectionError(f"Request to {url} failed "
+                                      f"({stream.status_code})")
+            if resume_from and stream.status_code == 206:
+                LOG.info(f"Resuming download from byte {resume_from}")
+                mode = 'ab'
+            else:
+                mode = 'wb'
+            with open(temp_dl_path, mode) as f:
+                for chunk in stream.iter_content(4096):
+                    if self._cancel_download.is_set():
+                        return False
+                    if chunk:
+                        f.write(chunk)
+        if self._download_size is not None and \
+                getsize(temp_dl_path) < self._download_size:
+            raise ConnectionError(f"Transfer from {url} ended after "
+                                  f"{getsize(temp_dl_path)} of "
+                                  f"{self._download_size} bytes")
+        return True
+
+    def _check_download_size(self, url: str, resp: requests.Response,
+                             resume_from: int):
+        """
+        Record the total size of a download from response headers and check
+        that it matches the size reported by any earlier response
+        @param url: requested URL
+        @param resp: response to a download request
+        @param resume_from: requested start byte
+        """
+        total = None
+        content_range = resp.headers.get("Content-Range", "")
+        if content_range.startswith("bytes "):
+            byte_range, _, size = content_range[6:].partition("/")
+            if resp.status_code == 206 and \
+                    not byte_range.startswith(f"{resume_from}-"):
+                raise ConnectionError(f"Unexpected range from {url}: "
+                                      f"{content_range}")
+            total = int(size) if size.isdigit() else None
+        elif resp.status_code == 200 and \
+                resp.headers.get("Content-Length", "").isdigit():
+            total = int(resp.headers["Content-Length"])
+        if total is None:
+            return
+        if self._download_size is not None and total != self._download_size:
+            raise ConnectionError(f"Size of {url} ({total}) does not match "
+                                  f"expected size ({self._download_size})")
+        self._download_size = total
+
+    def _get_with_failover(self, artifact: str, url: str,
+                           **kwargs) -> requests.Response:
+        """
+        Make a GET request to the fastest mirror of `url`, falling back to the
+        next mirror if a request fails.
+        @param artifact: artifact type (`initramfs`, `squashfs` or `metadata`)
+        @param url: URL of the resource on the origin server
+        @return: first successful response, else the last response received
+        """
+        kwargs.setdefault("timeout", self.request_timeout)
+        resp = None
+        error = None
+        for mirror_url in self._mirrors.get_urls(artifact, url):
+            try:
+                resp = requests.get(mirror_url, **kwargs)
+                if resp.ok:
+                    return resp
+                LOG.warning(f"Request to {mirror_url} failed "
+                            f"({resp.status_code})")
+            except Exception as e:
+                LOG.warning(f"Request to {mirror_url} failed: {e}")
+                error = e
+            self._mirrors.report_failure(artifact, mirror_url)
+        if resp is None:
+            raise error
+        return resp
 
-    def _get_gh_latest_release_tag(self, track: str = None) -> str:
+    def _verify_download(self, download_path: str,
+                         download_url: str = None) -> bool:
+        """
+        Verify a downloaded file against the chunk-hash manifest written when
+        it was downloaded. If any chunks are corrupted, only those chunks are
+        downloaded again and re-verified.
+        @param download_path: path to the downloaded file
+        @param download_url: URL to repair the file from (default from manifest)
+        @return: True if the file matches its manifest
+        @raises DownloadCancelledError: if a repair was cancelled
+        """
+        manifest = load_manifest(download_path)
+        if not manifest:
+            LOG.warning(f"No manifest to verify {download_path}")
+            return False
+        mismatched = verify_file(download_path, manifest,
+                                 workers=self.verify_workers)
+        if not mismatched:
+            LOG.debug(f"Verified {download_path}")
+            return True
+        LOG.warning(f"{len(mismatched)} corrupted chunks in {download_path}")
+        download_url = download_url or manifest.get("url")
+        if not download_url:
+            return False
+        try:
+            self._repair_download(download_url, download_path, manifest,
+                                  mismatched)
+        except DownloadCancelledError:
+            raise
+        except Exception as e:
+            LOG.error(f"Failed to repair {download_path}: {e}")
+            return False
+        mismatched = verify_file(download_path, manifest, mismatched,
+                                 self.verify_workers)
+        if mismatched:
+            LOG.error(f"Chunks {mismatched} still invalid after repair")
+            return False
+        LOG.info(f"Repaired {download_path}")
+        return True
+
+    def _repair_download(self, download_url: str, download_path: str,
+                         manifest: dict, chunks: list):
+        """
+        Re-download the specified chunks of a file using range requests. The
+        repair may be cancelled like a download; chunks already written are
+        kept and re-verified on the next attempt.
+        @param download_url: URL of the file to repair from
+        @param download_path: path to the local file to repair
+        @param manifest: chunk-hash manifest for the file
+        @param chunks: indices of chunks to re-download
+        @raises DownloadCancelledError: if the repair was cancelled
+        """
+        chunk_size = manifest['chunk_size']
+        with self._download_lock:
+            self._cancel_download.clear()
+            self._download_target = download_path
+            self._downloading = True
+            try:
+                with open(download_path, 'r+b') as f:
+                    for index in chunks:
+                        start = index * chunk_size
+                        end = min(start + chunk_size, manifest['size']) - 1
+                        LOG.debug(f"Downloading bytes {start}-{end}")
+                        with self._get_with_failover(
+                                "squashfs", download_url, stream=True,
+                                headers={"Range": f"bytes={start}-{end}"}) \
+                                as stream:
+                            if stream.status_code != 206:
+                                raise ConnectionError(
+                                    f"Range request for {download_url} "
+                                    f"failed ({stream.status_code})")
+                            f.seek(start)
+                            for data in stream.iter_content(1048576):
+                                if self._cancel_download.is_set():
+                                    raise DownloadCancelledError(
+                                        f"Repair of {download_path} was "
+                                        f"cancelled")
+                                f.write(data)
+                    f.truncate(manifest['size'])
+            finally:
+                self._downloading = False
+                self._download_target = None
+
+    @staticmethod
+    def _remove_download(download_path: str):
+        """
+        Remove a downloaded file and its manifest
+        @param download_path: path to the downloaded file
+        """
+        for path in (download_path, get_manifest_path(download_path)):
+            if isfile(path):
+                remove(path)
+
+    def _get_gh_latest_release_tag(self, track: str = None,
+                                   urgent: bool = False) -> str:
         """
         Get the GitHub release tag associated with the latest version of the
         installed OS (on the requested track). Note that the latest GitHub
         release may not be relevant to the installed OS
         @param track: "beta" or "stable" release track. An invalid request will
             default to "stable"
+        @param urgent: if True, the request may use the reserved API quota
         @return: String tag in `self.release_repo` corresponding to the newest
             valid release
         """
         include_prerelease = (track or self._default_branch) in ("dev", "beta")
         default_time = "2000-01-01T00:00:00Z"
-        url = f'https://api.github.com/repos/{self.release_repo}/releases'
+        path = f'/repos/{self.release_repo}/releases'
         LOG.debug(f"Getting releases from {self.release_repo}. "
                   f"prerelease={include_prerelease}")
         if not include_prerelease:
-            url = f"{url}/latest"
-            release = requests.get(url).json()
-            return release.get("tag_name")
+            release = self._github.get(f"{path}/latest", urgent)
+            tag = release.get("tag_name") if isinstance(release, dict) \
+                else None
+            if not tag:
+                raise ValueError(f"No release tag in response: {release}")
+            return tag
 
-        releases: list = requests.get(url).json()
+        releases = self._github.get(path, urgent)
+        if not isinstance(releases, list):
+            raise ValueError(f"Expected a list of releases: {releases}")
         installed_os = self.build_info.get("base_os", {}).get("name")
         if not installed_os:
             raise RuntimeError(f"Unable to determine installed OS from: "
                                f"{self.build_info}")
         releases = [r for r in releases if installed_os in r.get('body', '')]
+        if not releases:
+            raise ValueError(f"No releases found for {installed_os}")
         releases.sort(key=lambda r: datetime.strptime(r.get('created_at',
                                                             default_time),
                                                       "%Y-%m-%dT%H:%M:%SZ"),
@@ -316,10 +962,10 @@ class DeviceUpdater(PHALPlugin):
         if not installed_os:
             raise RuntimeError(f"Unable to determine installed OS from: "
                                f"{self.build_info}")
-        meta_url = (f"https://raw.githubusercontent.com/{self.release_repo}/"
+        meta_url = (f"{self.github_raw_url}/{self.release_repo}/"
                     f"{tag}/{installed_os}.yaml")
         LOG.debug(f"Getting metadata from {meta_url}")
-        resp = requests.get(meta_url)
+        resp = self._get_with_failover("metadata", meta_url)
         if not resp.ok:
             raise ValueError(f"Unable to get metadata for tag={tag}")
         meta_text = resp.text
@@ -362,68 +1008,129 @@ class DeviceUpdater(PHALPlugin):
 
     def check_update_initramfs(self, message: Message):
         """
-        Handle a request to check for initramfs updates
+        Handle a request to check for initramfs updates. The legacy check is
+        only used if the GitHub check fails since it may download the initramfs.
         @param message: `neon.check_update_initramfs` Message
         """
         track = message.data.get("track") or self._default_branch
         track = "beta" if track in ("dev", "beta") else "stable"
         try:
-            meta = self._get_gh_release_meta_from_tag(
-                self._get_gh_latest_release_tag(track))
-            update_available = meta['initramfs']['md5'] != self.initramfs_hash
+            update_available, meta = self._network.run_with_fallback(
+                partial(self._check_initramfs_update, track,
+                        message.data.get("urgent", False)),
+                partial(self._legacy_check_initramfs_update, track),
+                timeout=self.check_timeout)
         except Exception as e:
-            LOG.exception(e)
-            meta = dict()
-            update_available = self._legacy_check_initramfs_update_available(track)
+            LOG.exception(f"Failed to check for initramfs updates: {e!r}")
+            self.bus.emit(message.response({"update_available": False,
+                                            "new_meta": None,
+                                            "current_hash": self.initramfs_hash,
+                                            "track": track,
+                                            "error": repr(e)}))
+            return
         self.bus.emit(message.response({"update_available": update_available,
                                         "new_meta": meta.get('initramfs'),
                                         "current_hash": self.initramfs_hash,
                                         "track": track}))
 
+    def _check_initramfs_update(self, track: str, urgent: bool = False) \
+            -> Tuple[bool, dict]:
+        """
+        Check for an initramfs update using GitHub release metadata
+        @param track: update track to check
+        @param urgent: if True, the request may use the reserved API quota
+        @return: True if an update is available, and the release metadata
+        """
+        meta = self._get_gh_release_meta_from_tag(
+            self._get_gh_latest_release_tag(track, urgent))
+        return meta['initramfs']['md5'] != self.initramfs_hash, meta
+
+    def _legacy_check_initramfs_update(self, track: str) -> Tuple[bool, dict]:
+        """
+        Check for an initramfs update using the legacy MD5 file
+        @param track: update track to check
+        @return: True if an update is available, and empty metadata
+        """
+        return self._legacy_check_initramfs_update_available(track), dict()
+
+    def _check_squashfs_update(self, track: str, urgent: bool = False) \
+            -> Tuple[bool, Optional[dict]]:
+        """
+        Check for a squashFS update using GitHub release metadata
+        @param track: update track to check
+        @param urgent: if True, the request may use the reserved API quota
+        @return: True if an update is available, and the update metadata
+        """
+        tag = self._get_gh_latest_release_tag(track, urgent)
+        if self.build_info.get('version') and \
+                self.build_info['version'] == tag:
+            LOG.debug(f"Already up to date")
+            return False, None
+        update_meta = self._get_gh_release_meta_from_tag(tag)
+        return update_meta['base_os'] != self.build_info['base_os'], \
+            update_meta
+
+    def _legacy_check_squashfs_update(self, track: str) \
+            -> Tuple[bool, Optional[dict]]:
+        """
+        Check for a squashFS update using the legacy directory listing
+        @param track: update track to check
+        @return: True if an update is available, and the update metadata
+        """
+        response = self._legacy_check_squashfs_update_available(track)
+        if not response:
+            return False, None
+        new_version, download_url = response
+        # Get metadata for new version
+        meta_url = download_url.replace(".squashfs", ".json")
+        try:
+            resp = self._get_with_failover("squashfs", meta_url)
+            if resp.ok:
+                update_meta = resp.json()
+            else:
+                LOG.warning(f"Unable to get metadata: {resp.status_code}")
+                update_meta = dict()
+        except Exception as e:
+            LOG.exception(e)
+            update_meta = dict()
+        update_meta["download_url"] = download_url
+        return True, update_meta
+
     def check_update_squashfs(self, message: Message):
         """
-        Handle a request to check for squash updates
+        Handle a request to check for squash updates. The legacy check is
+        used if the GitHub check fails, and is started early if the GitHub
+        check takes longer than `check_hedge_delay` seconds.
         @param message: `neon.check_update_squashfs` Message
         """
         track = message.data.get("track") or self._default_branch
         try:
-            tag = self._get_gh_latest_release_tag(track)
-            if self._build_info.get('version') and \
-                    self._build_info['version'] == tag:
-                LOG.debug(f"Already up to date")
+            update_available, update_meta = self._network.run_with_fallback(
+                partial(self._check_squashfs_update, track,
+                        message.data.get("urgent", False)),
+                partial(self._legacy_check_squashfs_update, track),
+                timeout=self.check_timeout,
+                hedge_delay=self.check_hedge_delay)
+            rollout_deferred = False
+            if update_available and \
+                    not self._check_rollout_admitted(update_meta):
+                LOG.info("Update not yet rolled out to this device")
                 update_available = False
-                update_meta = None
-            else:
-                update_meta = self._get_gh_release_meta_from_tag(tag)
-                update_available = (
-                        update_meta['base_os'] != self._build_info['base_os'])
+                rollout_deferred = True
+            if update_available:
+                self._record_squashfs_checked(update_meta)
         except Exception as e:
-            LOG.info(f"Falling back to legacy update check: {e}")
-            response = self._legacy_check_squashfs_update_available(track)
-
-            if response:
-                update_available = True
-                new_version, download_url = response
-                # Get metadata for new version
-                meta_url = download_url.replace(".squashfs", ".json")
-                try:
-                    resp = requests.get(meta_url)
-                    if resp.ok:
-                        update_meta = resp.json()
-                    else:
-                        LOG.warning(f"Unable to get metadata: "
-                                    f"{resp.status_code}")
-                        update_meta = dict()
-                except Exception as e:
-                    LOG.exception(e)
-                    update_meta = dict()
-                update_meta["download_url"] = download_url
-            else:
-                update_available = False
-                update_meta = None
+            LOG.exception(f"Failed to check for updates: {e!r}")
+            self.bus.emit(message.response({"update_available": False,
+                                            "update_metadata": None,
+                                            "rollout_deferred": False,
+                                            "track": track,
+                                            "error": repr(e)}))
+            return
 
         self.bus.emit(message.response({"update_available": update_available,
                                         "update_metadata": update_meta,
+                                        "rollout_deferred": rollout_deferred,
                                         "track": track}))
 
     def update_squashfs(self, message: Message):
@@ -435,33 +1142,33 @@ class DeviceUpdater(PHALPlugin):
         LOG.info(f"Checking squashfs update: {track}")
         update_metadata = message.data.get("update_metadata")
         try:
-            if not update_metadata:
-                update_metadata = self._get_gh_release_meta_from_tag(
-                    self._get_gh_latest_release_tag(track))
-            platform = self.build_info['base_os']['platform']
-            download_url = update_metadata['download_url'].replace(
-                f"/{platform}/", f"/{platform}/updates/").replace(".img.xz",
-                                                                  ".squashfs")
-            download_path = str(join(dirname(self.initramfs_update_path),
-                                     update_metadata['build_version']))
-            if isfile(download_path):
-                LOG.info("Update already downloaded")
-                update_file = download_path
-            else:
-                update_file = self._stream_download_file(download_url,
-                                                         download_path)
-        except Exception as e:
-            LOG.exception(f"Failed to get download_url: {e}")
-            update_file = self._legacy_get_squashfs_latest(track)
+            try:
+                if not update_metadata:
+                    update_metadata = self._get_gh_release_meta_from_tag(
+                        self._get_gh_latest_release_tag(track, urgent=True))
+                download_url, download_path = \
+                    self._get_squashfs_download(update_metadata)
+                update_file = self._get_squashfs_update(
+                    download_url, download_path,
+                    self._get_squashfs_md5(update_metadata))
+            except DownloadCancelledError:
+                raise
+            except Exception as e:
+                LOG.exception(f"Failed to get download_url: {e}")
+                update_file = self._legacy_get_squashfs_latest(track)
 
-        try:
             if update_file:
                 LOG.info("Update downloaded and will be installed on restart")
-                shutil.copyfile(update_file, self.squashfs_path)
+                self._stage_squashfs(update_file,
+                                     (update_metadata or dict()).get("base_os"))
                 response = message.response({"new_version": update_file})
             else:
                 LOG.info("Already updated")
                 response = message.response({"new_version": None})
+        except DownloadCancelledError as e:
+            LOG.info(e)
+            response = message.response({"new_version": None,
+                                         "cancelled": True})
         except Exception as e:
             LOG.exception(e)
             response = message.response({"error": repr(e)})
@@ -469,10 +1176,12 @@ class DeviceUpdater(PHALPlugin):
 
     def update_initramfs(self, message: Message):
         """
-        Handle a request to update initramfs.
+        Handle a request to update initramfs. The update is downloaded and
+        applied in a background thread which emits
+        `neon.update_initramfs.progress` events while the update service runs,
+        then a `neon.update_initramfs.complete` event and a response.
         @param message: `neon.update_initramfs` Message
         """
-        branch = message.data.get("track") or self._default_branch
         LOG.info("Performing initramfs update")
         if not isfile(self.initramfs_real_path) and \
                 not message.data.get("force_update"):
@@ -481,34 +1190,258 @@ class DeviceUpdater(PHALPlugin):
                                          "error": "No initramfs to update"})
             self.bus.emit(response)
             return
+        if not self._initramfs_lock.acquire(blocking=False):
+            LOG.warning("InitramFS update already in progress")
+            self.bus.emit(message.response(
+                {"updated": None,
+                 "error": "InitramFS update already in progress"}))
+            return
+        # The lock is released by the update thread
         try:
-            meta = self._get_gh_release_meta_from_tag(
-                self._get_gh_latest_release_tag(branch))
-            branch = meta['image']['version']
-        except Exception as e:
-            LOG.error(f"Failed to get image version for branch {branch}: {e}")
+            target = self._profiler.wrap("neon.update_initramfs",
+                                         self._update_initramfs) if \
+                self._profiler else self._update_initramfs
+            Thread(target=target, args=(message,), daemon=True).start()
+        except Exception:
+            self._initramfs_lock.release()
+            raise
+
+    def _update_initramfs(self, message: Message):
+        """
+        Download and apply the latest initramfs and emit the result. If the
+        service has not finished within `initramfs_timeout`, a
+        `neon.update_initramfs.pending` event is emitted and the service is
+        polled until it finishes. This must be called while holding
+        `_initramfs_lock`, which is released when the service has finished.
+        @param message: `neon.update_initramfs` Message
+        """
         try:
-            if not self._get_initramfs_latest(branch):
-                LOG.info("No initramfs update")
-                response = message.response({"updated": False})
-            else:
-                LOG.debug("Updating initramfs")
-                proc = Popen("systemctl start update-initramfs", shell=True)
-                success = proc.wait(30) == 0
-                if success:
-                    LOG.info("Updated initramfs")
-                    self._initramfs_hash = None  # Update on next check
-                    response = message.response({"updated": success})
+            branch = message.data.get("track") or self._default_branch
+            try:
+                meta = self._get_gh_release_meta_from_tag(
+                    self._get_gh_latest_release_tag(branch, urgent=True))
+                branch = meta['image']['version']
+            except Exception as e:
+                LOG.error(f"Failed to get image version for branch {branch}: "
+                          f"{e}")
+            try:
+                if not self._get_initramfs_latest(branch):
+                    LOG.info("No initramfs update")
+                    response = message.response({"updated": False})
                 else:
-                    LOG.error(f"Update service exited with error: {success}")
-                    response = message.response({"updated": False,
-                                                 "error": str(success)})
+                    try:
+                        properties = self._run_initramfs_service(message)
+                    except UnitTimeoutError as e:
+                        # A slow service is not a failure; wait for the result
+                        properties = self._wait_for_initramfs_service(
+                            e.initial, message)
+                    if SystemdUnit.is_success(properties):
+                        response = message.response({"updated": True})
+                    else:
+                        response = message.response(
+                            {"updated": False,
+                             "error": self._get_initramfs_error(properties)})
+            except Exception as e:
+                LOG.error(e)
+                response = message.response({"updated": None,
+                                             "error": repr(e)})
+        finally:
+            self._initramfs_lock.release()
+        self.bus.emit(message.forward("neon.update_initramfs.complete",
+                                      {**response.data,
+                                       "initramfs_hash": self._initramfs_hash}))
+        self.bus.emit(response)
+
+    def apply_update(self, message: Message):
+        """
+        Handle a request to update initramfs and squashfs together. Release
+        metadata is resolved once and both files are downloaded concurrently.
+        The squashfs is staged first, keeping any previously staged squashfs
+        aside, so it can be restored if applying the initramfs fails. If the
+        initramfs service has not finished within `initramfs_timeout`, both
+        updates stay staged and a `pending` response is emitted; a
+        `neon.device_updater.apply_update.complete` event follows once the
+        service finishes.
+        @param message: `neon.device_updater.apply_update` Message
+        """
+        track = message.data.get("track") or self._default_branch
+        update_metadata = message.data.get("update_metadata")
+        force = message.data.get("force_update")
+        squashfs_only = message.data.get("squashfs_only")
+        squashfs_temp = f"{self.squashfs_path}.tmp"
+        squashfs_previous = f"{self.squashfs_path}.previous"
+        initramfs_temp = f"{self.initramfs_update_path}.download"
+        squashfs_staged = False
+        pending = None
+        try:
+            if not update_metadata:
+                update_metadata = self._get_gh_release_meta_from_tag(
+                    self._get_gh_latest_release_tag(track, urgent=True))
+            new_initramfs = update_metadata.get('initramfs') or dict()
+            update_initramfs = not squashfs_only and \
+                bool(new_initramfs.get('md5')) and \
+                (isfile(self.initramfs_real_path) or force) and \
+                new_initramfs['md5'] != self.initramfs_hash
+            update_squashfs = force or \
+                update_metadata.get('base_os') != self.build_info.get('base_os')
+            if not (update_initramfs or update_squashfs):
+                LOG.info("Already updated")
+                self.bus.emit(message.response({"updated": False}))
+                return
+
+            LOG.info(f"Applying update: squashfs={update_squashfs}|"
+                     f"initramfs={update_initramfs}")
+            squashfs_file = None
+            initramfs_file = None
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                if update_squashfs:
+                    squashfs_future = executor.submit(
+                        self._get_squashfs_update,
+                        *self._get_squashfs_download(update_metadata),
+                        self._get_squashfs_md5(update_metadata))
+                if update_initramfs:
+                    initramfs_future = executor.submit(
+                        self._download_initramfs,
+                        self.initramfs_url.format(
+                            update_metadata['image']['version']),
+                        new_initramfs['md5'])
+                if update_squashfs:
+                    squashfs_file = squashfs_future.result()
+                    if not squashfs_file:
+                        raise RuntimeError("Failed to download squashfs")
+                if update_initramfs:
+                    initramfs_file = initramfs_future.result()
+
+            # Stage squashfs first since it can be undone; initramfs can't
+            if squashfs_file:
+                shutil.copyfile(squashfs_file, squashfs_temp)
+                if isfile(self.squashfs_path):
+                    replace(self.squashfs_path, squashfs_previous)
+                replace(squashfs_temp, self.squashfs_path)
+                squashfs_staged = True
+            if initramfs_file:
+                if not self._initramfs_lock.acquire(blocking=False):
+                    raise RuntimeError("InitramFS update already in progress")
+                try:
+                    replace(initramfs_file, self.initramfs_update_path)
+                    if not self._apply_initramfs(message):
+                        raise RuntimeError("Failed to apply initramfs update")
+                except UnitTimeoutError as e:
+                    # The service may still apply the initramfs; keep the
+                    # update file and staged squashfs until it finishes
+                    pending = e
+                except Exception:
+                    if isfile(self.initramfs_update_path):
+                        remove(self.initramfs_update_path)
+                    raise
+                finally:
+                    if not pending:
+                        self._initramfs_lock.release()
+            if pending:
+                # The lock is released by the thread once the service finishes
+                Thread(target=self._settle_apply_update,
+                       args=(message, pending.initial, squashfs_file,
+                             update_metadata.get('base_os'),
+                             squashfs_previous),
+                       daemon=True).start()
+                response = message.response({
+                    "updated": None,
+                    "pending": True,
+                    "new_version": squashfs_file,
+                    "initramfs_updated": None,
+                    "version": update_metadata.get('version')})
+            else:
+                if squashfs_file:
+                    self._commit_squashfs(squashfs_file,
+                                          update_metadata.get('base_os'),
+                                          squashfs_previous)
+                response = message.response({
+                    "updated": True,
+                    "new_version": squashfs_file,
+                    "initramfs_updated": bool(initramfs_file),
+                    "version": update_metadata.get('version')})
         except Exception as e:
-            LOG.error(e)
-            response = message.response({"updated": None,
-                                         "error": repr(e)})
+            LOG.exception(e)
+            if pending:
+                # The initramfs may still be applied; leave the squashfs staged
+                self._initramfs_lock.release()
+            else:
+                self._unstage_squashfs(squashfs_previous, squashfs_staged)
+            for path in (squashfs_temp, initramfs_temp):
+                if isfile(path):
+                    remove(path)
+            response = message.response(
+                {"updated": False, "error": repr(e),
+                 "cancelled": isinstance(e, DownloadCancelledError)})
         self.bus.emit(response)
 
+    def _settle_apply_update(self, message: Message, initial: dict,
+                             squashfs_file: Optional[str],
+                             base_os: Optional[dict], previous_path: str):
+        """
+        Wait for an initramfs update from `apply_update` that did not finish
+        within `initramfs_timeout`, then keep the staged squashfs if the update
+        succeeded or restore the previous one if it failed. This must be called
+        while holding `_initramfs_lock`, which is released when done.
+        @param message: `neon.device_updater.apply_update` Message
+        @param initial: unit properties from before the service was started
+        @param squashfs_file: path to the staged squashfs update, if any
+        @param base_os: `base_os` metadata of the staged squashfs update
+        @param previous_path: path the previously staged squashfs was moved to
+        """
+        try:
+            properties = self._wait_for_initramfs_service(initial, message)
+            if SystemdUnit.is_success(properties):
+                if squashfs_file:
+                    self._commit_squashfs(squashfs_file, base_os,
+                                          previous_path)
+                data = {"updated": True, "new_version": squashfs_file,
+                        "initramfs_updated": True}
+            else:
+                if isfile(self.initramfs_update_path):
+                    remove(self.initramfs_update_path)
+                self._unstage_squashfs(previous_path, bool(squashfs_file))
+                data = {"updated": False,
+                        "error": self._get_initramfs_error(properties)}
+        except Exception as e:
+            # Service state is unknown; leave staged files as they are
+            LOG.exception(f"Failed to get initramfs update result: {e!r}")
+            data = {"updated": None, "error": repr(e)}
+        finally:
+            self._initramfs_lock.release()
+        self.bus.emit(message.forward(
+            "neon.device_updater.apply_update.complete", data))
+
+    def _commit_squashfs(self, squashfs_file: str, base_os: Optional[dict],
+                         previous_path: str):
+        """
+        Record a squashfs staged by `apply_update` and remove the previously
+        staged squashfs
+        @param squashfs_file: path to the downloaded squashfs update
+        @param base_os: `base_os` metadata of the squashfs update
+        @param previous_path: path the previously staged squashfs was moved to
+        """
+        if isfile(previous_path):
+            remove(previous_path)
+        self._record_squashfs_staged(squashfs_file, base_os)
+        LOG.info("Update will be installed on restart")
+
+    def _unstage_squashfs(self, previous_path: str, staged: bool):
+        """
+        Restore the squashfs that was staged before a failed update
+        @param previous_path: path the previously staged squashfs was moved to
+        @param staged: True if the new squashfs was moved to `squashfs_path`
+        """
+        try:
+            if isfile(previous_path):
+                LOG.info("Restoring previously staged squashfs")
+                replace(previous_path, self.squashfs_path)
+            elif staged and isfile(self.squashfs_path):
+                LOG.info("Removing staged squashfs")
+                remove(self.squashfs_path)
+        except OSError as e:
+            LOG.error(f"Failed to restore staged squashfs: {e!r}")
+
     def check_update_available(self, message: Message):
         """
         Handle a request to check for OS updates
@@ -516,10 +1449,25 @@ class DeviceUpdater(PHALPlugin):
         """
         track = "beta" if message.data.get("include_prerelease") else "stable"
         installed_version = self.build_info.get("build_version")
-        latest_version = self._get_gh_latest_release_tag(track)
+        try:
+            latest_version = self._get_gh_latest_release_tag(
+                track, message.data.get("urgent", False))
+        except Exception as e:
+            LOG.error(f"Failed to get latest version: {e!r}")
+            self.bus.emit(message.response(
+                {"installed_version": installed_version,
+                 "latest_version": None, "error": repr(e)}))
+            return
         self.bus.emit(message.response({"installed_version": installed_version,
                                         "latest_version": latest_version}))
 
+    def shutdown(self):
+        """
+        Stop background network workers and remove messagebus listeners
+        """
+        self._network.shutdown()
+        PHALPlugin.shutdown(self)
+
     def get_build_info(self, message: Message):
         """
         Handle a request to check for current OS build info
@@ -527,9 +1475,54 @@ class DeviceUpdater(PHALPlugin):
         """
         self.bus.emit(message.response(self.build_info))
 
+    def get_update_state(self, message: Message):
+        """
+        Handle a request to get the persisted state of updates
+        @param message: `neon.device_updater.get_update_state` Message
+        """
+        self.bus.emit(message.response({
+            "squashfs": self._journal.get("squashfs"),
+            "initramfs": self._journal.get("initramfs")}))
+
     def get_download_status(self, message: Message):
         """
         Handle a request to check if a download is in-progress
         @param message: `neon.device_updater.get_download_status` Message
         """
         self.bus.emit(message.response(data={"downloading": self._downloading}))
+
+    def cancel_download(self, message: Message):
+        """
+        Handle a request to cancel an in-progress download. Any partially
+        downloaded file is kept so the download may be resumed later.
+        @param message: `neon.device_updater.cancel_download` Message
+        """
+        download_path = self._download_target
+        if not self._downloading:
+            LOG.debug("No download to cancel")
+            self.bus.emit(message.response({"cancelled": False,
+                                            "download_path": None}))
+            return
+        LOG.info(f"Cancelling download of {download_path}")
+        self._cancel_download.set()
+        # Wait for the download thread to release the lock
+        cancelled = self._download_lock.acquire(
+            timeout=message.data.get("timeout", 10))
+        if cancelled:
+            self._download_lock.release()
+        self.bus.emit(message.response({"cancelled": cancelled,
+                                        "download_path": download_path}))
+
+    def get_profile(self, message: Message):
+        """
+        Handle a request to get saved handler profiles
+        @param message: `neon.device_updater.get_profile` Message
+        """
+        if not self._profiler:
+            self.bus.emit(message.response({"enabled": False,
+                                            "profiles": []}))
+            return
+        profiles = self._profiler.get_profiles(message.data.get("handler"),
+                                               message.data.get("limit"))
+        self.bus.emit(message.response({"enabled": True,
+                                        "profiles": profiles}))
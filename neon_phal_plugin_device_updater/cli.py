@@ -0,0 +1,321 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import json
+import sys
+
+from contextlib import contextmanager, redirect_stdout
+from os.path import getsize, isfile
+from time import time
+from typing import Optional
+
+import yaml
+from ovos_bus_client.message import Message
+from ovos_utils.messagebus import FakeBus
+
+from neon_phal_plugin_device_updater import DeviceUpdater
+from neon_phal_plugin_device_updater.log_utils import log_to_stderr
+from neon_phal_plugin_device_updater.verify import load_manifest, verify_file
+
+_HANDLER_TIMEOUT = 3600
+
+
+class _Timer:
+    def __init__(self):
+        """
+        Record the wall time of named phases of a command
+        """
+        self.timings = dict()
+
+    @contextmanager
+    def time(self, phase: str):
+        """
+        Context manager to time a phase
+        @param phase: name of the phase to record
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self.timings[phase] = round(time() - start, 3)
+
+
+def _get_plugin(args: argparse.Namespace) -> DeviceUpdater:
+    """
+    Create a `DeviceUpdater` connected to an in-process bus
+    @param args: parsed CLI arguments
+    @return: initialized plugin
+    """
+    config = dict()
+    if args.config:
+        with open(args.config) as f:
+            config = yaml.safe_load(f) or dict()
+    if args.build_info:
+        # Build info is read while the plugin reconciles update state
+        config["build_info_path"] = args.build_info
+    return DeviceUpdater(FakeBus(), config=config)
+
+
+def _request(plugin: DeviceUpdater, msg_type: str,
+             data: Optional[dict] = None) -> dict:
+    """
+    Call a plugin handler and return its response data
+    @param plugin: plugin to call
+    @param msg_type: Message type of the handler to call
+    @param data: Message data
+    @return: response data
+    """
+    resp = plugin.bus.wait_for_response(Message(msg_type, data or dict()),
+                                        timeout=_HANDLER_TIMEOUT)
+    if not resp:
+        raise TimeoutError(f"No response to {msg_type}")
+    return resp.data
+
+
+def _get_metadata(plugin: DeviceUpdater, track: str) -> dict:
+    """
+    Get release metadata for the latest release on a track
+    @param plugin: plugin to query
+    @param track: update track to get the latest release of
+    @return: dict release metadata
+    """
+    return plugin._get_gh_release_meta_from_tag(
+        plugin._get_gh_latest_release_tag(track, urgent=True))
+
+
+def check(plugin: DeviceUpdater, args: argparse.Namespace,
+          timer: _Timer) -> dict:
+    """
+    Check for available squashFS and optionally initramfs updates
+    @param plugin: plugin to check for updates with
+    @param args: parsed CLI arguments
+    @param timer: timer to record phases with
+    @return: dict check responses by update type
+    """
+    result = dict()
+    with timer.time("check_squashfs"):
+        result["squashfs"] = _request(plugin, "neon.check_update_squashfs",
+                                      {"track": args.track, "urgent": True})
+    if args.initramfs:
+        with timer.time("check_initramfs"):
+            result["initramfs"] = _request(plugin,
+                                           "neon.check_update_initramfs",
+                                           {"track": args.track,
+                                            "urgent": True})
+    return result
+
+
+def download(plugin: DeviceUpdater, args: argparse.Namespace,
+             timer: _Timer) -> dict:
+    """
+    Download and verify the latest squashFS update without staging it
+    @param plugin: plugin to download the update with
+    @param args: parsed CLI arguments
+    @param timer: timer to record phases with
+    @return: dict download URL, path and result
+    """
+    with timer.time("metadata"):
+        meta = _get_metadata(plugin, args.track)
+        download_url, download_path = plugin._get_squashfs_download(meta)
+    result = {"version": meta.get("version"),
+              "download_url": download_url,
+              "download_path": download_path}
+    if args.dry_run:
+        result["downloaded"] = isfile(download_path)
+        return result
+    with timer.time("download"):
+        update_file = plugin._get_squashfs_update(
+            download_url, download_path, plugin._get_squashfs_md5(meta))
+    result["downloaded"] = bool(update_file)
+    if update_file:
+        result["size"] = getsize(update_file)
+    return result
+
+
+def verify(plugin: DeviceUpdater, args: argparse.Namespace,
+           timer: _Timer) -> dict:
+    """
+    Verify a downloaded file against its manifest. Corrupted chunks are
+    downloaded again unless this is a dry run.
+    @param plugin: plugin to verify the file with
+    @param args: parsed CLI arguments
+    @param timer: timer to record phases with
+    @return: dict verification result
+    """
+    result = {"path": args.path}
+    if args.dry_run:
+        manifest = load_manifest(args.path)
+        if not manifest:
+            result["valid"] = False
+            result["error"] = "No manifest"
+            return result
+        with timer.time("verify"):
+            mismatched = verify_file(args.path, manifest,
+                                     workers=plugin.verify_workers)
+        result["valid"] = not mismatched
+        result["mismatched_chunks"] = mismatched
+        return result
+    with timer.time("verify"):
+        result["valid"] = plugin._verify_download(args.path)
+    return result
+
+
+def stage(plugin: DeviceUpdater, args: argparse.Namespace,
+          timer: _Timer) -> dict:
+    """
+    Download, verify and stage the latest initramfs and squashFS updates.
+    Applying an initramfs update starts the initramfs service on this host.
+    @param plugin: plugin to stage updates with
+    @param args: parsed CLI arguments
+    @param timer: timer to record phases with
+    @return: dict staging result
+    """
+    if args.dry_run:
+        with timer.time("metadata"):
+            meta = _get_metadata(plugin, args.track)
+            download_url, download_path = plugin._get_squashfs_download(meta)
+        return {"version": meta.get("version"),
+                "download_url": download_url,
+                "download_path": download_path,
+                "squashfs_path": plugin.squashfs_path,
+                "initramfs": None if args.squashfs_only else
+                meta.get("initramfs"),
+                "staged": False}
+    with timer.time("apply_update"):
+        result = _request(plugin, "neon.device_updater.apply_update",
+                          {"track": args.track,
+                           "force_update": args.force,
+                           "squashfs_only": args.squashfs_only})
+    result["staged"] = bool(result.get("updated"))
+    return result
+
+
+def _is_success(result: dict) -> bool:
+    """
+    Check if a command succeeded
+    @param result: dict command result
+    @return: False if the result or any response in it has an error or an
+        invalid file
+    """
+    if "error" in result or not result.get("valid", True):
+        return False
+    return all(_is_success(value) for value in result.values()
+               if isinstance(value, dict))
+
+
+def _print_result(result: dict, as_json: bool, stream=None):
+    """
+    Print command results
+    @param result: dict result to print
+    @param as_json: if True, print as JSON, else as `key: value` lines
+    @param stream: file to print to (default stdout)
+    """
+    stream = stream or sys.stdout
+    if as_json:
+        print(json.dumps(result, indent=2, default=str), file=stream)
+        return
+    for key, value in result.items():
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, default=str)
+        print(f"{key}: {value}", file=stream)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Get the argument parser for the CLI
+    @return: configured ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        prog="neon-device-updater",
+        description="Check for, download, verify and stage OS updates "
+                    "without a messagebus")
+    parser.add_argument("--config", help="YAML or JSON plugin configuration")
+    parser.add_argument("--build-info",
+                        help="build_info.json to use instead of the "
+                             "installed build info")
+    parser.add_argument("--track", default=None,
+                        help="update track (i.e. stable, beta)")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    parser.add_argument("--timing", action="store_true",
+                        help="include timing summary in results")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="do not download, repair or stage any files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    check_parser = commands.add_parser("check", help="check for updates")
+    check_parser.add_argument("--initramfs", action="store_true",
+                              help="also check for initramfs updates")
+    check_parser.set_defaults(func=check)
+    commands.add_parser("download", help="download and verify the latest "
+                                         "squashfs update").set_defaults(
+        func=download)
+    verify_parser = commands.add_parser("verify",
+                                        help="verify a downloaded update")
+    verify_parser.add_argument("path", help="path to downloaded update")
+    verify_parser.set_defaults(func=verify)
+    stage_parser = commands.add_parser(
+        "stage", help="download and stage updates for the next restart")
+    stage_parser.add_argument("--force", action="store_true",
+                              help="stage even if already updated")
+    stage_parser.add_argument("--squashfs-only", action="store_true",
+                              help="stage only the squashfs update and do "
+                                   "not apply an initramfs update")
+    stage_parser.set_defaults(func=stage)
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    """
+    Run the CLI
+    @param argv: optional list of arguments (default `sys.argv`)
+    @return: exit code
+    """
+    args = get_parser().parse_args(argv)
+    timer = _Timer()
+    stdout = sys.stdout
+    log_to_stderr()
+    # Loggers created while running the command will log to stderr
+    with redirect_stdout(sys.stderr):
+        try:
+            with timer.time("total"):
+                plugin = _get_plugin(args)
+                args.track = args.track or plugin._default_branch
+                result = args.func(plugin, args, timer)
+            success = _is_success(result)
+        except Exception as e:
+            result = {"error": repr(e)}
+            success = False
+    if args.timing:
+        result["timing"] = timer.timings
+    _print_result(result, args.json, stdout)
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import requests
+
+from threading import Lock
+from time import time
+from typing import Any, Dict, Optional, Tuple
+
+from ovos_utils.log import LOG
+
+
+class RateLimitError(ConnectionError):
+    def __init__(self, message: str, reset: float):
+        """
+        Raised when a GitHub request is not made because the API quota is
+        exhausted and there is no cached result to return.
+        @param message: error message
+        @param reset: epoch time when the quota resets
+        """
+        ConnectionError.__init__(self, message)
+        self.reset = reset
+
+
+class GitHubClient:
+    def __init__(self, api_url: str = "https://api.github.com",
+                 token: Optional[str] = None, timeout: float = 10,
+                 reserve: int = 10):
+        """
+        GitHub REST API client that tracks the API rate limit. Successful
+        responses are cached and revalidated with conditional requests. When
+        the quota is low, non-urgent requests are answered from cache until
+        the quota resets, and the last known good response is returned instead
+        of failing while rate-limited.
+        @param api_url: base URL of the GitHub API
+        @param token: optional token to authenticate requests
+        @param timeout: seconds to wait for a response
+        @param reserve: requests kept in reserve for urgent requests
+        """
+        self.api_url = api_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.reserve = reserve
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset: float = 0
+        self._cache: Dict[str, Tuple[Any, Optional[str]]] = dict()
+        self._lock = Lock()
+
+    @property
+    def rate_limit(self) -> dict:
+        """
+        Get the last known API rate limit status
+        """
+        return {"limit": self.limit, "remaining": self.remaining,
+                "reset": self.reset, "authenticated": bool(self.token)}
+
+    def is_deferred(self, urgent: bool = False) -> bool:
+        """
+        Check if a request should wait until the rate limit resets
+        @param urgent: if True, requests may use the reserved quota
+        @return: True if a request should not be made now
+        """
+        if self.remaining is None or time() >= self.reset:
+            return False
+        if urgent:
+            return self.remaining <= 0
+        return self.remaining <= self.reserve
+
+    def _update_rate_limit(self, resp: requests.Response):
+        """
+        Update rate limit status from response headers
+        @param resp: response from the GitHub API
+        """
+        headers = resp.headers
+        try:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset = float(headers["X-RateLimit-Reset"])
+            if resp.status_code in (403, 429) and "Retry-After" in headers:
+                # Secondary rate limits specify a delay instead of a quota
+                self.remaining = 0
+                self.reset = time() + float(headers["Retry-After"])
+        except ValueError as e:
+            LOG.warning(f"Invalid rate limit headers: {e}")
+
+    @staticmethod
+    def _is_rate_limited(resp: requests.Response) -> bool:
+        """
+        Check if a response was rejected by a rate limit
+        @param resp: response from the GitHub API
+        @return: True if the request was rate-limited
+        """
+        if resp.status_code == 429:
+            return True
+        if resp.status_code != 403:
+            return False
+        return resp.headers.get("X-RateLimit-Remaining") == "0" or \
+            "Retry-After" in resp.headers or \
+            "rate limit" in resp.text.lower()
+
+    def get(self, path: str, urgent: bool = False) -> Any:
+        """
+        Get a JSON resource from the GitHub API
+        @param path: API path (i.e. `/repos/{owner}/{repo}/releases`)
+        @param urgent: if True, the request may use the reserved quota
+        @return: parsed JSON response, possibly cached while rate-limited
+        """
+        url = f"{self.api_url}/{path.lstrip('/')}"
+        with self._lock:
+            cached, etag = self._cache.get(url, (None, None))
+            if self.is_deferred(urgent):
+                if cached is not None:
+                    LOG.info(f"Deferring GitHub request until "
+                             f"{self.reset}: {url}")
+                    return cached
+                raise RateLimitError(f"GitHub quota exhausted until "
+                                     f"{self.reset}", self.reset)
+        headers = {"Accept": "application/vnd.github+json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if etag and cached is not None:
+            headers["If-None-Match"] = etag
+        resp = requests.get(url, headers=headers, timeout=self.timeout)
+        with self._lock:
+            self._update_rate_limit(resp)
+            if resp.status_code == 304 and cached is not None:
+                return cached
+            if self._is_rate_limited(resp):
+                self.remaining = 0
+                if self.reset <= time():
+                    # Back off if the reset time is unknown
+                    self.reset = time() + 60
+                if cached is not None:
+                    LOG.warning(f"GitHub rate limited; returning cached "
+                                f"response for {url}")
+                    return cached
+                raise RateLimitError(f"GitHub rate limited until "
+                                     f"{self.reset}", self.reset)
+            if not resp.ok:
+                raise ConnectionError(f"Request to {url} failed "
+                                      f"({resp.status_code})")
+            data = resp.json()
+            self._cache[url] = (data, resp.headers.get("ETag"))
+            return data
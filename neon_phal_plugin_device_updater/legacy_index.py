@@ -0,0 +1,157 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import requests
+
+from bisect import bisect_left, insort
+from html.parser import HTMLParser
+from posixpath import basename
+from threading import Lock
+from time import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
+
+from ovos_utils.log import LOG
+
+
+class _LinkParser(HTMLParser):
+    def __init__(self, url: str, ext: str):
+        """
+        Incrementally parse an HTML directory listing into a sorted list of
+        `(name, url)` for links to files with the requested extension.
+        @param url: URL of the page being parsed
+        @param ext: file extension of links to index
+        """
+        HTMLParser.__init__(self)
+        self.url = url
+        self.ext = ext
+        self.host = urlsplit(url).netloc
+        self.links: List[Tuple[str, str]] = list()
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if not href:
+            return
+        link = urljoin(self.url, href)
+        parts = urlsplit(link)
+        if parts.netloc != self.host:
+            return
+        name = unquote(basename(parts.path)).lower()
+        if name.endswith(self.ext):
+            insort(self.links, (name, link))
+
+
+class DirectoryIndex:
+    def __init__(self, ext: str = ".squashfs", max_age: float = 60,
+                 timeout: float = 10):
+        """
+        Cache of remote directory listings, kept in version (name) order.
+        Listings are revalidated with conditional requests after `max_age`.
+        @param ext: file extension of links to index
+        @param max_age: seconds to use a cached listing without revalidating
+        @param timeout: seconds to wait for a listing request
+        """
+        self.ext = ext
+        self.max_age = max_age
+        self.timeout = timeout
+        self._cache: Dict[str, dict] = dict()
+        self._lock = Lock()
+
+    def get_links(self, url: str) -> List[Tuple[str, str]]:
+        """
+        Get the version-ordered links in a directory listing, fetching or
+        revalidating the listing if required.
+        @param url: URL of the directory listing
+        @return: list of `(name, url)` sorted by name
+        """
+        with self._lock:
+            cached = self._cache.get(url)
+            if cached and time() - cached["checked"] < self.max_age:
+                return cached["links"]
+            headers = dict()
+            if cached and cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached and cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+            try:
+                links = self._fetch(url, headers, cached)
+            except Exception as e:
+                if not cached:
+                    raise ConnectionError(f"Unable to get index from {url}: "
+                                          f"{e}")
+                LOG.warning(f"Using cached index of {url}: {e}")
+                links = cached["links"]
+            return links
+
+    def _fetch(self, url: str, headers: dict,
+               cached: Optional[dict]) -> List[Tuple[str, str]]:
+        """
+        Request a listing and parse it as it is streamed
+        @param url: URL of the directory listing
+        @param headers: conditional request headers
+        @param cached: cached listing for `url`, if any
+        @return: list of `(name, url)` sorted by name
+        """
+        with requests.get(url, headers=headers, stream=True,
+                          timeout=self.timeout) as resp:
+            if cached and resp.status_code == 304:
+                LOG.debug(f"Index not modified: {url}")
+                cached["checked"] = time()
+                return cached["links"]
+            if not resp.ok:
+                raise ConnectionError(f"{resp.status_code}")
+            resp.encoding = resp.encoding or "utf-8"
+            parser = _LinkParser(url, self.ext)
+            for chunk in resp.iter_content(8192, decode_unicode=True):
+                parser.feed(chunk)
+            parser.close()
+            self._cache[url] = {"checked": time(),
+                                "etag": resp.headers.get("ETag"),
+                                "last_modified":
+                                    resp.headers.get("Last-Modified"),
+                                "links": parser.links}
+        LOG.debug(f"Indexed {len(parser.links)} links from {url}")
+        return parser.links
+
+    def get_newest(self, url: str,
+                   prefix: str = "") -> Optional[Tuple[str, str]]:
+        """
+        Get the newest file in a directory listing with the requested prefix
+        @param url: URL of the directory listing
+        @param prefix: required file name prefix
+        @return: `(name, url)` of the newest matching file, else None
+        """
+        links = self.get_links(url)
+        prefix = prefix.lower()
+        # Matching names are contiguous in the sorted index
+        end = bisect_left(links, (f"{prefix}\uffff",))
+        if end and links[end - 1][0].startswith(prefix):
+            return links[end - 1]
+        return None
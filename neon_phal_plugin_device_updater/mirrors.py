@@ -0,0 +1,166 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from ovos_utils.log import LOG
+
+
+def get_mirror_url(url: str, mirror: str) -> str:
+    """
+    Get the URL of a resource on a mirror. The scheme and host of `url` are
+    replaced with `mirror`, which may include a path prefix.
+    @param url: URL of the resource on the origin server
+    @param mirror: base URL of the mirror
+    @return: URL of the resource on the mirror
+    """
+    parts = urlsplit(url)
+    mirror_url = f"{mirror.rstrip('/')}{parts.path}"
+    if parts.query:
+        mirror_url = f"{mirror_url}?{parts.query}"
+    return mirror_url
+
+
+class MirrorSelector:
+    def __init__(self, mirrors: Optional[Dict[str, List[str]]] = None,
+                 cache_ttl: int = 3600, probe_timeout: float = 5,
+                 probe_bytes: int = 65536):
+        """
+        Select mirrors for each artifact type, ranked by probed response time.
+        @param mirrors: dict of artifact type to ordered list of mirror URLs
+        @param cache_ttl: seconds to cache a mirror ranking before re-probing
+        @param probe_timeout: seconds to wait for a mirror to respond to a probe
+        @param probe_bytes: number of bytes to request when probing a mirror
+        """
+        self.mirrors = mirrors or dict()
+        self.cache_ttl = cache_ttl
+        self.probe_timeout = probe_timeout
+        self.probe_bytes = probe_bytes
+        self._rankings: Dict[str, Tuple[float, List[str]]] = dict()
+        self._lock = Lock()
+
+    def get_urls(self, artifact: str, url: str) -> List[str]:
+        """
+        Get candidate URLs for a resource, fastest first. The origin `url` is
+        always included as the last candidate if not already listed.
+        @param artifact: artifact type (`initramfs`, `squashfs` or `metadata`)
+        @param url: URL of the resource on the origin server
+        @return: list of URLs to try in order
+        """
+        if not self.mirrors.get(artifact):
+            return [url]
+        urls = [get_mirror_url(url, mirror)
+                for mirror in self.get_ranking(artifact, url)]
+        if url not in urls:
+            urls.append(url)
+        return urls
+
+    def get_ranking(self, artifact: str, url: str) -> List[str]:
+        """
+        Get the cached ranking of mirrors for an artifact type, probing mirrors
+        if there is no valid cached ranking.
+        @param artifact: artifact type to rank mirrors for
+        @param url: URL of a resource on the origin server to probe with
+        @return: list of mirror base URLs, fastest first
+        """
+        with self._lock:
+            cached = self._rankings.get(artifact)
+            if cached and time() - cached[0] < self.cache_ttl:
+                return list(cached[1])
+        ranking = self.rank(self.mirrors.get(artifact) or [], url)
+        LOG.info(f"Ranked {artifact} mirrors: {ranking}")
+        with self._lock:
+            self._rankings[artifact] = (time(), ranking)
+        return list(ranking)
+
+    def rank(self, mirrors: List[str], url: str) -> List[str]:
+        """
+        Probe mirrors in parallel and sort them by response time. Mirrors that
+        fail the probe are kept in configured order after responsive mirrors.
+        @param mirrors: list of mirror base URLs to rank
+        @param url: URL of a resource on the origin server to probe with
+        @return: list of mirror base URLs, fastest first
+        """
+        if not mirrors:
+            return []
+        with ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+            scores = list(executor.map(
+                lambda m: self.probe(get_mirror_url(url, m)), mirrors))
+        ranked = sorted(zip(scores, mirrors),
+                        key=lambda s: (s[0] is None, s[0] or 0))
+        return [mirror for _, mirror in ranked]
+
+    def probe(self, url: str) -> Optional[float]:
+        """
+        Measure the time to fetch the first `probe_bytes` of a resource. This
+        accounts for both latency and throughput of the server.
+        @param url: URL to probe
+        @return: seconds elapsed, or None if the request failed
+        """
+        headers = {"Range": f"bytes=0-{self.probe_bytes - 1}"}
+        start = time()
+        try:
+            with requests.get(url, stream=True, headers=headers,
+                              timeout=self.probe_timeout) as resp:
+                if not resp.ok:
+                    LOG.debug(f"Probe failed for {url}: {resp.status_code}")
+                    return None
+                received = 0
+                for chunk in resp.iter_content(8192):
+                    received += len(chunk)
+                    if received >= self.probe_bytes:
+                        break
+        except Exception as e:
+            LOG.debug(f"Probe failed for {url}: {e}")
+            return None
+        return time() - start
+
+    def report_failure(self, artifact: str, url: str):
+        """
+        Move the mirror serving a failed request to the end of the cached
+        ranking for an artifact type.
+        @param artifact: artifact type of the failed request
+        @param url: URL of the failed request
+        """
+        with self._lock:
+            cached = self._rankings.get(artifact)
+            if not cached:
+                return
+            ranking = list(cached[1])
+            for mirror in ranking:
+                if url.startswith(mirror.rstrip('/')):
+                    ranking.remove(mirror)
+                    ranking.append(mirror)
+                    break
+            self._rankings[artifact] = (cached[0], ranking)
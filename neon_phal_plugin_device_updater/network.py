@@ -0,0 +1,148 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock, Thread
+from typing import Any, Awaitable, Callable, Optional
+
+from ovos_utils.log import LOG
+
+
+class AsyncNetwork:
+    def __init__(self, max_workers: int = 8, timeout: float = 10):
+        """
+        Run blocking network calls concurrently from an asyncio event loop with
+        per-call deadlines. The loop runs in a background thread so the sync
+        methods may be called from any messagebus handler.
+        @param max_workers: maximum number of concurrent network calls
+        @param timeout: default deadline in seconds for each call
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[Thread] = None
+        self._lock = Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Get the event loop, starting it on first use
+        """
+        with self._lock:
+            if self._loop is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="device_updater_network")
+                self._loop = asyncio.new_event_loop()
+                self._thread = Thread(target=self._loop.run_forever,
+                                      daemon=True)
+                self._thread.start()
+            return self._loop
+
+    async def call(self, func: Callable, *args,
+                   timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        Run a blocking function in the network thread pool
+        @param func: function to call
+        @param timeout: deadline in seconds (default `self.timeout`)
+        @return: value returned by `func`
+        """
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout or self.timeout)
+
+    async def with_fallback(self, primary: Callable, fallback: Callable,
+                            timeout: Optional[float] = None,
+                            hedge_delay: Optional[float] = None) -> Any:
+        """
+        Return the result of `primary` if it succeeds, else the result of
+        `fallback`. `fallback` is only called once `primary` fails or, if
+        `hedge_delay` is set, once `primary` has not finished within
+        `hedge_delay` seconds. A hedged `fallback` runs concurrently with
+        `primary` so a slow failure does not add the latency of both calls.
+        @param primary: preferred function to call
+        @param fallback: function to use if `primary` fails
+        @param timeout: deadline in seconds for each call
+        @param hedge_delay: seconds to wait for `primary` before also starting
+            `fallback` (default only start `fallback` after `primary` fails)
+        @return: value returned by `primary` or `fallback`
+        """
+        timeout = timeout or self.timeout
+        primary_task = asyncio.ensure_future(self.call(primary,
+                                                       timeout=timeout))
+        fallback_task = None
+        if hedge_delay is not None:
+            await asyncio.wait({primary_task}, timeout=hedge_delay)
+            if not primary_task.done():
+                LOG.debug(f"Starting fallback after {hedge_delay}s")
+                fallback_task = asyncio.ensure_future(
+                    self.call(fallback, timeout=timeout))
+        try:
+            result = await primary_task
+            if fallback_task:
+                fallback_task.cancel()
+            return result
+        except Exception as e:
+            LOG.info(f"Using fallback result: {e!r}")
+        return await (fallback_task or self.call(fallback, timeout=timeout))
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None) -> Any:
+        """
+        Synchronously run a coroutine on the network event loop
+        @param coro: coroutine to run
+        @param timeout: optional overall deadline in seconds
+        @return: value returned by `coro`
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(
+            timeout)
+
+    def run_with_fallback(self, primary: Callable, fallback: Callable,
+                          timeout: Optional[float] = None,
+                          hedge_delay: Optional[float] = None) -> Any:
+        """
+        Synchronous facade for `with_fallback`
+        """
+        return self.run(self.with_fallback(primary, fallback, timeout,
+                                           hedge_delay))
+
+    def shutdown(self):
+        """
+        Stop the event loop and thread pool
+        """
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+            self._loop.close()
+            self._executor.shutdown(wait=False)
+            self._loop = None
@@ -0,0 +1,200 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import cProfile
+import io
+import json
+import pstats
+import tracemalloc
+
+from functools import wraps
+from glob import glob
+from os import makedirs, remove, replace
+from os.path import basename, getsize, join
+from threading import Lock
+from time import time
+from typing import Callable, List, Optional
+
+from ovos_utils.log import LOG
+
+
+class HandlerProfiler:
+    def __init__(self, profile_dir: str, max_profiles: int = 20,
+                 max_bytes: int = 1048576, top_n: int = 25,
+                 trace_memory: bool = True):
+        """
+        Record CPU and memory profiles of messagebus handlers to disk.
+
+        Memory tracing is process-wide: `tracemalloc` records every allocation
+        in every thread from the time it is started, and each profiled call
+        takes two full snapshots of all traced memory. This adds overhead to
+        the whole process, and memory stats of a call include allocations made
+        concurrently by other threads. Disable `trace_memory` to record only
+        CPU profiles.
+
+        Only one call is profiled at a time, since Python 3.12+ allows only one
+        active `cProfile` per process. Handlers called while another call is
+        being profiled, or while another profiler is active, run unprofiled.
+        @param profile_dir: directory to write profiles to
+        @param max_profiles: maximum number of profiles to keep
+        @param max_bytes: maximum total size in bytes of kept profiles. The
+            newest profile is always kept.
+        @param top_n: number of functions and allocation sites to record
+        @param trace_memory: if True, start `tracemalloc` and record memory
+            allocated during each call
+        """
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.max_bytes = max_bytes
+        self.top_n = top_n
+        self.trace_memory = trace_memory
+        self._lock = Lock()
+        self._profile_lock = Lock()
+        makedirs(self.profile_dir, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            LOG.info("Tracing memory allocations for profiling")
+            tracemalloc.start()
+
+    def wrap(self, name: str, handler: Callable) -> Callable:
+        """
+        Wrap a handler so each call is profiled
+        @param name: name to record the profile under (i.e. Message type)
+        @param handler: handler to wrap
+        @return: wrapped handler
+        """
+        @wraps(handler)
+        def profiled(*args, **kwargs):
+            if not self._profile_lock.acquire(blocking=False):
+                LOG.debug(f"Not profiling {name}: another call is profiled")
+                return handler(*args, **kwargs)
+            try:
+                profile = cProfile.Profile()
+                snapshot = tracemalloc.take_snapshot() if \
+                    self.trace_memory and tracemalloc.is_tracing() else None
+                start = time()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    # Another profiler is active
+                    LOG.warning(f"Not profiling {name}: {e}")
+                    return handler(*args, **kwargs)
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    duration = time() - start
+                    try:
+                        memory_stats = tracemalloc.take_snapshot().compare_to(
+                            snapshot, "lineno") if snapshot and \
+                            tracemalloc.is_tracing() else None
+                        self._save(name, start, duration, profile,
+                                   memory_stats)
+                    except Exception as e:
+                        LOG.error(f"Failed to save profile for {name}: {e}")
+            finally:
+                self._profile_lock.release()
+        return profiled
+
+    def _save(self, name: str, start: float, duration: float,
+              profile: cProfile.Profile, memory_stats: Optional[list]):
+        """
+        Write a profile to disk and remove old profiles beyond configured limits
+        @param name: name of the profiled handler
+        @param start: timestamp the handler was called
+        @param duration: wall time in seconds spent in the handler
+        @param profile: completed cProfile for the handler call
+        @param memory_stats: tracemalloc statistics diff for the call, or None
+            if memory was not traced
+        """
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(self.top_n)
+        data = {"handler": name,
+                "time": start,
+                "duration": duration,
+                "cpu_time": stats.total_tt,
+                "cpu_stats": stream.getvalue(),
+                "memory_allocated": None,
+                "memory_stats": None}
+        if memory_stats is not None:
+            data["memory_allocated"] = sum(s.size_diff for s in memory_stats)
+            data["memory_stats"] = [str(s) for s in
+                                    memory_stats[:self.top_n]]
+        file_name = f"{start:.6f}_{name}.json"
+        temp_path = join(self.profile_dir, f".{file_name}.tmp")
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        replace(temp_path, join(self.profile_dir, file_name))
+        LOG.debug(f"Profiled {name} in {duration}s")
+        self._prune()
+
+    def _get_profile_files(self) -> List[str]:
+        """
+        Get saved profile files, oldest first
+        """
+        return sorted(glob(join(self.profile_dir, "*.json")),
+                      key=lambda p: float(basename(p).split('_', 1)[0]))
+
+    def _prune(self):
+        """
+        Remove the oldest profiles until within `max_profiles` and `max_bytes`.
+        The newest profile is kept even if it alone exceeds `max_bytes`.
+        """
+        with self._lock:
+            files = self._get_profile_files()
+            total_bytes = sum(getsize(f) for f in files)
+            while len(files) > 1 and (len(files) > self.max_profiles or
+                                      total_bytes > self.max_bytes):
+                oldest = files.pop(0)
+                total_bytes -= getsize(oldest)
+                remove(oldest)
+
+    def get_profiles(self, handler: Optional[str] = None,
+                     limit: Optional[int] = None) -> List[dict]:
+        """
+        Get saved profiles, newest first
+        @param handler: optional handler name to filter profiles by
+        @param limit: optional maximum number of profiles to return
+        @return: list of saved profile dicts
+        """
+        profiles = list()
+        with self._lock:
+            files = self._get_profile_files()
+        for file in reversed(files):
+            if limit is not None and len(profiles) >= limit:
+                break
+            if handler and \
+                    basename(file).split('_', 1)[1] != f"{handler}.json":
+                continue
+            try:
+                with open(file) as f:
+                    profiles.append(json.load(f))
+            except FileNotFoundError:
+                # Removed by a concurrent prune
+                continue
+        return profiles
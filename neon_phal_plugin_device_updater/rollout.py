@@ -0,0 +1,141 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+
+from datetime import date, datetime, timezone
+from time import time
+from typing import Optional, Union
+
+from ovos_utils.log import LOG
+
+
+def get_rollout_bucket(device_id: str) -> float:
+    """
+    Get a stable rollout bucket for a device
+    @param device_id: unique identifier of the device
+    @return: float bucket in the range [0, 100)
+    """
+    digest = hashlib.sha256(device_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 * 100
+
+
+def _parse_time(value: Union[str, int, float, date]) -> float:
+    """
+    Parse a schedule time as a UTC timestamp. Times without a timezone are
+    treated as UTC.
+    @param value: ISO 8601 date or time (i.e. `2024-07-01T00:00:00Z`),
+        timestamp, `date` or `datetime`
+    @return: float timestamp
+    """
+    if isinstance(value, bool):
+        raise TypeError(f"Invalid time: {value}")
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.endswith(("Z", "z")):
+            value = f"{value[:-1]}+00:00"
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=value.tzinfo or timezone.utc).timestamp()
+    if isinstance(value, date):
+        # YAML parses unquoted dates as `date`
+        return datetime(value.year, value.month, value.day,
+                        tzinfo=timezone.utc).timestamp()
+    raise TypeError(f"Invalid time: {value}")
+
+
+def _parse_percentage(value: Union[str, int, float]) -> float:
+    """
+    Parse a rollout percentage
+    @param value: percentage as a number or numeric string
+    @return: float percentage
+    """
+    if isinstance(value, bool):
+        raise TypeError(f"Invalid percentage: {value}")
+    percentage = float(value)
+    if percentage != percentage:
+        raise ValueError(f"Invalid percentage: {value}")
+    return percentage
+
+
+def get_rollout_percentage(rollout: Optional[dict],
+                           now: Optional[float] = None) -> float:
+    """
+    Get the percentage of devices admitted by a rollout spec at a given time.
+    A spec may define a static `percentage` or a `schedule` of steps, each with
+    a `time` and `percentage`; `halted: true` stops the rollout. An invalid
+    spec admits no devices so a malformed release is not offered to everyone.
+    @param rollout: rollout spec from release metadata or configuration
+    @param now: timestamp to evaluate the schedule at (default now)
+    @return: float percentage of devices admitted
+    """
+    if not rollout:
+        return 100.0
+    try:
+        if rollout.get("halted"):
+            return 0.0
+        schedule = rollout.get("schedule")
+        if schedule:
+            now = time() if now is None else now
+            steps = sorted((_parse_time(step["time"]),
+                            _parse_percentage(step["percentage"]))
+                           for step in schedule)
+            percentage = 0.0
+            for step_time, step_percentage in steps:
+                if step_time > now:
+                    break
+                percentage = step_percentage
+            return percentage
+        return _parse_percentage(rollout.get("percentage", 100))
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        LOG.error(f"Invalid rollout spec {rollout}: {e!r}")
+        return 0.0
+
+
+def is_admitted(device_id: Optional[str], rollout: Optional[dict],
+                now: Optional[float] = None) -> bool:
+    """
+    Check if a device is admitted to a staged rollout
+    @param device_id: unique identifier of the device
+    @param rollout: rollout spec from release metadata or configuration
+    @param now: timestamp to evaluate the schedule at (default now)
+    @return: True if the device's bucket is admitted
+    """
+    percentage = get_rollout_percentage(rollout, now)
+    if percentage >= 100:
+        return True
+    if percentage <= 0:
+        return False
+    if not device_id:
+        LOG.warning("No device ID; ignoring staged rollout")
+        return True
+    bucket = get_rollout_bucket(device_id)
+    LOG.debug(f"Rollout bucket={bucket} percentage={percentage}")
+    return bucket < percentage
@@ -0,0 +1,726 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import argparse
+import json
+import sys
+
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from math import ceil
+from os import makedirs, remove
+from os.path import isfile, join
+from queue import PriorityQueue
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+from ovos_bus_client.message import Message
+from ovos_utils.log import LOG
+from ovos_utils.messagebus import FakeBus
+
+from neon_phal_plugin_device_updater import DeviceUpdater
+from neon_phal_plugin_device_updater.log_utils import log_to_stderr
+from neon_phal_plugin_device_updater.network import AsyncNetwork
+
+RELEASE_REPO = "NeonGeckoCom/neon-os"
+OS_NAME = "debian-neon-image-rpi4"
+PLATFORM = "rpi4"
+INSTALLED_VERSION = "24.01.01"
+INSTALLED_TIME = "2024-01-01_00_00"
+RELEASE_VERSION = "24.07.01"
+RELEASE_TIME = "2024-07-01_00_00"
+
+_CHUNK = bytes(65536)
+
+
+def get_percentile(values: List[float], percentile: float) -> Optional[float]:
+    """
+    Get a percentile of a list of values using the nearest-rank method
+    @param values: list of values
+    @param percentile: percentile to get (0-100)
+    @return: value at the requested percentile, or None if `values` is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(ceil(percentile / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    server: "_StubHTTPServer"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        if stub.latency:
+            sleep(stub.latency)
+        path = self.path.split("?", 1)[0]
+        api_prefix = f"/api/repos/{RELEASE_REPO}/releases"
+        if path.startswith(api_prefix):
+            self._send_api(path[len(api_prefix):])
+        elif path.startswith(f"/raw/{RELEASE_REPO}/"):
+            self._send_metadata(path)
+        elif path.startswith("/legacy/") and path.endswith("/"):
+            self._send_legacy_index()
+        elif path.startswith("/legacy/") and path.endswith(".json"):
+            self._send_data("legacy_metadata",
+                            json.dumps(stub.release_meta).encode(),
+                            "application/json")
+        elif path.endswith(".squashfs"):
+            self._send_download()
+        else:
+            self._send_data("other", b"Not Found", status=404)
+
+    def _send_data(self, endpoint: str, data: bytes,
+                   content_type: str = "text/plain", status: int = 200,
+                   headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.stub.record(endpoint, status, len(data))
+
+    def _send_api(self, path: str):
+        stub = self.server.stub
+        if stub.api_latency:
+            sleep(stub.api_latency)
+        if stub.is_api_failure():
+            self._send_data("api", b'{"message": "Server Error"}',
+                            "application/json", status=502)
+            return
+        release = {"tag_name": RELEASE_VERSION,
+                   "created_at": "2024-07-01T00:00:00Z",
+                   "body": f"{OS_NAME} {RELEASE_TIME}"}
+        if path == "/latest":
+            data = release
+        elif path in ("", "/"):
+            data = [release]
+        else:
+            self._send_data("api", b"Not Found", status=404)
+            return
+        etag = f'"{RELEASE_VERSION}{path}"'
+        # Conditional requests count against the quota, as they do for
+        # unauthenticated clients
+        allowed, headers = stub.use_api_quota(
+            self.headers.get("Authorization") or "anonymous")
+        if not allowed:
+            self._send_data("api", b'{"message": "API rate limit exceeded"}',
+                            "application/json", status=403, headers=headers)
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            stub.record("api", 304, 0)
+            return
+        self._send_data("api", json.dumps(data).encode(), "application/json",
+                        headers={"ETag": etag, **headers})
+
+    def _send_metadata(self, path: str):
+        if path != f"/raw/{RELEASE_REPO}/{RELEASE_VERSION}/{OS_NAME}.yaml":
+            self._send_data("metadata", b"Not Found", status=404)
+            return
+        self._send_data("metadata",
+                        yaml.safe_dump([self.server.stub.release_meta]).encode())
+
+    def _send_legacy_index(self):
+        etag = '"legacy-index"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            self.server.stub.record("legacy_index", 304, 0)
+            return
+        name = f"{OS_NAME}_{RELEASE_TIME}"
+        page = (f'<html><body><a href="../">../</a>'
+                f'<a href="{name}.json">{name}.json</a>'
+                f'<a href="{name}.squashfs">{name}.squashfs</a>'
+                f'</body></html>')
+        self._send_data("legacy_index", page.encode(), "text/html",
+                        headers={"ETag": etag})
+
+    def _send_download(self):
+        stub = self.server.stub
+        size = stub.download_size
+        start, end = 0, size - 1
+        status = 200
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), end) if last else end
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                stub.record("download", 416, 0)
+                return
+            status = 206
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        sent = 0
+        stub.download_started()
+        try:
+            while sent < length:
+                chunk = min(len(_CHUNK), length - sent)
+                self.wfile.write(_CHUNK[:chunk])
+                sent += chunk
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stub.download_finished()
+            stub.record("download", status, sent)
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, stub: "StubServer"):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), _StubHandler)
+        self.stub = stub
+
+
+class StubServer:
+    def __init__(self, download_size: int = 1048576,
+                 rollout: Optional[dict] = None, latency: float = 0.0,
+                 api_quota: Optional[int] = None,
+                 api_quota_window: float = 3600, api_error_rate: float = 0.0,
+                 api_latency: float = 0.0, seed: int = 0):
+        """
+        Local HTTP server modeling the GitHub API, raw release metadata, the
+        legacy update directory and the update download host. Requests are
+        counted per endpoint. Like GitHub, the API quota applies separately to
+        each client (`Authorization` header) and is reported in
+        `X-RateLimit-*` headers; requests over the quota are rejected with 403.
+        @param download_size: size in bytes of the served update file
+        @param rollout: optional `rollout` spec included in release metadata
+        @param latency: seconds to delay each request
+        @param api_quota: optional API requests allowed per client per window
+        @param api_quota_window: seconds until a client's API quota resets
+        @param api_error_rate: fraction of API requests that fail with 502
+        @param api_latency: additional seconds to delay each API request
+        @param seed: random seed for API failures
+        """
+        self.download_size = download_size
+        self.rollout = rollout
+        self.latency = latency
+        self.api_quota = api_quota
+        self.api_quota_window = api_quota_window
+        self.api_error_rate = api_error_rate
+        self.api_latency = api_latency
+        self._random = Random(seed)
+        self._api_clients: Dict[str, Tuple[int, float]] = dict()
+        self._server: Optional[_StubHTTPServer] = None
+        self._thread: Optional[Thread] = None
+        self._lock = Lock()
+        self.endpoints: Dict[str, dict] = dict()
+        self.bytes_served = 0
+        self.active_downloads = 0
+        self.peak_downloads = 0
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL of the running server
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def release_meta(self) -> dict:
+        """
+        Release metadata served for the latest release
+        """
+        meta = {"version": RELEASE_VERSION,
+                "build_version": f"{OS_NAME}_{RELEASE_TIME}",
+                "base_os": {"name": OS_NAME, "time": RELEASE_TIME,
+                            "platform": PLATFORM},
+                "image": {"version": RELEASE_VERSION},
+                "download_url": f"{self.url}/download/{PLATFORM}/"
+                                f"{OS_NAME}_{RELEASE_TIME}.img.xz"}
+        if self.rollout is not None:
+            meta["rollout"] = self.rollout
+        return meta
+
+    def start(self) -> "StubServer":
+        """
+        Start serving in a background thread
+        """
+        self._server = _StubHTTPServer(self)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the server
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def record(self, endpoint: str, status: int, size: int):
+        """
+        Record a served request
+        @param endpoint: name of the requested endpoint
+        @param status: HTTP status code of the response
+        @param size: number of body bytes sent
+        """
+        with self._lock:
+            stats = self.endpoints.setdefault(
+                endpoint, {"requests": 0, "bytes": 0, "status": dict()})
+            stats["requests"] += 1
+            stats["bytes"] += size
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+            self.bytes_served += size
+
+    def is_api_failure(self) -> bool:
+        """
+        Decide if an API request should fail
+        @return: True if the request should be answered with a server error
+        """
+        if not self.api_error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.api_error_rate
+
+    def use_api_quota(self, client: str) -> Tuple[bool, dict]:
+        """
+        Check and use a client's API quota
+        @param client: identifier of the requesting client
+        @return: True if the request is allowed, and rate limit headers
+        """
+        if self.api_quota is None:
+            return True, dict()
+        with self._lock:
+            now = time()
+            used, reset = self._api_clients.get(
+                client, (0, now + self.api_quota_window))
+            if now >= reset:
+                used, reset = 0, now + self.api_quota_window
+            allowed = used < self.api_quota
+            if allowed:
+                used += 1
+            self._api_clients[client] = (used, reset)
+        return allowed, {"X-RateLimit-Limit": str(self.api_quota),
+                         "X-RateLimit-Remaining": str(self.api_quota - used),
+                         "X-RateLimit-Reset": str(ceil(reset))}
+
+    def download_started(self):
+        with self._lock:
+            self.active_downloads += 1
+            self.peak_downloads = max(self.peak_downloads,
+                                      self.active_downloads)
+
+    def download_finished(self):
+        with self._lock:
+            self.active_downloads -= 1
+
+
+class FleetSimulation:
+    def __init__(self, devices: int = 100, poll_interval: float = 10,
+                 duration: float = 30, track: str = "stable",
+                 rollout_percentage: Optional[float] = None,
+                 legacy_index_ttl: float = 60, download: bool = False,
+                 download_size: int = 1048576, stagger: bool = True,
+                 workers: int = 32, latency: float = 0.0, seed: int = 0,
+                 api_quota: Optional[int] = None,
+                 api_quota_window: float = 3600, quota_reserve: int = 10,
+                 api_error_rate: float = 0.0, api_latency: float = 0.0,
+                 hedge_delay: float = 2):
+        """
+        Simulate a fleet of devices polling for updates against a local stub
+        server. Each device is a `DeviceUpdater` with its own `FakeBus`,
+        build info, device ID, state directory and GitHub API client.
+        @param devices: number of simulated devices
+        @param poll_interval: seconds between update checks on each device
+        @param duration: seconds to run the simulation
+        @param track: update track to check
+        @param rollout_percentage: optional rollout percentage of the release
+        @param legacy_index_ttl: seconds each device caches the legacy index
+        @param download: if True, devices download available updates
+        @param download_size: size in bytes of the update file
+        @param stagger: if True, spread first checks over `poll_interval`,
+            else all devices check at once
+        @param workers: number of concurrent device operations
+        @param latency: seconds the stub server delays each request
+        @param seed: random seed for staggered start times and API failures
+        @param api_quota: optional GitHub API requests allowed per device per
+            `api_quota_window`
+        @param api_quota_window: seconds until a device's API quota resets
+        @param quota_reserve: API requests each device keeps in reserve for
+            urgent requests (`github_quota_reserve`)
+        @param api_error_rate: fraction of API requests that fail with 502
+        @param api_latency: additional seconds the stub server delays each
+            API request
+        @param hedge_delay: seconds before a slow GitHub check also starts the
+            legacy check (`check_hedge_delay`)
+        """
+        self.devices = devices
+        self.poll_interval = poll_interval
+        self.duration = duration
+        self.track = track
+        self.rollout_percentage = rollout_percentage
+        self.legacy_index_ttl = legacy_index_ttl
+        self.download = download
+        self.download_size = download_size
+        self.stagger = stagger
+        self.workers = workers
+        self.latency = latency
+        self.seed = seed
+        self.api_quota = api_quota
+        self.api_quota_window = api_quota_window
+        self.quota_reserve = quota_reserve
+        self.api_error_rate = api_error_rate
+        self.api_latency = api_latency
+        self.hedge_delay = hedge_delay
+        self._lock = Lock()
+        self._latencies: List[float] = list()
+        self._results: Dict[str, int] = dict()
+
+    @property
+    def config(self) -> dict:
+        """
+        Simulation parameters included in the report
+        """
+        return {"devices": self.devices,
+                "poll_interval": self.poll_interval,
+                "duration": self.duration,
+                "track": self.track,
+                "rollout_percentage": self.rollout_percentage,
+                "legacy_index_ttl": self.legacy_index_ttl,
+                "download": self.download,
+                "stagger": self.stagger,
+                "api_quota": self.api_quota,
+                "api_quota_window": self.api_quota_window,
+                "quota_reserve": self.quota_reserve,
+                "api_error_rate": self.api_error_rate,
+                "api_latency": self.api_latency,
+                "hedge_delay": self.hedge_delay}
+
+    def _get_device(self, index: int, server: StubServer,
+                    network: AsyncNetwork, work_dir: str) -> DeviceUpdater:
+        """
+        Create a simulated device
+        @param index: index of the device in the fleet
+        @param server: running stub server
+        @param network: network engine shared by all devices
+        @param work_dir: directory for device files
+        @return: initialized plugin
+        """
+        device_dir = join(work_dir, f"device-{index}")
+        makedirs(device_dir)
+        config = {"release_repo": RELEASE_REPO,
+                  "github_api_url": f"{server.url}/api",
+                  "github_raw_url": f"{server.url}/raw",
+                  "squashfs_url": f"{server.url}/legacy/{{}}/",
+                  "initramfs_upadate_path": join(device_dir, "initramfs"),
+                  "squashfs_path": join(device_dir, "update.squashfs"),
+                  "device_id": f"device-{index}",
+                  "default_track": self.track,
+                  "legacy_index_ttl": self.legacy_index_ttl,
+                  # Identifies the device to the stub API's per-client quota
+                  "github_token": f"device-{index}",
+                  "github_quota_reserve": self.quota_reserve,
+                  "check_hedge_delay": self.hedge_delay}
+        plugin = DeviceUpdater(FakeBus(), config=config)
+        plugin._build_info = {"base_os": {"name": OS_NAME,
+                                          "time": INSTALLED_TIME,
+                                          "platform": PLATFORM},
+                              "version": INSTALLED_VERSION,
+                              "device": f"device-{index}"}
+        plugin._network = network
+        plugin.min_update_size = self.download_size
+        return plugin
+
+    def _count(self, result: str):
+        with self._lock:
+            self._results[result] = self._results.get(result, 0) + 1
+
+    def _poll(self, plugin: DeviceUpdater):
+        """
+        Check for an update and optionally download it on one device
+        @param plugin: device to check
+        """
+        start = monotonic()
+        resp = plugin.bus.wait_for_response(
+            Message("neon.check_update_squashfs", {"track": self.track}),
+            timeout=plugin.check_timeout + plugin.request_timeout)
+        with self._lock:
+            self._latencies.append(monotonic() - start)
+        if not resp or resp.data.get("error"):
+            self._count("check_errors")
+            return
+        self._count("checks")
+        if resp.data.get("rollout_deferred"):
+            self._count("rollout_deferred")
+        if not resp.data.get("update_available"):
+            return
+        self._count("updates_available")
+        if not self.download:
+            return
+        update_meta = resp.data["update_metadata"]
+        resp = plugin.bus.wait_for_response(
+            Message("neon.update_squashfs", {"track": self.track,
+                                             "update_metadata": update_meta}),
+            timeout=3600)
+        new_version = resp.data.get("new_version") if resp else None
+        if not new_version:
+            self._count("download_errors")
+            return
+        self._count("downloads")
+        # Device restarts into the new version; remove files to save space
+        plugin._build_info = {**plugin.build_info,
+                              "base_os": update_meta.get("base_os") or
+                              {"name": OS_NAME, "time": RELEASE_TIME,
+                               "platform": PLATFORM},
+                              "version": update_meta.get("version")}
+        plugin._remove_download(new_version)
+        if isfile(plugin.squashfs_path):
+            remove(plugin.squashfs_path)
+
+    def _run_worker(self, queue: PriorityQueue, fleet: List[DeviceUpdater],
+                    end_time: float):
+        """
+        Run scheduled device checks until the simulation ends
+        @param queue: queue of (due time, device index)
+        @param fleet: list of simulated devices
+        @param end_time: monotonic time to stop scheduling checks
+        """
+        while True:
+            due, index = queue.get()
+            if due >= end_time:
+                # All remaining checks are after the end of the simulation
+                queue.put((due, index))
+                return
+            sleep(max(due - monotonic(), 0))
+            try:
+                self._poll(fleet[index])
+            except Exception as e:
+                LOG.exception(e)
+                self._count("check_errors")
+            queue.put((max(due + self.poll_interval, monotonic()), index))
+
+    def run(self) -> dict:
+        """
+        Run the simulation
+        @return: dict report of requests served and check latency
+        """
+        rollout = None if self.rollout_percentage is None else \
+            {"percentage": self.rollout_percentage}
+        server = StubServer(self.download_size, rollout, self.latency,
+                            api_quota=self.api_quota,
+                            api_quota_window=self.api_quota_window,
+                            api_error_rate=self.api_error_rate,
+                            api_latency=self.api_latency,
+                            seed=self.seed).start()
+        network = AsyncNetwork(max_workers=2 * self.workers)
+        work_dir = mkdtemp()
+        fleet = list()
+        try:
+            fleet = [self._get_device(i, server, network, work_dir)
+                     for i in range(self.devices)]
+            rng = Random(self.seed)
+            start = monotonic()
+            queue = PriorityQueue()
+            for index in range(self.devices):
+                offset = rng.uniform(0, self.poll_interval) if \
+                    self.stagger else 0
+                queue.put((start + offset, index))
+            threads = [Thread(target=self._run_worker,
+                              args=(queue, fleet, start + self.duration),
+                              daemon=True)
+                       for _ in range(min(self.workers, self.devices))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = monotonic() - start
+        finally:
+            for plugin in fleet:
+                plugin.shutdown()
+            network.shutdown()
+            server.stop()
+            rmtree(work_dir, ignore_errors=True)
+        latency = {f"p{p}": get_percentile(self._latencies, p)
+                   for p in (50, 90, 99)}
+        latency["max"] = max(self._latencies) if self._latencies else None
+        return {"config": self.config,
+                "elapsed": round(elapsed, 3),
+                **{key: self._results.get(key, 0) for key in
+                   ("checks", "check_errors", "updates_available",
+                    "rollout_deferred", "downloads", "download_errors")},
+                "check_latency": latency,
+                "endpoints": server.endpoints,
+                "bytes_served": server.bytes_served,
+                "peak_concurrent_downloads": server.peak_downloads}
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Get the argument parser for the simulation
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m neon_phal_plugin_device_updater.simulation",
+        description="Simulate update load from a fleet of devices. Every "
+                    "combination of polling, caching and rollout values is "
+                    "run as a separate scenario.")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds to run each scenario")
+    parser.add_argument("--poll-interval", type=float, nargs="+",
+                        default=[10], help="seconds between device checks")
+    parser.add_argument("--legacy-index-ttl", type=float, nargs="+",
+                        default=[60],
+                        help="seconds devices cache the legacy index")
+    parser.add_argument("--rollout", type=float, nargs="+", default=[None],
+                        help="rollout percentage of the release")
+    parser.add_argument("--track", default="stable")
+    parser.add_argument("--download", action="store_true",
+                        help="download available updates")
+    parser.add_argument("--download-size", type=int, default=1048576,
+                        help="size in bytes of the update file")
+    parser.add_argument("--no-stagger", action="store_true",
+                        help="start all devices at the same time")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="number of concurrent device operations")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the server delays each request")
+    parser.add_argument("--api-quota", type=int, default=None,
+                        help="GitHub API requests allowed per device per "
+                             "quota window (default unlimited)")
+    parser.add_argument("--api-quota-window", type=float, default=3600,
+                        help="seconds until a device's API quota resets")
+    parser.add_argument("--quota-reserve", type=int, default=10,
+                        help="API requests each device reserves for urgent "
+                             "requests")
+    parser.add_argument("--api-error-rate", type=float, nargs="+",
+                        default=[0.0],
+                        help="fraction of API requests that fail")
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="additional seconds the server delays each API "
+                             "request")
+    parser.add_argument("--hedge-delay", type=float, default=2,
+                        help="seconds before a slow GitHub check also starts "
+                             "the legacy check")
+    parser.add_argument("--json", action="store_true",
+                        help="print reports as JSON")
+    return parser
+
+
+def _print_summary(report: dict, stream=None):
+    """
+    Print a short summary of a simulation report
+    @param report: report returned by `FleetSimulation.run`
+    @param stream: file to print to (default stdout)
+    """
+    stream = stream or sys.stdout
+    config = report["config"]
+    latency = report["check_latency"]
+    requests = ", ".join(f"{name}={stats['requests']}" for name, stats in
+                         sorted(report["endpoints"].items()))
+    print(f"poll_interval={config['poll_interval']} "
+          f"legacy_index_ttl={config['legacy_index_ttl']} "
+          f"rollout={config['rollout_percentage']} "
+          f"api_error_rate={config['api_error_rate']}", file=stream)
+    print(f"  checks={report['checks']} errors={report['check_errors']} "
+          f"available={report['updates_available']} "
+          f"deferred={report['rollout_deferred']} "
+          f"downloads={report['downloads']}", file=stream)
+    print(f"  requests: {requests}", file=stream)
+    if "api" in report["endpoints"]:
+        print(f"  api_status: {report['endpoints']['api']['status']}",
+              file=stream)
+    print(f"  bytes_served={report['bytes_served']} "
+          f"peak_concurrent_downloads={report['peak_concurrent_downloads']}",
+          file=stream)
+    print("  check_latency: " +
+          " ".join(f"{key}={value:.3f}s" for key, value in latency.items()
+                   if value is not None), file=stream)
+
+
+def main(argv: Optional[list] = None) -> int:
+    """
+    Run simulation scenarios
+    @param argv: optional list of arguments (default `sys.argv`)
+    @return: exit code
+    """
+    args = get_parser().parse_args(argv)
+    LOG.set_level("ERROR")
+    stdout = sys.stdout
+    log_to_stderr()
+    reports = list()
+    for poll_interval, ttl, rollout, api_error_rate in product(
+            args.poll_interval, args.legacy_index_ttl, args.rollout,
+            args.api_error_rate):
+        # Loggers created while running will log to stderr
+        with redirect_stdout(sys.stderr):
+            report = FleetSimulation(
+                devices=args.devices, poll_interval=poll_interval,
+                duration=args.duration, track=args.track,
+                rollout_percentage=rollout, legacy_index_ttl=ttl,
+                download=args.download, download_size=args.download_size,
+                stagger=not args.no_stagger, workers=args.workers,
+                latency=args.latency, api_quota=args.api_quota,
+                api_quota_window=args.api_quota_window,
+                quota_reserve=args.quota_reserve,
+                api_error_rate=api_error_rate, api_latency=args.api_latency,
+                hedge_delay=args.hedge_delay).run()
+        reports.append(report)
+        if not args.json:
+            _print_summary(report, stdout)
+    if args.json:
+        print(json.dumps(reports, indent=2), file=stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
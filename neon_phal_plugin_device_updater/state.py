@@ -0,0 +1,169 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+
+from enum import Enum
+from os import fsync, replace
+from os.path import dirname, getmtime, getsize, isdir, isfile
+from threading import Lock
+from time import time
+from typing import Optional
+
+from ovos_utils.log import LOG
+
+
+class UpdateState(str, Enum):
+    CHECKED = "checked"
+    DOWNLOADING = "downloading"
+    VERIFIED = "verified"
+    STAGED = "staged"
+    APPLIED = "applied"
+
+
+def get_file_stat(path: str) -> Optional[dict]:
+    """
+    Get the size and modification time of a file, used to detect changes to
+    a file since it was verified or staged.
+    @param path: path to file
+    @return: dict `size` and `mtime` if the file exists, else None
+    """
+    if not isfile(path):
+        return None
+    return {"size": getsize(path), "mtime": getmtime(path)}
+
+
+class UpdateJournal:
+    max_history = 20
+
+    def __init__(self, path: str):
+        """
+        Persist the state of each update artifact so interrupted updates can
+        resume after a restart. Every change is written atomically.
+        @param path: path to the journal file
+        """
+        self.path = path
+        self._lock = Lock()
+        self._data = {"artifacts": dict(), "history": list()}
+        self._load()
+
+    def _load(self):
+        """
+        Load the journal from disk
+        """
+        if not isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self._data["artifacts"] = data.get("artifacts") or dict()
+            self._data["history"] = data.get("history") or list()
+        except Exception as e:
+            LOG.error(f"Ignoring invalid update journal {self.path}: {e}")
+
+    def _save(self):
+        """
+        Atomically write the journal to disk. This must be called while
+        holding `_lock`.
+        """
+        if not isdir(dirname(self.path) or "."):
+            LOG.warning(f"Not saving update journal; "
+                        f"{dirname(self.path)} does not exist")
+            return
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self._data, f)
+                f.flush()
+                fsync(f.fileno())
+            replace(temp_path, self.path)
+        except Exception as e:
+            LOG.error(f"Failed to save update journal: {e}")
+
+    def get(self, artifact: str) -> dict:
+        """
+        Get the current state of an artifact
+        @param artifact: artifact type (`squashfs` or `initramfs`)
+        @return: dict state data (empty if no state is recorded)
+        """
+        with self._lock:
+            return dict(self._data["artifacts"].get(artifact) or dict())
+
+    def get_state(self, artifact: str) -> Optional[UpdateState]:
+        """
+        Get the current state of an artifact
+        @param artifact: artifact type (`squashfs` or `initramfs`)
+        @return: UpdateState if recorded, else None
+        """
+        state = self.get(artifact).get("state")
+        return UpdateState(state) if state else None
+
+    def transition(self, artifact: str, state: UpdateState, **data):
+        """
+        Record a new state for an artifact. If `version` is not specified, the
+        previous version is kept.
+        @param artifact: artifact type (`squashfs` or `initramfs`)
+        @param state: new state
+        @param data: state data to record (i.e. `version`, `download_path`)
+        """
+        with self._lock:
+            entry = dict(self._data["artifacts"].get(artifact) or dict())
+            if data.get("version") and \
+                    data["version"] != entry.get("version"):
+                # New version; don't carry over data from the old version
+                entry = dict()
+            entry.update(data)
+            entry["state"] = UpdateState(state).value
+            entry["time"] = time()
+            self._data["artifacts"][artifact] = entry
+            self._data["history"].append({"artifact": artifact,
+                                          "state": entry["state"],
+                                          "version": entry.get("version"),
+                                          "time": entry["time"]})
+            self._data["history"] = \
+                self._data["history"][-self.max_history:]
+            self._save()
+        LOG.debug(f"{artifact} state={entry['state']}|"
+                  f"version={entry.get('version')}")
+
+    def clear(self, artifact: str):
+        """
+        Remove the recorded state of an artifact
+        @param artifact: artifact type (`squashfs` or `initramfs`)
+        """
+        with self._lock:
+            if self._data["artifacts"].pop(artifact, None) is not None:
+                self._save()
+
+    @property
+    def history(self) -> list:
+        """
+        Get recent state transitions, oldest first
+        """
+        with self._lock:
+            return list(self._data["history"])
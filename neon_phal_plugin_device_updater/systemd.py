@@ -0,0 +1,166 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+from subprocess import run
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+from ovos_utils.log import LOG
+
+_PROPERTIES = ("ActiveState", "SubState", "Result", "ExecMainStatus",
+               "ActiveEnterTimestampMonotonic",
+               "InactiveEnterTimestampMonotonic")
+_TRANSIENT_STATES = ("activating", "deactivating", "reloading")
+
+
+class UnitTimeoutError(TimeoutError):
+    def __init__(self, message: str, initial: dict, properties: dict):
+        """
+        Raised when a unit job has not finished within a deadline. The job may
+        still be running and can be waited on again with `initial`.
+        @param message: error message
+        @param initial: unit properties returned by `start`
+        @param properties: unit properties at the deadline
+        """
+        TimeoutError.__init__(self, message)
+        self.initial = initial
+        self.properties = properties
+
+
+class SystemdUnit:
+    def __init__(self, name: str, systemctl: str = "systemctl",
+                 poll_interval: float = 0.5):
+        """
+        Start a systemd unit without blocking on its job and track the job to
+        completion by polling the unit state.
+        @param name: name of the unit to start
+        @param systemctl: path to the `systemctl` executable
+        @param poll_interval: seconds between unit state checks
+        """
+        self.name = name
+        self.systemctl = systemctl
+        self.poll_interval = poll_interval
+
+    def get_properties(self) -> dict:
+        """
+        Get the current state of the unit
+        @return: dict of unit properties
+        """
+        proc = run([self.systemctl, "show", self.name,
+                    f"--property={','.join(_PROPERTIES)}"],
+                   capture_output=True, text=True, timeout=10)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Failed to get {self.name} state: "
+                               f"{proc.stderr.strip()}")
+        properties = dict()
+        for line in proc.stdout.splitlines():
+            key, _, value = line.partition("=")
+            properties[key] = value
+        return properties
+
+    def start(self) -> dict:
+        """
+        Queue a start job for the unit and return immediately
+        @return: unit properties from before the job was queued
+        """
+        properties = self.get_properties()
+        proc = run([self.systemctl, "start", "--no-block", self.name],
+                   capture_output=True, text=True, timeout=10)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Failed to start {self.name}: "
+                               f"{proc.stderr.strip()}")
+        return properties
+
+    @staticmethod
+    def is_finished(initial: dict, properties: dict) -> bool:
+        """
+        Check if a start job has finished
+        @param initial: unit properties from before the job was queued
+        @param properties: current unit properties
+        @return: True if the unit has settled since the job was queued
+        """
+        if properties.get("ActiveState") in _TRANSIENT_STATES:
+            return False
+        if initial.get("ActiveState") == "active":
+            # Starting an active unit is a no-op
+            return True
+        return any(properties.get(key) != initial.get(key) for key in
+                   ("ActiveEnterTimestampMonotonic",
+                    "InactiveEnterTimestampMonotonic"))
+
+    @staticmethod
+    def is_success(properties: dict) -> bool:
+        """
+        Check if a finished job succeeded
+        @param properties: unit properties after the job finished
+        @return: True if the unit completed successfully
+        """
+        return properties.get("ActiveState") != "failed" and \
+            properties.get("Result") == "success"
+
+    def wait(self, initial: dict, timeout: Optional[float],
+             callback: Optional[Callable[[dict], None]] = None) -> dict:
+        """
+        Poll the unit until a queued start job finishes
+        @param initial: unit properties returned by `start`
+        @param timeout: maximum seconds to wait for the job, or None to wait
+            until it finishes
+        @param callback: optional function called when the unit state changes
+        @return: unit properties after the job finished
+        @raises UnitTimeoutError: if the job did not finish within `timeout`
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        last_state = None
+        while True:
+            properties = self.get_properties()
+            state = (properties.get("ActiveState"), properties.get("SubState"))
+            if state != last_state:
+                LOG.debug(f"{self.name} state={state}")
+                last_state = state
+                if callback:
+                    callback(properties)
+            if self.is_finished(initial, properties):
+                return properties
+            if deadline is not None and monotonic() > deadline:
+                raise UnitTimeoutError(f"{self.name} did not finish within "
+                                       f"{timeout}s (state={state})",
+                                       initial, properties)
+            sleep(self.poll_interval)
+
+    def run(self, timeout: float,
+            callback: Optional[Callable[[dict], None]] = None) -> dict:
+        """
+        Start the unit and wait for the job to finish
+        @param timeout: maximum seconds to wait for the job, or None to wait
+            until it finishes
+        @param callback: optional function called when the unit state changes
+        @return: unit properties after the job finished
+        @raises UnitTimeoutError: if the job did not finish within `timeout`
+        """
+        return self.wait(self.start(), timeout, callback)
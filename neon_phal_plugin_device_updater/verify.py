@@ -0,0 +1,187 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count, replace
+from os.path import getsize, isfile
+from typing import Iterable, List, Optional
+
+from ovos_utils.log import LOG
+
+DEFAULT_CHUNK_SIZE = 64 * 1048576
+DEFAULT_ALGORITHM = "md5"
+_READ_SIZE = 1048576
+
+
+def get_manifest_path(file_path: str) -> str:
+    """
+    Get the path of the chunk-hash manifest associated with a file
+    @param file_path: path to a downloaded file
+    @return: path to the manifest for `file_path`
+    """
+    return f"{file_path}.manifest.json"
+
+
+def hash_chunk(file_path: str, index: int, chunk_size: int,
+               algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Hash one chunk of a file. Hashing releases the GIL, so this may be called
+    from multiple threads to use multiple cores.
+    @param file_path: path to file to read
+    @param index: index of the chunk to hash
+    @param chunk_size: size in bytes of each chunk
+    @param algorithm: name of the `hashlib` algorithm to use
+    @return: hex digest of the requested chunk
+    """
+    digest = hashlib.new(algorithm)
+    remaining = chunk_size
+    with open(file_path, 'rb') as f:
+        f.seek(index * chunk_size)
+        while remaining > 0:
+            data = f.read(min(_READ_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+    return digest.hexdigest()
+
+
+def hash_file(file_path: str, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Hash a whole file
+    @param file_path: path to file to read
+    @param algorithm: name of the `hashlib` algorithm to use
+    @return: hex digest of the file
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for data in iter(lambda: f.read(_READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _hash_chunks(file_path: str, indices: Iterable[int], chunk_size: int,
+                 algorithm: str, workers: Optional[int]) -> List[str]:
+    """
+    Hash the requested chunks of a file in parallel
+    @param file_path: path to file to read
+    @param indices: chunk indices to hash
+    @param chunk_size: size in bytes of each chunk
+    @param algorithm: name of the `hashlib` algorithm to use
+    @param workers: number of threads to use (default one per CPU)
+    @return: list of hex digests in the order of `indices`
+    """
+    indices = list(indices)
+    if len(indices) < 2:
+        return [hash_chunk(file_path, i, chunk_size, algorithm)
+                for i in indices]
+    workers = min(workers or cpu_count() or 1, len(indices))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda i: hash_chunk(file_path, i, chunk_size, algorithm),
+            indices))
+
+
+def build_manifest(file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   algorithm: str = DEFAULT_ALGORITHM,
+                   workers: Optional[int] = None) -> dict:
+    """
+    Build a chunk-hash manifest for a file
+    @param file_path: path to file to hash
+    @param chunk_size: size in bytes of each chunk
+    @param algorithm: name of the `hashlib` algorithm to use
+    @param workers: number of threads to use (default one per CPU)
+    @return: dict manifest with `size`, `chunk_size`, `algorithm` and `chunks`
+    """
+    size = getsize(file_path)
+    num_chunks = max(1, -(-size // chunk_size))
+    return {"size": size,
+            "chunk_size": chunk_size,
+            "algorithm": algorithm,
+            "chunks": _hash_chunks(file_path, range(num_chunks), chunk_size,
+                                   algorithm, workers)}
+
+
+def verify_file(file_path: str, manifest: dict,
+                indices: Optional[Iterable[int]] = None,
+                workers: Optional[int] = None) -> List[int]:
+    """
+    Verify a file against a chunk-hash manifest
+    @param file_path: path to file to verify
+    @param manifest: manifest previously returned by `build_manifest`
+    @param indices: optional chunk indices to check (default all chunks)
+    @param workers: number of threads to use (default one per CPU)
+    @return: sorted list of chunk indices that do not match the manifest
+    """
+    expected = manifest["chunks"]
+    chunk_size = manifest["chunk_size"]
+    indices = sorted(set(indices)) if indices is not None else \
+        list(range(len(expected)))
+    if not isfile(file_path):
+        return indices
+    hashes = _hash_chunks(file_path, indices, chunk_size,
+                          manifest.get("algorithm", DEFAULT_ALGORITHM),
+                          workers)
+    mismatched = [i for i, h in zip(indices, hashes) if h != expected[i]]
+    if getsize(file_path) != manifest["size"] and \
+            len(expected) - 1 not in mismatched:
+        # Extra data after the last chunk is not covered by chunk hashes
+        mismatched.append(len(expected) - 1)
+    return mismatched
+
+
+def load_manifest(file_path: str) -> Optional[dict]:
+    """
+    Load the manifest associated with a file
+    @param file_path: path to a downloaded file
+    @return: dict manifest if available, else None
+    """
+    try:
+        with open(get_manifest_path(file_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        LOG.error(f"Failed to load manifest for {file_path}: {e}")
+        return None
+
+
+def save_manifest(file_path: str, manifest: dict):
+    """
+    Atomically write the manifest associated with a file
+    @param file_path: path to a downloaded file
+    @param manifest: manifest to save
+    """
+    manifest_path = get_manifest_path(file_path)
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    replace(temp_path, manifest_path)
@@ -30,6 +30,7 @@ from setuptools import setup, find_packages
 from os import path, getenv
 
 PLUGIN_ENTRY_POINT = "neon-phal-plugin-device-updater=neon_phal_plugin_device_updater:DeviceUpdater"
+CLI_ENTRY_POINT = "neon-device-updater=neon_phal_plugin_device_updater.cli:main"
 BASE_PATH = path.abspath(path.dirname(__file__))
 
 
@@ -67,5 +68,6 @@ setup(
     long_description_content_type="text/markdown",
     install_requires=get_requirements('requirements.txt'),
     packages=find_packages(),
-    entry_points={'ovos.plugin.phal.admin': PLUGIN_ENTRY_POINT}
+    entry_points={'ovos.plugin.phal.admin': PLUGIN_ENTRY_POINT,
+                  'console_scripts': [CLI_ENTRY_POINT]}
 )
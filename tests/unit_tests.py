@@ -25,26 +25,162 @@
 # LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import cProfile
+import hashlib
+import json
 import logging
+import sys
+import tracemalloc
 import unittest
-from tempfile import mkstemp
-from threading import Thread
+from datetime import date
+from tempfile import mkdtemp, mkstemp
+from threading import Event, Thread
 from time import time, sleep
 
 import requests
 
-from os import remove
-from os.path import isfile, basename, join, dirname
+from contextlib import redirect_stdout
+from io import StringIO
+from os import chmod, listdir, remove, urandom
+from shutil import rmtree
+from os.path import isfile, basename, join, dirname, getsize
+from mock import patch
 
 from ovos_bus_client import Message
 
-from neon_phal_plugin_device_updater import DeviceUpdater
+from neon_phal_plugin_device_updater import DeviceUpdater, \
+    DownloadCancelledError
+from neon_phal_plugin_device_updater.cli import main as cli_main
+from neon_phal_plugin_device_updater.github import GitHubClient, \
+    RateLimitError
+from neon_phal_plugin_device_updater.legacy_index import DirectoryIndex
+from neon_phal_plugin_device_updater.mirrors import MirrorSelector, \
+    get_mirror_url
+from neon_phal_plugin_device_updater.network import AsyncNetwork
+from neon_phal_plugin_device_updater.profiling import HandlerProfiler
+from neon_phal_plugin_device_updater.rollout import get_rollout_bucket, \
+    get_rollout_percentage, is_admitted
+from neon_phal_plugin_device_updater.simulation import FleetSimulation, \
+    StubServer, get_percentile
+from neon_phal_plugin_device_updater.state import UpdateJournal, \
+    UpdateState, get_file_stat
+from neon_phal_plugin_device_updater.systemd import SystemdUnit, \
+    UnitTimeoutError
+from neon_phal_plugin_device_updater.verify import DEFAULT_CHUNK_SIZE, \
+    build_manifest, get_manifest_path, load_manifest, save_manifest, \
+    verify_file
 from ovos_utils.messagebus import FakeBus
 from ovos_utils.log import LOG
 
 LOG.level = logging.DEBUG
 
 
+class FakeStreamResponse:
+    """
+    Minimal stand-in for a streamed `requests.Response`
+    """
+    def __init__(self, size: int, status_code: int = 200,
+                 chunk_delay: float = 0.0, fail_after: int = None,
+                 headers: dict = None):
+        self.size = size
+        self.headers = headers or dict()
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.chunk_delay = chunk_delay
+        self.fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size: int):
+        remaining = self.size
+        while remaining > 0:
+            sleep(self.chunk_delay)
+            if self.fail_after is not None and \
+                    self.size - remaining >= self.fail_after:
+                raise requests.ConnectionError("Connection reset")
+            chunk = min(chunk_size, remaining)
+            remaining -= chunk
+            yield b'\0' * chunk
+
+
+FAKE_SYSTEMCTL = f"""#!{sys.executable}
+import json, os, subprocess, sys, time
+state_file = os.path.join(os.path.dirname(__file__), "unit_state.json")
+try:
+    with open(state_file) as f:
+        state = json.load(f)
+except FileNotFoundError:
+    state = {{"ActiveState": "inactive", "SubState": "dead",
+             "Result": "success", "ExecMainStatus": "0",
+             "ActiveEnterTimestampMonotonic": "0",
+             "InactiveEnterTimestampMonotonic": "0"}}
+
+
+def save():
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+if sys.argv[1] == "show":
+    print("\\n".join(f"{{k}}={{v}}" for k, v in state.items()))
+elif sys.argv[1] == "start":
+    subprocess.Popen([sys.executable, __file__, "_run"],
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+elif sys.argv[1] == "_run":
+    time.sleep(0.1)
+    state.update(ActiveState="activating", SubState="start")
+    save()
+    time.sleep(float(os.environ.get("FAKE_UNIT_DURATION", "0.5")))
+    failed = os.environ.get("FAKE_UNIT_RESULT", "success") != "success"
+    state.update(ActiveState="failed" if failed else "inactive",
+                 SubState="failed" if failed else "dead",
+                 Result="exit-code" if failed else "success",
+                 ExecMainStatus="1" if failed else "0",
+                 InactiveEnterTimestampMonotonic=str(time.monotonic_ns()))
+    save()
+else:
+    sys.exit(1)
+"""
+
+
+def get_fake_systemctl(directory: str) -> str:
+    """
+    Write a stand-in `systemctl` that runs a fake unit in the background
+    """
+    path = join(directory, "systemctl")
+    with open(path, 'w') as f:
+        f.write(FAKE_SYSTEMCTL)
+    chmod(path, 0o755)
+    return path
+
+
+def fake_range_get(size: int, chunk_delay: float = 0.0):
+    """
+    Build a `requests.get` replacement serving `size` bytes with Range support
+    """
+    def _get(url, stream=False, headers=None, **kwargs):
+        headers = headers or dict()
+        if "Range" in headers:
+            start, end = headers["Range"].split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else size - 1
+            if start >= size:
+                return FakeStreamResponse(
+                    0, 416, headers={"Content-Range": f"bytes */{size}"})
+            return FakeStreamResponse(
+                end - start + 1, 206, chunk_delay,
+                headers={"Content-Range": f"bytes {start}-{end}/{size}"})
+        return FakeStreamResponse(size, 200, chunk_delay,
+                                  headers={"Content-Length": str(size)})
+    return _get
+
+
 class PluginTests(unittest.TestCase):
     bus = FakeBus()
     plugin = DeviceUpdater(bus)
@@ -269,13 +405,488 @@ class PluginTests(unittest.TestCase):
         # TODO
         pass
 
+    def test_check_update_squashfs_rollout(self):
+        self.plugin._build_info = {"base_os": {"name": "debian-neon-image-rpi4",
+                                               "time": "2024-01-01_00_00"},
+                                   "version": "24.01.01"}
+        meta = {"base_os": {"name": "debian-neon-image-rpi4",
+                            "time": "2024-07-01_00_00"},
+                "rollout": {"percentage": 0}}
+        message = Message("neon.check_update_squashfs", {"track": "stable"})
+
+        with patch.object(self.plugin, "_get_gh_latest_release_tag",
+                          return_value="24.07.01"), \
+                patch.object(self.plugin, "_get_gh_release_meta_from_tag",
+                             return_value=meta):
+            # Device not admitted
+            self.plugin._device_id = "test-device"
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['update_available'])
+            self.assertTrue(resp['rollout_deferred'])
+            self.assertEqual(resp['update_metadata'], meta)
+
+            # Device admitted
+            meta['rollout']['percentage'] = \
+                get_rollout_bucket("test-device") + 1
+            resp = self.bus.wait_for_response(message).data
+            self.assertTrue(resp['update_available'])
+            self.assertFalse(resp['rollout_deferred'])
+
+            # Configured rollout overrides metadata
+            self.plugin.config["rollout"] = {"halted": True}
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['update_available'])
+            self.assertTrue(resp['rollout_deferred'])
+            self.plugin.config.pop("rollout")
+
+            # Invalid rollout spec fails closed
+            meta['rollout'] = {"schedule": [{"time": "July 1",
+                                             "percentage": 100}]}
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['update_available'])
+            self.assertTrue(resp['rollout_deferred'])
+
+            # Rollout errors are reported
+            with patch.object(self.plugin, "_check_rollout_admitted",
+                              side_effect=RuntimeError("rollout")):
+                resp = self.bus.wait_for_response(message).data
+                self.assertFalse(resp['update_available'])
+                self.assertIn("rollout", resp['error'])
+
+            # No rollout spec
+            meta.pop("rollout")
+            resp = self.bus.wait_for_response(message).data
+            self.assertTrue(resp['update_available'])
+            self.assertFalse(resp['rollout_deferred'])
+
+        self.plugin._device_id = None
+
+    def test_check_update_squashfs_fallback(self):
+        message = Message("neon.check_update_squashfs", {"track": "beta"})
+        legacy_meta = {"download_url": "https://fake/update.squashfs"}
+
+        gh_checks = []
+
+        def _gh_check(track, urgent=False):
+            gh_checks.append((track, urgent))
+            sleep(0.5)
+            raise ValueError("Unable to get metadata")
+
+        def _legacy_check(track):
+            sleep(0.5)
+            return True, legacy_meta
+
+        self.plugin.check_hedge_delay = 0.1
+        with patch.object(self.plugin, "_check_squashfs_update",
+                          side_effect=_gh_check), \
+                patch.object(self.plugin, "_legacy_check_squashfs_update",
+                             side_effect=_legacy_check):
+            # Legacy result is used and started before the slow check fails
+            start = time()
+            resp = self.bus.wait_for_response(message).data
+            self.assertLess(time() - start, 0.9)
+            self.assertTrue(resp['update_available'])
+            self.assertEqual(resp['update_metadata'], legacy_meta)
+            self.assertEqual(resp['track'], "beta")
+            self.assertNotIn("error", resp)
+            self.assertEqual(gh_checks, [("beta", False)])
+
+        with patch.object(self.plugin, "_check_squashfs_update",
+                          side_effect=ValueError("GitHub error")), \
+                patch.object(self.plugin, "_legacy_check_squashfs_update",
+                             side_effect=ConnectionError("Legacy error")):
+            # Both checks failed
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['update_available'])
+            self.assertIn("Legacy error", resp['error'])
+
+        with patch.object(self.plugin, "_check_squashfs_update",
+                          return_value=(False, None)), \
+                patch.object(self.plugin,
+                             "_legacy_check_squashfs_update") as legacy:
+            # Legacy check is not run if GitHub check succeeds
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['update_available'])
+            self.assertNotIn("error", resp)
+            legacy.assert_not_called()
+        self.plugin.check_hedge_delay = 2
+
+    def test_check_update_initramfs_fallback(self):
+        message = Message("neon.check_update_initramfs", {"track": "dev"})
+        self.plugin._initramfs_hash = "old_hash"
+        meta = {"initramfs": {"md5": "new_hash", "path": "initramfs"}}
+
+        with patch.object(self.plugin, "_get_gh_latest_release_tag",
+                          return_value="24.07.01") as get_tag, \
+                patch.object(self.plugin, "_get_gh_release_meta_from_tag",
+                             return_value=meta), \
+                patch.object(self.plugin,
+                             "_legacy_check_initramfs_update_available") as \
+                legacy:
+            # GitHub metadata is used
+            resp = self.bus.wait_for_response(message).data
+            self.assertTrue(resp['update_available'])
+            self.assertEqual(resp['new_meta'], meta['initramfs'])
+            self.assertEqual(resp['track'], "beta")
+            get_tag.assert_called_once_with("beta", False)
+            legacy.assert_not_called()
+
+            # Legacy check is used if GitHub check fails
+            get_tag.side_effect = ConnectionError("GitHub error")
+            legacy.return_value = True
+            resp = self.bus.wait_for_response(message).data
+            self.assertTrue(resp['update_available'])
+            self.assertIsNone(resp['new_meta'])
+            legacy.assert_called_once_with("beta")
+
+            # Both checks failed
+            legacy.side_effect = RuntimeError("Legacy error")
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['update_available'])
+            self.assertEqual(resp['current_hash'], "old_hash")
+            self.assertIn("Legacy error", resp['error'])
+        self.plugin._initramfs_hash = None
+
     def test_update_squashfs(self):
         # TODO
         pass
 
+    def test_apply_update(self):
+        _, squashfs_path = mkstemp()
+        remove(squashfs_path)
+        _, update_file = mkstemp()
+        with open(update_file, 'w') as f:
+            f.write("squashfs")
+        _, initramfs_update_path = mkstemp()
+        remove(initramfs_update_path)
+        _, initramfs_real_path = mkstemp()
+        real_paths = (self.plugin.squashfs_path,
+                      self.plugin.initramfs_update_path,
+                      self.plugin.initramfs_real_path)
+        self.plugin.squashfs_path = squashfs_path
+        self.plugin.initramfs_update_path = initramfs_update_path
+        self.plugin.initramfs_real_path = initramfs_real_path
+        self.plugin._initramfs_hash = "old_hash"
+        self.plugin._build_info = {"base_os": {"name": "debian-neon-image-rpi4",
+                                               "time": "2024-01-01_00_00",
+                                               "platform": "rpi4"}}
+        meta = {"version": "24.07.01",
+                "build_version": "debian-neon-image-rpi4_2024-07-01_00_00",
+                "download_url": "https://fake/rpi4/image.img.xz",
+                "base_os": {"name": "debian-neon-image-rpi4",
+                            "time": "2024-07-01_00_00",
+                            "platform": "rpi4"},
+                "image": {"version": "24.07.01"},
+                "initramfs": {"md5": "new_hash"}}
+        message = Message("neon.device_updater.apply_update",
+                          {"update_metadata": meta})
+
+        def _download_initramfs(url, md5):
+            self.assertEqual(md5, "new_hash")
+            with open(f"{initramfs_update_path}.download", 'w') as f:
+                f.write("initramfs")
+            return f"{initramfs_update_path}.download"
+
+        initramfs_result = [False]
+
+        def _apply_initramfs(_):
+            # Squashfs is staged before initramfs is applied
+            with open(squashfs_path) as f:
+                self.assertEqual(f.read(), "squashfs")
+            self.assertTrue(self.plugin._initramfs_lock.locked())
+            return initramfs_result[0]
+
+        with patch.object(self.plugin, "_get_squashfs_update",
+                          return_value=update_file) as get_squashfs, \
+                patch.object(self.plugin, "_download_initramfs",
+                             side_effect=_download_initramfs), \
+                patch.object(self.plugin, "_apply_initramfs",
+                             side_effect=_apply_initramfs) as apply_initramfs:
+            # Initramfs failure stages neither update
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['updated'])
+            self.assertIsInstance(resp['error'], str)
+            apply_initramfs.assert_called_once()
+            self.assertFalse(isfile(squashfs_path))
+            self.assertFalse(isfile(f"{squashfs_path}.tmp"))
+            self.assertFalse(isfile(initramfs_update_path))
+
+            # Initramfs failure restores a previously staged squashfs
+            apply_initramfs.reset_mock()
+            with open(squashfs_path, 'w') as f:
+                f.write("previous")
+            apply_initramfs.side_effect = RuntimeError("initramfs")
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['updated'])
+            self.assertIn("initramfs", resp['error'])
+            apply_initramfs.assert_called_once()
+            with open(squashfs_path) as f:
+                self.assertEqual(f.read(), "previous")
+            self.assertFalse(isfile(f"{squashfs_path}.previous"))
+            self.assertFalse(isfile(initramfs_update_path))
+
+            # Service still running at the deadline keeps both updates staged
+            complete = list()
+            self.bus.on("neon.device_updater.apply_update.complete",
+                        lambda m: complete.append(m.data))
+            settle = Event()
+            result = {"ActiveState": "failed", "Result": "exit-code",
+                      "ExecMainStatus": "1"}
+
+            def _wait_for_service(initial, _):
+                self.assertEqual(initial, {"ActiveState": "inactive"})
+                settle.wait(5)
+                return result
+
+            apply_initramfs.side_effect = UnitTimeoutError(
+                "timeout", {"ActiveState": "inactive"},
+                {"ActiveState": "activating"})
+            with patch.object(self.plugin, "_wait_for_initramfs_service",
+                              side_effect=_wait_for_service):
+                for success in (False, True):
+                    resp = self.bus.wait_for_response(message).data
+                    self.assertIsNone(resp['updated'])
+                    self.assertTrue(resp['pending'])
+                    with open(squashfs_path) as f:
+                        self.assertEqual(f.read(), "squashfs")
+                    self.assertTrue(isfile(initramfs_update_path))
+                    self.assertTrue(self.plugin._initramfs_lock.locked())
+
+                    if success:
+                        result.update(ActiveState="inactive",
+                                      Result="success", ExecMainStatus="0")
+                    settle.set()
+                    timeout = time() + 5
+                    while not complete and time() < timeout:
+                        sleep(0.05)
+                    self.assertFalse(self.plugin._initramfs_lock.locked())
+                    self.assertEqual(complete.pop()['updated'], success)
+                    settle.clear()
+                    self.assertFalse(isfile(f"{squashfs_path}.previous"))
+                    with open(squashfs_path) as f:
+                        # Previous squashfs is only restored after a failure
+                        self.assertEqual(f.read(),
+                                         "squashfs" if success else "previous")
+                    self.assertEqual(isfile(initramfs_update_path), success)
+
+            # Restore the previously staged squashfs for following cases
+            with open(squashfs_path, 'w') as f:
+                f.write("previous")
+            remove(initramfs_update_path)
+
+            # Initramfs update in progress stages neither update
+            apply_initramfs.reset_mock()
+            with self.plugin._initramfs_lock:
+                resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['updated'])
+            self.assertIn("in progress", resp['error'])
+            apply_initramfs.assert_not_called()
+            with open(squashfs_path) as f:
+                self.assertEqual(f.read(), "previous")
+
+            # Squashfs failure stages neither update
+            apply_initramfs.reset_mock()
+            apply_initramfs.side_effect = _apply_initramfs
+            initramfs_result[0] = True
+            get_squashfs.return_value = None
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['updated'])
+            apply_initramfs.assert_not_called()
+            with open(squashfs_path) as f:
+                self.assertEqual(f.read(), "previous")
+            self.assertFalse(isfile(initramfs_update_path))
+            self.assertFalse(isfile(f"{initramfs_update_path}.download"))
+
+            # Both updates staged
+            get_squashfs.return_value = update_file
+            resp = self.bus.wait_for_response(message).data
+            self.assertTrue(resp['updated'])
+            self.assertTrue(resp['initramfs_updated'])
+            self.assertEqual(resp['new_version'], update_file)
+            self.assertEqual(resp['version'], "24.07.01")
+            get_squashfs.assert_called_with(
+                "https://fake/rpi4/updates/image.squashfs",
+                join(dirname(initramfs_update_path), meta['build_version']),
+                None)
+            apply_initramfs.assert_called_once()
+            with open(squashfs_path) as f:
+                self.assertEqual(f.read(), "squashfs")
+            self.assertFalse(isfile(f"{squashfs_path}.previous"))
+            with open(initramfs_update_path) as f:
+                self.assertEqual(f.read(), "initramfs")
+            remove(squashfs_path)
+            remove(initramfs_update_path)
+
+            # Squashfs only
+            apply_initramfs.reset_mock()
+            resp = self.bus.wait_for_response(Message(
+                "neon.device_updater.apply_update",
+                {"update_metadata": meta, "squashfs_only": True})).data
+            self.assertTrue(resp['updated'])
+            self.assertFalse(resp['initramfs_updated'])
+            apply_initramfs.assert_not_called()
+            self.assertTrue(isfile(squashfs_path))
+            self.assertFalse(isfile(initramfs_update_path))
+            remove(squashfs_path)
+
+            # Already updated
+            self.plugin._initramfs_hash = "new_hash"
+            self.plugin._build_info['base_os'] = meta['base_os']
+            resp = self.bus.wait_for_response(message).data
+            self.assertFalse(resp['updated'])
+            self.assertNotIn("error", resp)
+
+        remove(update_file)
+        remove(initramfs_real_path)
+        self.plugin.squashfs_path, self.plugin.initramfs_update_path, \
+            self.plugin.initramfs_real_path = real_paths
+        self.plugin._initramfs_hash = None
+
+    def test_get_gh_latest_release_rate_limited(self):
+        self.plugin._build_info = {"base_os": {"name":
+                                               "debian-neon-image-rpi4"}}
+        limited = FakeAPIResponse(
+            {"message": "API rate limit exceeded"}, 403,
+            {"X-RateLimit-Remaining": "0",
+             "X-RateLimit-Reset": str(time() + 60)})
+        github = self.plugin._github
+        self.plugin._github = GitHubClient()
+        try:
+            with patch("neon_phal_plugin_device_updater.github.requests.get",
+                       return_value=limited):
+                with self.assertRaises(RateLimitError):
+                    self.plugin._get_gh_latest_release_tag("stable")
+                resp = self.bus.wait_for_response(
+                    Message("neon.device_updater.check_update"))
+                self.assertIsNone(resp.data['latest_version'])
+                self.assertIn("RateLimitError", resp.data['error'])
+
+            # Empty or invalid responses
+            self.plugin._github = GitHubClient()
+            with patch("neon_phal_plugin_device_updater.github.requests.get",
+                       return_value=FakeAPIResponse([])):
+                with self.assertRaises(ValueError):
+                    self.plugin._get_gh_latest_release_tag("beta")
+            with patch("neon_phal_plugin_device_updater.github.requests.get",
+                       return_value=FakeAPIResponse({"message": "Error"})):
+                with self.assertRaises(ValueError):
+                    self.plugin._get_gh_latest_release_tag("stable")
+
+            # Last known good release is used while rate-limited
+            release = {"tag_name": "24.07.01b1", "body": "rpi4",
+                       "created_at": "2024-07-01T00:00:00Z"}
+            with patch("neon_phal_plugin_device_updater.github.requests.get",
+                       return_value=FakeAPIResponse(
+                           [release, {**release, "body": "other"}])):
+                self.plugin._build_info['base_os']['name'] = "rpi4"
+                self.assertEqual(
+                    self.plugin._get_gh_latest_release_tag("beta"),
+                    "24.07.01b1")
+            with patch("neon_phal_plugin_device_updater.github.requests.get",
+                       return_value=limited):
+                self.assertEqual(
+                    self.plugin._get_gh_latest_release_tag("beta", True),
+                    "24.07.01b1")
+        finally:
+            self.plugin._github = github
+            self.plugin._build_info = None
+
     def test_update_initramfs(self):
-        # TODO
-        pass
+        test_dir = mkdtemp()
+        real_path = self.plugin.initramfs_real_path
+        unit = self.plugin._initramfs_unit
+        self.plugin.initramfs_real_path = join(test_dir, "initramfs")
+        with open(self.plugin.initramfs_real_path, 'wb') as f:
+            f.write(b"new initramfs")
+        new_hash = hashlib.md5(b"new initramfs").hexdigest()
+        self.plugin._initramfs_unit = SystemdUnit(
+            "update-initramfs", systemctl=get_fake_systemctl(test_dir),
+            poll_interval=0.05)
+        progress = list()
+        complete = list()
+        self.bus.on("neon.update_initramfs.progress",
+                    lambda m: progress.append(m.data))
+        self.bus.on("neon.update_initramfs.complete",
+                    lambda m: complete.append(m.data))
+        update = Message("neon.update_initramfs", {"track": "dev"})
+
+        def _get_initramfs_latest(_):
+            # Lock is held while the update is downloaded
+            self.assertTrue(self.plugin._initramfs_lock.locked())
+            return True
+
+        try:
+            with patch.object(self.plugin, "_get_gh_latest_release_tag",
+                              side_effect=ConnectionError()), \
+                    patch.object(self.plugin, "_get_initramfs_latest",
+                                 side_effect=_get_initramfs_latest), \
+                    patch.dict("os.environ", {"FAKE_UNIT_DURATION": "0.5"}):
+                # Failed update keeps the cached hash
+                self.plugin._initramfs_hash = "old_hash"
+                with patch.dict("os.environ", {"FAKE_UNIT_RESULT": "failed"}):
+                    resp = self.bus.wait_for_response(update, timeout=10)
+                self.assertFalse(resp.data['updated'])
+                self.assertIn("result=exit-code", resp.data['error'])
+                self.assertIn("status=1", resp.data['error'])
+                self.assertEqual(self.plugin._initramfs_hash, "old_hash")
+                self.assertEqual(complete[-1]['initramfs_hash'], "old_hash")
+
+                # Handler returns before the service finishes
+                progress.clear()
+                start = time()
+                self.bus.emit(update)
+                self.assertLess(time() - start, 0.5)
+                sleep(0.2)
+                self.assertTrue(self.plugin._initramfs_lock.locked())
+                resp = self.bus.wait_for_response(update, timeout=10)
+                self.assertIsNone(resp.data['updated'])
+                self.assertIn("in progress", resp.data['error'])
+                resp = self.bus.wait_for_message(
+                    "neon.update_initramfs.response", timeout=10)
+                self.assertTrue(resp.data['updated'])
+                self.assertIn({"state": "activating", "sub_state": "start"},
+                              progress)
+                self.assertEqual(progress[-1]['state'], "inactive")
+
+                # Hash is recomputed after a confirmed update
+                self.assertEqual(self.plugin._initramfs_hash, new_hash)
+                self.assertEqual(complete[-1]['initramfs_hash'], new_hash)
+                self.assertEqual(self.plugin._journal.get_state("initramfs"),
+                                 UpdateState.APPLIED)
+
+                # Service that does not finish in time is not a success
+                self.plugin.initramfs_timeout = 0.2
+                self.plugin._initramfs_hash = "old_hash"
+                self.assertFalse(self.plugin._initramfs_lock.locked())
+                with self.assertRaises(UnitTimeoutError), \
+                        self.plugin._initramfs_lock:
+                    self.plugin._apply_initramfs()
+                self.assertEqual(self.plugin._initramfs_hash, "old_hash")
+                sleep(0.6)
+
+                # Slow service is polled until it finishes
+                pending = list()
+                self.bus.on("neon.update_initramfs.pending",
+                            lambda m: pending.append(m.data))
+                self.bus.emit(update)
+                timeout = time() + 5
+                while not pending and time() < timeout:
+                    sleep(0.05)
+                self.assertEqual(len(pending), 1)
+                self.assertTrue(self.plugin._initramfs_lock.locked())
+                self.assertEqual(self.plugin._initramfs_hash, "old_hash")
+                resp = self.bus.wait_for_message(
+                    "neon.update_initramfs.response", timeout=10)
+                self.assertTrue(resp.data['updated'])
+                self.assertFalse(self.plugin._initramfs_lock.locked())
+                self.assertEqual(self.plugin._initramfs_hash, new_hash)
+        finally:
+            sleep(1)  # Allow the stand-in unit to finish
+            self.plugin.initramfs_timeout = 300
+            self.plugin.initramfs_real_path = real_path
+            self.plugin._initramfs_unit = unit
+            self.plugin._initramfs_hash = None
+            rmtree(test_dir)
 
     def test_stream_download_file(self):
         valid_os_url = "https://download.neonaiservices.com/test_images/test_os.img.xz"
@@ -315,6 +926,349 @@ class PluginTests(unittest.TestCase):
         self.assertFalse(self.plugin._downloading)
         remove(output_path)
 
+    def test_cancel_download(self):
+        file_size = 101 * 1048576
+        _, output_path = mkstemp()
+        remove(output_path)
+        temp_path = f"{output_path}.download"
+
+        # Nothing to cancel
+        resp = self.bus.wait_for_response(
+            Message("neon.device_updater.cancel_download"))
+        self.assertFalse(resp.data['cancelled'])
+
+        results = list()
+
+        def _download():
+            try:
+                results.append(self.plugin._stream_download_file(
+                    "https://fake/update.squashfs", output_path))
+            except DownloadCancelledError as e:
+                results.append(e)
+
+        # Cancel in-progress download and a queued duplicate request
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   fake_range_get(file_size, 0.001)):
+            thread = Thread(target=_download)
+            thread.start()
+            sleep(0.5)
+            self.assertTrue(self.plugin._downloading)
+            duplicate = Thread(target=_download)
+            duplicate.start()
+            sleep(0.1)
+            resp = self.bus.wait_for_response(
+                Message("neon.device_updater.cancel_download"))
+            thread.join()
+            duplicate.join()
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, DownloadCancelledError)
+        self.assertTrue(resp.data['cancelled'])
+        self.assertEqual(resp.data['download_path'], output_path)
+        self.assertFalse(self.plugin._downloading)
+        self.assertFalse(self.plugin._download_lock.locked())
+        self.assertFalse(isfile(output_path))
+        self.assertTrue(isfile(temp_path))
+        partial_size = getsize(temp_path)
+        self.assertLess(partial_size, file_size)
+
+        # Resume partial download
+        mock_get = fake_range_get(file_size)
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   side_effect=mock_get) as get:
+            self.assertEqual(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path), output_path)
+            self.assertEqual(get.call_args.kwargs['headers']['Range'],
+                             f"bytes={partial_size}-")
+        self.assertEqual(getsize(output_path), file_size)
+        self.assertFalse(isfile(temp_path))
+        self.plugin._remove_download(output_path)
+
+    def test_preempt_download(self):
+        file_size = 101 * 1048576
+        _, stale_path = mkstemp()
+        remove(stale_path)
+        _, new_path = mkstemp()
+        remove(new_path)
+        results = dict()
+        slow_get = fake_range_get(file_size, 0.001)
+        fast_get = fake_range_get(file_size)
+
+        def _get(url, *args, **kwargs):
+            if "stale" in url:
+                return slow_get(url, *args, **kwargs)
+            return fast_get(url, *args, **kwargs)
+
+        def _stale_download():
+            try:
+                results['stale'] = self.plugin._stream_download_file(
+                    "https://fake/stale.squashfs", stale_path)
+            except DownloadCancelledError as e:
+                results['stale'] = e
+
+        with patch("neon_phal_plugin_device_updater.requests.get", _get):
+            thread = Thread(target=_stale_download)
+            thread.start()
+            sleep(0.5)
+            self.assertTrue(self.plugin._downloading)
+            self.assertEqual(self.plugin._stream_download_file(
+                "https://fake/new.squashfs", new_path), new_path)
+        thread.join()
+        self.assertIsInstance(results['stale'], DownloadCancelledError)
+        self.assertFalse(isfile(stale_path))
+        self.assertTrue(isfile(f"{stale_path}.download"))
+        self.assertEqual(getsize(new_path), file_size)
+        self.assertFalse(self.plugin._downloading)
+        remove(f"{stale_path}.download")
+        self.plugin._remove_download(new_path)
+
+    def test_download_interrupted(self):
+        file_size = 101 * 1048576
+        _, output_path = mkstemp()
+        remove(output_path)
+        temp_path = f"{output_path}.download"
+
+        # Dropped transfer keeps the partial file
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   return_value=FakeStreamResponse(file_size,
+                                                   fail_after=2048 * 1024)):
+            self.assertIsNone(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path))
+        self.assertFalse(isfile(output_path))
+        self.assertTrue(isfile(temp_path))
+        partial_size = getsize(temp_path)
+        self.assertGreater(partial_size, 0)
+
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   side_effect=fake_range_get(file_size)) as get:
+            self.assertEqual(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path), output_path)
+            self.assertEqual(get.call_args.kwargs['headers']['Range'],
+                             f"bytes={partial_size}-")
+        self.assertEqual(getsize(output_path), file_size)
+        self.plugin._remove_download(output_path)
+
+    def test_download_size_validation(self):
+        file_size = 101 * 1048576
+        _, output_path = mkstemp()
+        remove(output_path)
+        temp_path = f"{output_path}.download"
+
+        # Transfer that ends early is not accepted
+        short = FakeStreamResponse(
+            file_size - 1024, headers={"Content-Length": str(file_size)})
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   return_value=short):
+            self.assertIsNone(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path))
+        self.assertFalse(isfile(output_path))
+        self.assertEqual(getsize(temp_path), file_size - 1024)
+
+        # Partial larger than the remote file is discarded
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   side_effect=fake_range_get(file_size - 2048)):
+            self.assertIsNone(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path))
+        self.assertFalse(isfile(temp_path))
+
+        # Server reporting a different size is not used to resume
+        origin = "https://download.example.com/update.squashfs"
+        self.plugin._mirrors = MirrorSelector(
+            {"squashfs": ["https://mirror.example.com"]})
+        self.plugin._mirrors._rankings["squashfs"] = \
+            (time(), ["https://mirror.example.com"])
+        other_get = fake_range_get(file_size + 1024)
+
+        def _get(url, stream=False, headers=None, **kwargs):
+            if url.startswith("https://mirror.example.com"):
+                return FakeStreamResponse(
+                    file_size, fail_after=file_size // 2,
+                    headers={"Content-Length": str(file_size)})
+            return other_get(url, stream, headers)
+
+        try:
+            with patch("neon_phal_plugin_device_updater.requests.get", _get):
+                self.assertIsNone(self.plugin._stream_download_file(
+                    origin, output_path))
+            self.assertFalse(isfile(output_path))
+            self.assertEqual(getsize(temp_path), file_size // 2)
+        finally:
+            self.plugin._mirrors = MirrorSelector()
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   side_effect=fake_range_get(file_size)):
+            self.assertEqual(self.plugin._stream_download_file(
+                origin, output_path), output_path)
+        self.assertEqual(getsize(output_path), file_size)
+        self.plugin._remove_download(output_path)
+
+        # Hash from release metadata is checked
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   side_effect=fake_range_get(file_size)):
+            self.assertIsNone(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path, "0" * 32))
+            self.assertFalse(isfile(output_path))
+            self.assertFalse(isfile(temp_path))
+            md5 = hashlib.md5(b'\0' * file_size).hexdigest()
+            self.assertEqual(self.plugin._stream_download_file(
+                "https://fake/update.squashfs", output_path, md5),
+                output_path)
+        self.assertEqual(DeviceUpdater._get_squashfs_md5(
+            {"squashfs": {"md5": md5}}), md5)
+        self.assertIsNone(DeviceUpdater._get_squashfs_md5({}))
+        self.plugin._remove_download(output_path)
+
+    def test_update_squashfs_cancelled(self):
+        meta = {"build_version": "test_version",
+                "download_url": "https://fake/rpi4/test.img.xz"}
+        self.plugin._build_info = {"base_os": {"platform": "rpi4"}}
+        try:
+            with patch.object(self.plugin, "_get_squashfs_update",
+                              side_effect=DownloadCancelledError()), \
+                    patch.object(self.plugin,
+                                 "_legacy_get_squashfs_latest") as legacy:
+                resp = self.bus.wait_for_response(
+                    Message("neon.update_squashfs",
+                            {"update_metadata": meta}))
+                legacy.assert_not_called()
+            self.assertTrue(resp.data['cancelled'])
+            self.assertIsNone(resp.data['new_version'])
+
+            # Failed download is an error, not "already updated"
+            with patch.object(self.plugin, "_stream_download_file",
+                              return_value=None), \
+                    patch.object(self.plugin, "_legacy_get_squashfs_latest",
+                                 side_effect=ConnectionError()):
+                resp = self.bus.wait_for_response(
+                    Message("neon.update_squashfs",
+                            {"update_metadata": meta}))
+            self.assertIn("ConnectionError", resp.data['error'])
+        finally:
+            self.plugin._build_info = None
+
+    def test_verify_download(self):
+        file_size = 101 * 1048576
+        chunk_size = 8 * 1048576
+        _, output_path = mkstemp()
+        remove(output_path)
+        self.plugin.verify_chunk_size = chunk_size
+
+        # No manifest
+        with open(output_path, 'wb') as f:
+            f.write(b'\0' * 1024)
+        self.assertFalse(self.plugin._verify_download(output_path))
+        remove(output_path)
+
+        # Valid download
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   fake_range_get(file_size)):
+            self.plugin._stream_download_file("https://fake/update.squashfs",
+                                              output_path)
+        self.assertTrue(isfile(get_manifest_path(output_path)))
+        self.assertTrue(self.plugin._verify_download(output_path))
+
+        # Corrupted chunk is repaired
+        with open(output_path, 'r+b') as f:
+            f.seek(chunk_size + 10)
+            f.write(b'corrupt')
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   side_effect=fake_range_get(file_size)) as get:
+            self.assertTrue(self.plugin._verify_download(output_path))
+            get.assert_called_once()
+            self.assertEqual(get.call_args.kwargs['headers']['Range'],
+                             f"bytes={chunk_size}-{2 * chunk_size - 1}")
+
+        # Truncated file is repaired
+        with open(output_path, 'r+b') as f:
+            f.truncate(file_size - chunk_size)
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   fake_range_get(file_size)):
+            self.assertTrue(self.plugin._verify_download(output_path))
+        self.assertEqual(getsize(output_path), file_size)
+
+        # Repair can be cancelled and is resumed by the next verification
+        with open(output_path, 'r+b') as f:
+            f.truncate(file_size - 4 * chunk_size)
+        results = list()
+
+        def _verify():
+            try:
+                results.append(self.plugin._verify_download(output_path))
+            except DownloadCancelledError as e:
+                results.append(e)
+
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   fake_range_get(file_size, 0.05)):
+            thread = Thread(target=_verify)
+            thread.start()
+            sleep(0.3)
+            self.assertTrue(self.plugin._downloading)
+            start = time()
+            resp = self.bus.wait_for_response(
+                Message("neon.device_updater.cancel_download"))
+            self.assertLess(time() - start, 1)
+            thread.join()
+        self.assertTrue(resp.data['cancelled'])
+        self.assertEqual(resp.data['download_path'], output_path)
+        self.assertIsInstance(results[0], DownloadCancelledError)
+        self.assertFalse(self.plugin._downloading)
+        self.assertIsNone(self.plugin._download_target)
+        self.assertTrue(isfile(output_path))
+        with patch("neon_phal_plugin_device_updater.requests.get",
+                   fake_range_get(file_size)):
+            self.assertTrue(self.plugin._verify_download(output_path))
+
+        # Corrupted file without a source is invalid
+        with open(output_path, 'r+b') as f:
+            f.write(b'corrupt')
+        manifest = load_manifest(output_path)
+        manifest.pop("url")
+        save_manifest(output_path, manifest)
+        self.assertFalse(self.plugin._verify_download(output_path))
+
+        self.plugin._remove_download(output_path)
+        self.assertFalse(isfile(get_manifest_path(output_path)))
+        self.plugin.verify_chunk_size = DEFAULT_CHUNK_SIZE
+
+    def test_mirror_failover(self):
+        file_size = 101 * 1048576
+        _, output_path = mkstemp()
+        remove(output_path)
+        origin = "https://download.example.com/neon_os/update.squashfs"
+        self.plugin._mirrors = MirrorSelector({"squashfs": [
+            "https://failing.example.com", "https://mirror.example.com/cache"]})
+        self.plugin._mirrors._rankings["squashfs"] = \
+            (time(), list(self.plugin._mirrors.mirrors["squashfs"]))
+        requested = list()
+
+        def _get(url, stream=False, headers=None, **kwargs):
+            requested.append((url, dict(headers or {})))
+            if url.startswith("https://failing.example.com"):
+                return FakeStreamResponse(file_size, fail_after=file_size // 2)
+            return fake_range_get(file_size)(url, stream, headers)
+
+        # Transfer continues from the next mirror without restarting
+        with patch("neon_phal_plugin_device_updater.requests.get", _get):
+            self.assertEqual(self.plugin._stream_download_file(
+                origin, output_path), output_path)
+        self.assertEqual(getsize(output_path), file_size)
+        self.assertEqual(len(requested), 2)
+        self.assertEqual(requested[0][0], "https://failing.example.com/"
+                                          "neon_os/update.squashfs")
+        self.assertEqual(requested[1][0], "https://mirror.example.com/cache/"
+                                          "neon_os/update.squashfs")
+        resumed_from = int(requested[1][1]['Range'].split('=')[1][:-1])
+        self.assertGreaterEqual(resumed_from, file_size // 2)
+
+        # Failed mirror is demoted
+        self.assertEqual(self.plugin._mirrors.get_urls("squashfs", origin),
+                         ["https://mirror.example.com/cache/"
+                          "neon_os/update.squashfs",
+                          "https://failing.example.com/"
+                          "neon_os/update.squashfs", origin])
+
+        self.plugin._remove_download(output_path)
+        self.plugin._mirrors = MirrorSelector()
+
     def test_get_build_info(self):
         resp = self.plugin.bus.wait_for_response(
             Message("neon.device_updater.get_build_info"))
@@ -333,6 +1287,1018 @@ class PluginTests(unittest.TestCase):
 
         self.plugin._downloading = False
 
+    def test_get_profile(self):
+        # Profiling disabled
+        self.assertIsNone(self.plugin._profiler)
+        resp = self.bus.wait_for_response(
+            Message("neon.device_updater.get_profile"))
+        self.assertEqual(resp.data, {"enabled": False, "profiles": []})
+
+        # Profiling enabled
+        profile_dir = mkdtemp()
+        bus = FakeBus()
+        plugin = DeviceUpdater(bus, config={"profiling": {
+            "enabled": True, "path": profile_dir, "max_profiles": 3}})
+        plugin._build_info = {"base_os": {"name": "test"}}
+        for _ in range(5):
+            bus.wait_for_response(
+                Message("neon.device_updater.get_build_info"))
+        bus.wait_for_response(
+            Message("neon.device_updater.get_download_status"))
+        self.assertEqual(len(listdir(profile_dir)), 3)
+
+        resp = bus.wait_for_response(
+            Message("neon.device_updater.get_profile"))
+        self.assertTrue(resp.data['enabled'])
+        profiles = resp.data['profiles']
+        self.assertEqual(len(profiles), 3)
+        self.assertEqual(profiles[0]['handler'],
+                         "neon.device_updater.get_download_status")
+        self.assertIn("get_download_status", profiles[0]['cpu_stats'])
+        self.assertIsInstance(profiles[0]['memory_stats'], list)
+
+        resp = bus.wait_for_response(
+            Message("neon.device_updater.get_profile",
+                    {"handler": "neon.device_updater.get_build_info",
+                     "limit": 1}))
+        self.assertEqual(len(resp.data['profiles']), 1)
+        self.assertEqual(resp.data['profiles'][0]['handler'],
+                         "neon.device_updater.get_build_info")
+
+        # InitramFS update thread is profiled rather than the handler
+        with patch.object(plugin, "_get_gh_latest_release_tag",
+                          side_effect=ConnectionError()), \
+                patch.object(plugin, "_get_initramfs_latest",
+                             return_value=False):
+            resp = bus.wait_for_response(Message("neon.update_initramfs",
+                                                 {"force_update": True}))
+            self.assertFalse(resp.data['updated'])
+        # Profile is saved after the update thread responds
+        timeout = time() + 5
+        profiles = list()
+        while not profiles and time() < timeout:
+            sleep(0.1)
+            profiles = plugin._profiler.get_profiles("neon.update_initramfs")
+        self.assertEqual(len(profiles), 1)
+        self.assertIn("_update_initramfs", profiles[0]['cpu_stats'])
+
+        tracemalloc.stop()
+        rmtree(profile_dir)
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_handler_profiler(self):
+        profile_dir = mkdtemp()
+        profiler = HandlerProfiler(profile_dir, max_profiles=10,
+                                   max_bytes=16384, top_n=5)
+
+        def _handler(size):
+            return bytearray(size)
+
+        handler = profiler.wrap("test.handler", _handler)
+        self.assertEqual(handler.__name__, "_handler")
+        self.assertEqual(len(handler(1048576)), 1048576)
+        profile = profiler.get_profiles()[0]
+        self.assertEqual(profile['handler'], "test.handler")
+        self.assertGreaterEqual(profile['duration'], 0)
+        self.assertIn("_handler", profile['cpu_stats'])
+        self.assertLessEqual(len(profile['memory_stats']), 5)
+
+        # Errors are raised after profiling
+        with self.assertRaises(TypeError):
+            handler("invalid")
+        self.assertEqual(len(profiler.get_profiles()), 2)
+
+        # Total size is bounded
+        for _ in range(10):
+            handler(1024)
+        total = sum(getsize(join(profile_dir, f))
+                    for f in listdir(profile_dir))
+        self.assertLessEqual(total, 16384)
+        self.assertLessEqual(len(listdir(profile_dir)), 10)
+
+        tracemalloc.stop()
+        rmtree(profile_dir)
+
+    def test_handler_profiler_limits(self):
+        profile_dir = mkdtemp()
+        profiler = HandlerProfiler(profile_dir, max_profiles=10,
+                                   max_bytes=16, trace_memory=False)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        handler = profiler.wrap("test.handler", lambda: None)
+        handler()
+        handler()
+
+        # Newest profile is kept even if larger than `max_bytes`
+        profiles = profiler.get_profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertGreater(getsize(join(profile_dir, listdir(profile_dir)[0])),
+                           16)
+        self.assertIsNone(profiles[0]['memory_stats'])
+        self.assertIsNone(profiles[0]['memory_allocated'])
+        self.assertFalse(tracemalloc.is_tracing())
+        rmtree(profile_dir)
+
+    def test_handler_profiler_concurrent(self):
+        profile_dir = mkdtemp()
+        profiler = HandlerProfiler(profile_dir, trace_memory=False)
+        started = Event()
+        release = Event()
+        calls = list()
+
+        def _blocking():
+            started.set()
+            release.wait(5)
+            return "blocking"
+
+        def _handler():
+            calls.append("handler")
+            return "handler"
+
+        blocking = profiler.wrap("test.blocking", _blocking)
+        handler = profiler.wrap("test.handler", _handler)
+
+        # Calls made while another call is profiled run unprofiled
+        thread = Thread(target=blocking, daemon=True)
+        thread.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(handler(), "handler")
+        release.set()
+        thread.join(5)
+        self.assertEqual([p['handler'] for p in profiler.get_profiles()],
+                         ["test.blocking"])
+
+        # Nested profiled calls run unprofiled
+        outer = profiler.wrap("test.outer", lambda: handler())
+        self.assertEqual(outer(), "handler")
+        self.assertEqual(len(profiler.get_profiles("test.outer")), 1)
+        self.assertEqual(profiler.get_profiles("test.handler"), [])
+
+        # Handlers run unprofiled if another profiler is active
+        class _ActiveProfile(cProfile.Profile):
+            def enable(self, *args, **kwargs):
+                raise ValueError("Another profiling tool is already active")
+
+        with patch("neon_phal_plugin_device_updater.profiling.cProfile."
+                   "Profile", _ActiveProfile):
+            self.assertEqual(handler(), "handler")
+        self.assertEqual(calls, ["handler"] * 3)
+        self.assertEqual(profiler.get_profiles("test.handler"), [])
+        rmtree(profile_dir)
+
+
+class CLITests(unittest.TestCase):
+    @staticmethod
+    def _run(*args) -> (int, dict):
+        stdout = StringIO()
+        with redirect_stdout(stdout):
+            code = cli_main(["--json", "--timing", *args])
+        return code, json.loads(stdout.getvalue())
+
+    def test_verify(self):
+        _, file_path = mkstemp()
+        with open(file_path, 'wb') as f:
+            f.write(urandom(4096))
+        save_manifest(file_path, build_manifest(file_path, chunk_size=1024))
+
+        code, result = self._run("--dry-run", "verify", file_path)
+        self.assertEqual(code, 0)
+        self.assertTrue(result['valid'])
+        self.assertEqual(result['mismatched_chunks'], [])
+        self.assertIn("verify", result['timing'])
+        self.assertIn("total", result['timing'])
+
+        with open(file_path, 'r+b') as f:
+            f.seek(2048)
+            f.write(b'corrupt')
+        code, result = self._run("--dry-run", "verify", file_path)
+        self.assertEqual(code, 1)
+        self.assertFalse(result['valid'])
+        self.assertEqual(result['mismatched_chunks'], [2])
+
+        DeviceUpdater._remove_download(file_path)
+        code, result = self._run("--dry-run", "verify", file_path)
+        self.assertEqual(code, 1)
+        self.assertEqual(result['error'], "No manifest")
+
+    def test_check(self):
+        build_info = {"base_os": {"name": "debian-neon-image-rpi4"}}
+        _, build_info_path = mkstemp()
+        with open(build_info_path, 'w') as f:
+            json.dump(build_info, f)
+
+        def _check(plugin, message):
+            self.assertEqual(plugin.build_info, build_info)
+            plugin.bus.emit(message.response({"update_available": True,
+                                              "track": "beta"}))
+
+        def _reconcile(plugin):
+            # Build info is available before update state is reconciled
+            self.assertEqual(plugin.build_info, build_info)
+
+        with patch.object(DeviceUpdater, "check_update_squashfs",
+                          autospec=True, side_effect=_check), \
+                patch.object(DeviceUpdater, "_reconcile_state",
+                             autospec=True, side_effect=_reconcile) as rec:
+            code, result = self._run("--build-info", build_info_path,
+                                     "--track", "beta", "check")
+            rec.assert_called_once()
+        self.assertEqual(code, 0)
+        self.assertEqual(result['squashfs'], {"update_available": True,
+                                              "track": "beta"})
+        self.assertNotIn("initramfs", result)
+        self.assertIn("check_squashfs", result['timing'])
+
+        # Failed checks exit non-zero
+        def _failed_check(plugin, message):
+            plugin.bus.emit(message.response({"update_available": False,
+                                              "error": "failed"}))
+
+        with patch.object(DeviceUpdater, "check_update_squashfs",
+                          autospec=True, side_effect=_failed_check):
+            code, result = self._run("--build-info", build_info_path,
+                                     "check")
+        self.assertEqual(code, 1)
+        self.assertEqual(result['squashfs']['error'], "failed")
+        remove(build_info_path)
+
+    def test_stage(self):
+        requests = list()
+
+        def _apply_update(plugin, message):
+            requests.append(message.data)
+            plugin.bus.emit(message.response({"updated": True,
+                                              "initramfs_updated": False}))
+
+        with patch.object(DeviceUpdater, "apply_update", autospec=True,
+                          side_effect=_apply_update):
+            code, result = self._run("--track", "beta", "stage", "--force",
+                                     "--squashfs-only")
+        self.assertEqual(code, 0)
+        self.assertTrue(result['staged'])
+        self.assertEqual(requests, [{"track": "beta", "force_update": True,
+                                     "squashfs_only": True}])
+
+    def test_download_dry_run(self):
+        meta = {"version": "24.07.01",
+                "build_version": "debian-neon-image-rpi4_2024-07-01_00_00",
+                "download_url": "https://fake/rpi4/image.img.xz"}
+        _, build_info_path = mkstemp()
+        with open(build_info_path, 'w') as f:
+            json.dump({"base_os": {"platform": "rpi4"}}, f)
+        with patch.object(DeviceUpdater, "_get_gh_latest_release_tag",
+                          return_value="24.07.01"), \
+                patch.object(DeviceUpdater, "_get_gh_release_meta_from_tag",
+                             return_value=meta), \
+                patch.object(DeviceUpdater,
+                             "_stream_download_file") as download:
+            code, result = self._run("--build-info", build_info_path,
+                                     "--dry-run", "download")
+            download.assert_not_called()
+        self.assertEqual(code, 0)
+        self.assertEqual(result['version'], "24.07.01")
+        self.assertEqual(result['download_url'],
+                         "https://fake/rpi4/updates/image.squashfs")
+        self.assertTrue(result['download_path'].endswith(
+            meta['build_version']))
+        self.assertFalse(result['downloaded'])
+        remove(build_info_path)
+
+
+class FakeIndexResponse:
+    """
+    Stand-in for a streamed directory listing response
+    """
+    def __init__(self, html: str = "", status_code: int = 200,
+                 headers: dict = None):
+        self.html = html
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or dict()
+        self.encoding = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size: int, decode_unicode: bool = False):
+        for i in range(0, len(self.html), 7):
+            yield self.html[i:i + 7]
+
+
+class DirectoryIndexTests(unittest.TestCase):
+    url = "https://download.example.com/neon_os/updates/dev/"
+    html = """<html><body><h1>Index of /neon_os/updates/dev/</h1><pre>
+<a href="../">../</a>
+<a href="debian-neon-image-rpi4_2024-07-01_00_00.squashfs">debian-neon-image-rpi4_2024-07-01_00..&gt;</a>
+<a href="debian-neon-image-rpi4_2024-07-01_00_00.json">debian-neon-image-rpi4_2024-07-01_00..&gt;</a>
+<a href="debian-neon-image-rpi4_2024-08-01_00_00.squashfs">debian-neon-image-rpi4_2024-08-01_00..&gt;</a>
+<a href="debian-neon-image-opi5_2024-09-01_00_00.squashfs">debian-neon-image-opi5_2024-09-01_00..&gt;</a>
+<a href="https://other.example.com/debian-neon-image-rpi4_2025-01-01_00_00.squashfs">external</a>
+<a href="/neon_os/updates/dev/debian-neon-image-rpi4_2024-06-01_00_00.squashfs">absolute</a>
+</pre></body></html>"""
+
+    def test_get_newest(self):
+        index = DirectoryIndex(max_age=0)
+        with patch("neon_phal_plugin_device_updater.legacy_index.requests.get",
+                   return_value=FakeIndexResponse(self.html,
+                                                  headers={"ETag": "v1"})):
+            links = index.get_links(self.url)
+            self.assertEqual([link[0] for link in links], [
+                "debian-neon-image-opi5_2024-09-01_00_00.squashfs",
+                "debian-neon-image-rpi4_2024-06-01_00_00.squashfs",
+                "debian-neon-image-rpi4_2024-07-01_00_00.squashfs",
+                "debian-neon-image-rpi4_2024-08-01_00_00.squashfs"])
+            self.assertEqual(index.get_newest(self.url,
+                                              "debian-neon-image-rpi4"),
+                             ("debian-neon-image-rpi4_2024-08-01_00_00."
+                              "squashfs",
+                              f"{self.url}debian-neon-image-rpi4_"
+                              f"2024-08-01_00_00.squashfs"))
+            self.assertEqual(index.get_newest(self.url)[0],
+                             "debian-neon-image-rpi4_2024-08-01_00_00."
+                             "squashfs")
+            self.assertEqual(index.get_newest(self.url,
+                                              "debian-neon-image-opi5")[0],
+                             "debian-neon-image-opi5_2024-09-01_00_00."
+                             "squashfs")
+            self.assertIsNone(index.get_newest(self.url,
+                                               "debian-neon-image-x86"))
+
+    def test_revalidation(self):
+        index = DirectoryIndex(max_age=60)
+        with patch("neon_phal_plugin_device_updater.legacy_index.requests.get",
+                   return_value=FakeIndexResponse(
+                       self.html, headers={"ETag": "v1",
+                                           "Last-Modified": "yesterday"})) \
+                as get:
+            links = index.get_links(self.url)
+            self.assertEqual(index.get_links(self.url), links)
+            get.assert_called_once()
+
+            # Conditional request after max_age
+            index.max_age = 0
+            get.return_value = FakeIndexResponse(status_code=304)
+            self.assertEqual(index.get_links(self.url), links)
+            self.assertEqual(get.call_args.kwargs['headers'],
+                             {"If-None-Match": "v1",
+                              "If-Modified-Since": "yesterday"})
+
+            # Cached index is used if the server is unavailable
+            get.side_effect = requests.ConnectionError("offline")
+            self.assertEqual(index.get_links(self.url), links)
+
+            # No cached index
+            with self.assertRaises(ConnectionError):
+                index.get_links(f"{self.url}other/")
+
+    def test_legacy_check_no_updates(self):
+        plugin = DeviceUpdater(FakeBus())
+        plugin._build_info = {"base_os": {"name": "debian-neon-image-x86"}}
+        with patch("neon_phal_plugin_device_updater.legacy_index.requests.get",
+                   return_value=FakeIndexResponse(self.html)):
+            self.assertIsNone(
+                plugin._legacy_check_squashfs_update_available("dev"))
+
+
+class AsyncNetworkTests(unittest.TestCase):
+    network = AsyncNetwork(max_workers=4, timeout=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.network.shutdown()
+
+    def test_with_fallback(self):
+        def _result(value, delay=0.0):
+            sleep(delay)
+            return value
+
+        def _error(delay=0.0):
+            sleep(delay)
+            raise ConnectionError("failed")
+
+        # Primary result is preferred even if fallback is faster
+        self.assertEqual(self.network.run_with_fallback(
+            lambda: _result("primary", 0.2), lambda: _result("fallback")),
+            "primary")
+
+        # Fallback is not called if primary succeeds
+        fallback_calls = []
+        self.assertEqual(self.network.run_with_fallback(
+            lambda: _result("primary", 0.2),
+            lambda: fallback_calls.append(1), hedge_delay=0.5), "primary")
+        self.assertEqual(self.network.run_with_fallback(
+            lambda: _result("primary"), lambda: fallback_calls.append(1)),
+            "primary")
+        sleep(0.1)
+        self.assertEqual(fallback_calls, [])
+
+        # Fallback starts after primary fails
+        start = time()
+        self.assertEqual(self.network.run_with_fallback(
+            lambda: _error(0.3), lambda: _result("fallback", 0.3)),
+            "fallback")
+        self.assertGreaterEqual(time() - start, 0.6)
+
+        # Hedged fallback runs concurrently with a slow primary
+        start = time()
+        self.assertEqual(self.network.run_with_fallback(
+            lambda: _error(0.4), lambda: _result("fallback", 0.3),
+            hedge_delay=0.1), "fallback")
+        self.assertLess(time() - start, 0.6)
+
+        # Primary deadline
+        start = time()
+        self.assertEqual(self.network.run_with_fallback(
+            lambda: _result("primary", 1), lambda: _result("fallback"),
+            timeout=0.2), "fallback")
+        self.assertLess(time() - start, 0.5)
+
+        # Both fail
+        with self.assertRaises(ConnectionError):
+            self.network.run_with_fallback(_error, _error)
+        with self.assertRaises(ConnectionError):
+            self.network.run_with_fallback(lambda: _error(0.2), _error,
+                                           hedge_delay=0)
+
+
+class UpdateStateTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = mkdtemp()
+        self.state_path = join(self.test_dir, "state.json")
+        self.download_path = join(self.test_dir, "image_2024-07-01_00_00")
+        self.squashfs_path = join(self.test_dir, "update.squashfs")
+
+    def tearDown(self):
+        rmtree(self.test_dir)
+
+    def _get_plugin(self) -> DeviceUpdater:
+        plugin = DeviceUpdater(FakeBus(), config={
+            "state_path": self.state_path,
+            "initramfs_upadate_path": join(self.test_dir, "initramfs"),
+            "squashfs_path": self.squashfs_path})
+        plugin._build_info = {"base_os": {"name": "image",
+                                          "time": "2024-01-01_00_00"}}
+        return plugin
+
+    def _write_download(self):
+        with open(self.download_path, 'wb') as f:
+            f.write(urandom(4096))
+        save_manifest(self.download_path,
+                      build_manifest(self.download_path, chunk_size=1024))
+
+    def test_journal(self):
+        journal = UpdateJournal(self.state_path)
+        self.assertIsNone(journal.get_state("squashfs"))
+        journal.transition("squashfs", UpdateState.CHECKED, version="v1",
+                           download_url="https://fake/v1")
+        journal.transition("squashfs", UpdateState.DOWNLOADING,
+                           download_path="/tmp/v1")
+        self.assertEqual(listdir(self.test_dir), ["state.json"])
+
+        # State persists across instances
+        journal = UpdateJournal(self.state_path)
+        self.assertEqual(journal.get_state("squashfs"),
+                         UpdateState.DOWNLOADING)
+        entry = journal.get("squashfs")
+        self.assertEqual(entry['version'], "v1")
+        self.assertEqual(entry['download_url'], "https://fake/v1")
+        self.assertEqual(entry['download_path'], "/tmp/v1")
+
+        # New version resets state data
+        journal.transition("squashfs", UpdateState.CHECKED, version="v2")
+        self.assertNotIn("download_path", journal.get("squashfs"))
+
+        # History is bounded
+        for _ in range(30):
+            journal.transition("initramfs", UpdateState.CHECKED)
+        self.assertEqual(len(journal.history), journal.max_history)
+
+        journal.clear("squashfs")
+        self.assertEqual(UpdateJournal(self.state_path).get("squashfs"), {})
+
+        # Invalid journal is ignored
+        with open(self.state_path, 'w') as f:
+            f.write("{invalid")
+        self.assertIsNone(UpdateJournal(self.state_path).get_state("squashfs"))
+
+    def test_reconcile_staged(self):
+        self._write_download()
+        with open(self.squashfs_path, 'w') as f:
+            f.write("staged")
+        base_os = {"name": "image", "time": "2024-07-01_00_00"}
+        journal = UpdateJournal(self.state_path)
+        journal.transition("squashfs", UpdateState.STAGED,
+                           version=basename(self.download_path),
+                           download_path=self.download_path,
+                           verified_stat=get_file_stat(self.download_path),
+                           staged_stat=get_file_stat(self.squashfs_path),
+                           base_os=base_os)
+
+        # Staged update not yet applied
+        plugin = self._get_plugin()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.STAGED)
+
+        # Staged file removed
+        remove(self.squashfs_path)
+        plugin = self._get_plugin()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.VERIFIED)
+
+        # Restarted into the new image
+        with open(self.squashfs_path, 'w') as f:
+            f.write("staged")
+        journal = UpdateJournal(self.state_path)
+        journal.transition("squashfs", UpdateState.STAGED,
+                           staged_stat=get_file_stat(self.squashfs_path))
+        plugin = DeviceUpdater(FakeBus(), config={
+            "state_path": self.state_path,
+            "squashfs_path": self.squashfs_path})
+        plugin._build_info = {"base_os": base_os}
+        plugin._reconcile_state()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.APPLIED)
+
+    def test_reconcile_download(self):
+        journal = UpdateJournal(self.state_path)
+        journal.transition("squashfs", UpdateState.DOWNLOADING,
+                           version=basename(self.download_path),
+                           download_path=self.download_path)
+
+        # Partial download is kept for resumption
+        with open(f"{self.download_path}.download", 'w') as f:
+            f.write("partial")
+        plugin = self._get_plugin()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.DOWNLOADING)
+
+        # Download completed before state was saved
+        self._write_download()
+        plugin = self._get_plugin()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.VERIFIED)
+
+        # Verified file was modified
+        with open(self.download_path, 'ab') as f:
+            f.write(b'modified')
+        remove(f"{self.download_path}.download")
+        remove(get_manifest_path(self.download_path))
+        plugin = self._get_plugin()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.CHECKED)
+
+    def test_resume_verified_update(self):
+        self._write_download()
+        plugin = self._get_plugin()
+        url = "https://fake/image.squashfs"
+
+        # Existing download is verified once
+        with patch.object(plugin, "_verify_download",
+                          return_value=True) as verify:
+            self.assertEqual(plugin._get_squashfs_update(url,
+                                                         self.download_path),
+                             self.download_path)
+            verify.assert_called_once()
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.VERIFIED)
+
+        # Verified download is not re-verified after a restart
+        plugin = self._get_plugin()
+        with patch.object(plugin, "_verify_download") as verify, \
+                patch.object(plugin, "_stream_download_file") as download:
+            self.assertEqual(plugin._get_squashfs_update(url,
+                                                         self.download_path),
+                             self.download_path)
+            verify.assert_not_called()
+            download.assert_not_called()
+
+        # Staged file is not copied again
+        plugin._stage_squashfs(self.download_path)
+        self.assertEqual(plugin._journal.get_state("squashfs"),
+                         UpdateState.STAGED)
+        plugin = self._get_plugin()
+        with patch("neon_phal_plugin_device_updater.shutil.copyfile") as copy:
+            plugin._stage_squashfs(self.download_path)
+            copy.assert_not_called()
+
+        resp = plugin.bus.wait_for_response(
+            Message("neon.device_updater.get_update_state"))
+        self.assertEqual(resp.data['squashfs']['state'], "staged")
+        self.assertEqual(resp.data['initramfs'], {})
+
+
+class SimulationTests(unittest.TestCase):
+    def test_get_percentile(self):
+        self.assertIsNone(get_percentile([], 50))
+        values = list(range(1, 101))
+        self.assertEqual(get_percentile(values, 50), 50)
+        self.assertEqual(get_percentile(values, 99), 99)
+        self.assertEqual(get_percentile(values, 100), 100)
+        self.assertEqual(get_percentile([3, 1, 2], 0), 1)
+
+    def test_stub_server(self):
+        server = StubServer(download_size=1000).start()
+        try:
+            resp = requests.get(f"{server.url}/api/repos/NeonGeckoCom/neon-os"
+                                f"/releases/latest")
+            self.assertEqual(resp.json()['tag_name'],
+                             server.release_meta['version'])
+            url = server.release_meta['download_url'].replace(
+                "/rpi4/", "/rpi4/updates/").replace(".img.xz", ".squashfs")
+            resp = requests.get(url, headers={"Range": "bytes=400-"})
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(len(resp.content), 600)
+            resp = requests.get(url, headers={"Range": "bytes=1000-"})
+            self.assertEqual(resp.status_code, 416)
+            index = DirectoryIndex(max_age=0)
+            self.assertTrue(index.get_links(f"{server.url}/legacy/stable/"))
+            self.assertTrue(index.get_links(f"{server.url}/legacy/stable/"))
+        finally:
+            server.stop()
+        self.assertEqual(server.endpoints['api']['requests'], 1)
+        self.assertEqual(server.endpoints['download']['status'],
+                         {206: 1, 416: 1})
+        self.assertEqual(server.endpoints['legacy_index']['status'],
+                         {200: 1, 304: 1})
+        self.assertEqual(server.peak_downloads, 1)
+
+    def test_stub_server_api_limits(self):
+        path = "/api/repos/NeonGeckoCom/neon-os/releases/latest"
+        server = StubServer(api_quota=2).start()
+        url = f"{server.url}{path}"
+        try:
+            resp = requests.get(url, headers={"Authorization": "Bearer a"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["X-RateLimit-Remaining"], "1")
+            resp = requests.get(url, headers={
+                "Authorization": "Bearer a",
+                "If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers["X-RateLimit-Remaining"], "0")
+            resp = requests.get(url, headers={"Authorization": "Bearer a"})
+            self.assertEqual(resp.status_code, 403)
+            self.assertIn("rate limit", resp.json()['message'])
+            # Quota is per client
+            resp = requests.get(url, headers={"Authorization": "Bearer b"})
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            server.stop()
+        self.assertEqual(server.endpoints['api']['status'],
+                         {200: 2, 304: 1, 403: 1})
+
+        server = StubServer(api_error_rate=1).start()
+        try:
+            resp = requests.get(f"{server.url}{path}")
+            self.assertEqual(resp.status_code, 502)
+        finally:
+            server.stop()
+        self.assertEqual(server.endpoints['api']['status'], {502: 1})
+
+    def test_fleet_simulation(self):
+        report = FleetSimulation(devices=4, poll_interval=0.5, duration=1,
+                                 download=True, download_size=65536,
+                                 stagger=False, workers=4).run()
+        self.assertEqual(report['check_errors'], 0)
+        self.assertGreaterEqual(report['checks'], 8)
+        self.assertEqual(report['updates_available'], 4)
+        self.assertEqual(report['downloads'], 4)
+        self.assertEqual(report['endpoints']['api']['requests'],
+                         report['checks'])
+        # Legacy index is only used if the GitHub check fails
+        self.assertNotIn("legacy_index", report['endpoints'])
+        self.assertEqual(report['endpoints']['download']['bytes'], 4 * 65536)
+        self.assertGreaterEqual(report['peak_concurrent_downloads'], 1)
+        self.assertLessEqual(report['check_latency']['p50'],
+                             report['check_latency']['max'])
+
+        # No devices admitted to the rollout
+        report = FleetSimulation(devices=4, poll_interval=0.5, duration=0.5,
+                                 rollout_percentage=0, download=True,
+                                 stagger=False, workers=4).run()
+        self.assertEqual(report['rollout_deferred'], report['checks'])
+        self.assertEqual(report['downloads'], 0)
+        self.assertNotIn("download", report['endpoints'])
+
+    def test_fleet_simulation_api_limits(self):
+        # Devices stop using the API when the quota runs out and answer
+        # checks from cache
+        report = FleetSimulation(devices=2, poll_interval=0.2, duration=1,
+                                 stagger=False, workers=2, api_quota=2,
+                                 quota_reserve=0).run()
+        self.assertEqual(report['check_errors'], 0)
+        self.assertEqual(report['updates_available'], report['checks'])
+        self.assertEqual(report['endpoints']['api']['requests'], 4)
+        self.assertGreater(report['checks'], 4)
+
+        # Failed API requests fall back to the cached legacy index
+        report = FleetSimulation(devices=2, poll_interval=0.2, duration=1,
+                                 stagger=False, workers=2, api_error_rate=1,
+                                 legacy_index_ttl=60).run()
+        self.assertEqual(report['check_errors'], 0)
+        self.assertEqual(report['updates_available'], report['checks'])
+        self.assertEqual(report['endpoints']['api']['status'],
+                         {502: report['checks']})
+        self.assertEqual(report['endpoints']['legacy_index']['requests'], 2)
+        uncached = FleetSimulation(devices=2, poll_interval=0.2, duration=1,
+                                   stagger=False, workers=2, api_error_rate=1,
+                                   legacy_index_ttl=0).run()
+        self.assertEqual(uncached['endpoints']['legacy_index']['requests'],
+                         uncached['checks'])
+
+        # Slow API requests are hedged with the legacy check
+        report = FleetSimulation(devices=2, poll_interval=0.5, duration=1,
+                                 stagger=False, workers=2, api_latency=0.5,
+                                 hedge_delay=0.1).run()
+        self.assertEqual(report['check_errors'], 0)
+        self.assertEqual(report['endpoints']['legacy_metadata']['requests'],
+                         report['checks'])
+
+
+class FakeAPIResponse:
+    def __init__(self, data=None, status_code: int = 200,
+                 headers: dict = None):
+        """
+        Minimal `requests.Response` for GitHub API calls
+        """
+        self.data = data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or dict()
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+
+class GitHubClientTests(unittest.TestCase):
+    def test_rate_limit(self):
+        client = GitHubClient("https://api.example.com/", token="token",
+                              reserve=2)
+        reset = time() + 60
+        release = {"tag_name": "24.07.01"}
+        with patch("neon_phal_plugin_device_updater.github.requests.get",
+                   return_value=FakeAPIResponse(
+                       release, headers={"X-RateLimit-Limit": "60",
+                                         "X-RateLimit-Remaining": "3",
+                                         "X-RateLimit-Reset": str(reset),
+                                         "ETag": '"v1"'})) as get:
+            self.assertEqual(client.get("/releases/latest"), release)
+            get.assert_called_once()
+            self.assertEqual(get.call_args.args[0],
+                             "https://api.example.com/releases/latest")
+            headers = get.call_args.kwargs['headers']
+            self.assertEqual(headers['Authorization'], "Bearer token")
+            self.assertNotIn("If-None-Match", headers)
+        self.assertEqual(client.rate_limit,
+                         {"limit": 60, "remaining": 3, "reset": reset,
+                          "authenticated": True})
+        self.assertFalse(client.is_deferred())
+
+        # Cached response is revalidated
+        with patch("neon_phal_plugin_device_updater.github.requests.get",
+                   return_value=FakeAPIResponse(
+                       None, 304, {"X-RateLimit-Remaining": "2"})) as get:
+            self.assertEqual(client.get("/releases/latest"), release)
+            self.assertEqual(get.call_args.kwargs['headers']['If-None-Match'],
+                             '"v1"')
+
+        # Non-urgent requests are deferred while the quota is in reserve
+        self.assertTrue(client.is_deferred())
+        self.assertFalse(client.is_deferred(urgent=True))
+        with patch("neon_phal_plugin_device_updater.github.requests.get") \
+                as get:
+            self.assertEqual(client.get("/releases/latest"), release)
+            get.assert_not_called()
+            with self.assertRaises(RateLimitError):
+                client.get("/releases")
+            get.assert_not_called()
+
+        # Rate-limited response returns the last known good result
+        limited = FakeAPIResponse(
+            {"message": "API rate limit exceeded"}, 403,
+            {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)})
+        with patch("neon_phal_plugin_device_updater.github.requests.get",
+                   return_value=limited) as get:
+            self.assertEqual(client.get("/releases/latest", urgent=True),
+                             release)
+            get.assert_called_once()
+            self.assertEqual(client.remaining, 0)
+            with self.assertRaises(RateLimitError) as e:
+                client.get("/releases", urgent=True)
+            self.assertEqual(e.exception.reset, reset)
+            get.assert_called_once()
+
+        # Requests resume after the reset time
+        client.reset = time() - 1
+        self.assertFalse(client.is_deferred())
+
+    def test_errors(self):
+        client = GitHubClient()
+        with patch("neon_phal_plugin_device_updater.github.requests.get",
+                   return_value=FakeAPIResponse(
+                       {"message": "Forbidden"}, 403)):
+            with self.assertRaises(ConnectionError) as e:
+                client.get("/releases")
+            self.assertNotIsInstance(e.exception, RateLimitError)
+        self.assertFalse(client.is_deferred())
+
+        # Secondary rate limit
+        with patch("neon_phal_plugin_device_updater.github.requests.get",
+                   return_value=FakeAPIResponse(
+                       {"message": "Slow down"}, 429,
+                       {"Retry-After": "30"})):
+            with self.assertRaises(RateLimitError) as e:
+                client.get("/releases")
+        self.assertGreater(e.exception.reset, time() + 25)
+        self.assertTrue(client.is_deferred(urgent=True))
+
+
+class SystemdUnitTests(unittest.TestCase):
+    def test_is_finished(self):
+        inactive = {"ActiveState": "inactive",
+                    "ActiveEnterTimestampMonotonic": "0",
+                    "InactiveEnterTimestampMonotonic": "10"}
+        self.assertFalse(SystemdUnit.is_finished(inactive, inactive))
+        self.assertFalse(SystemdUnit.is_finished(
+            inactive, {**inactive, "ActiveState": "activating"}))
+        finished = {**inactive, "InactiveEnterTimestampMonotonic": "20",
+                    "Result": "success"}
+        self.assertTrue(SystemdUnit.is_finished(inactive, finished))
+        self.assertTrue(SystemdUnit.is_success(finished))
+
+        failed = {**finished, "ActiveState": "failed", "Result": "exit-code"}
+        self.assertTrue(SystemdUnit.is_finished(inactive, failed))
+        self.assertFalse(SystemdUnit.is_success(failed))
+
+        active = {**finished, "ActiveState": "active"}
+        self.assertTrue(SystemdUnit.is_finished(active, active))
+        self.assertTrue(SystemdUnit.is_success(active))
+
+    def test_run(self):
+        test_dir = mkdtemp()
+        unit = SystemdUnit("test", systemctl=get_fake_systemctl(test_dir),
+                           poll_interval=0.05)
+        states = list()
+        with patch.dict("os.environ", {"FAKE_UNIT_DURATION": "0.2"}):
+            properties = unit.run(5, lambda p: states.append(p['ActiveState']))
+        self.assertTrue(SystemdUnit.is_success(properties))
+        self.assertEqual(states, ["inactive", "activating", "inactive"])
+
+        with self.assertRaises(RuntimeError):
+            SystemdUnit("test", systemctl="/bin/false").start()
+        rmtree(test_dir)
+
+
+class MirrorTests(unittest.TestCase):
+    def test_get_mirror_url(self):
+        url = "https://download.example.com/neon_os/rpi4/update.squashfs?a=1"
+        self.assertEqual(get_mirror_url(url, "http://local/"),
+                         "http://local/neon_os/rpi4/update.squashfs?a=1")
+        self.assertEqual(get_mirror_url(url, "https://cache.example/neon"),
+                         "https://cache.example/neon/neon_os/rpi4/"
+                         "update.squashfs?a=1")
+
+    def test_mirror_ranking(self):
+        origin = "https://origin.example.com/file"
+        mirrors = ["https://down.example.com", "https://slow.example.com",
+                   "https://fast.example.com"]
+        selector = MirrorSelector({"squashfs": mirrors}, probe_bytes=8192)
+        self.assertEqual(selector.get_urls("initramfs", origin), [origin])
+
+        probed = list()
+
+        def _get(url, stream=False, headers=None, **kwargs):
+            probed.append(url)
+            self.assertEqual(headers['Range'], "bytes=0-8191")
+            if url.startswith("https://down"):
+                raise requests.ConnectionError("unreachable")
+            delay = 0.1 if url.startswith("https://slow") else 0.0
+            return FakeStreamResponse(8192, 206, delay)
+
+        with patch("neon_phal_plugin_device_updater.mirrors.requests.get",
+                   _get):
+            urls = selector.get_urls("squashfs", origin)
+            self.assertEqual(urls, ["https://fast.example.com/file",
+                                    "https://slow.example.com/file",
+                                    "https://down.example.com/file", origin])
+            self.assertEqual(len(probed), 3)
+
+            # Ranking is cached
+            self.assertEqual(selector.get_urls("squashfs", origin), urls)
+            self.assertEqual(len(probed), 3)
+
+            # Expired ranking is re-probed
+            selector.cache_ttl = 0
+            selector.get_urls("squashfs", origin)
+            self.assertEqual(len(probed), 6)
+
+
+class RolloutTests(unittest.TestCase):
+    def test_get_rollout_bucket(self):
+        bucket = get_rollout_bucket("device-1")
+        self.assertIsInstance(bucket, float)
+        self.assertTrue(0 <= bucket < 100)
+        self.assertEqual(bucket, get_rollout_bucket("device-1"))
+        self.assertNotEqual(bucket, get_rollout_bucket("device-2"))
+
+        # Buckets are roughly uniform
+        buckets = [get_rollout_bucket(f"device-{i}") for i in range(1000)]
+        admitted = len([b for b in buckets if b < 25])
+        self.assertTrue(200 < admitted < 300)
+
+    def test_get_rollout_percentage(self):
+        self.assertEqual(get_rollout_percentage(None), 100)
+        self.assertEqual(get_rollout_percentage({}), 100)
+        self.assertEqual(get_rollout_percentage({"percentage": 20}), 20)
+        self.assertEqual(get_rollout_percentage({"percentage": 20,
+                                                 "halted": True}), 0)
+
+        schedule = {"schedule": [
+            {"time": "2024-07-03T00:00:00Z", "percentage": 100},
+            {"time": "2024-07-01T00:00:00Z", "percentage": 10},
+            {"time": 1719878400, "percentage": 50}]}
+        jun_30 = 1719705600
+        jul_1 = 1719792000
+        jul_2 = 1719878400
+        jul_3 = 1719964800
+        self.assertEqual(get_rollout_percentage(schedule, jun_30), 0)
+        self.assertEqual(get_rollout_percentage(schedule, jul_1), 10)
+        self.assertEqual(get_rollout_percentage(schedule, jul_2 + 1), 50)
+        self.assertEqual(get_rollout_percentage(schedule, jul_3), 100)
+
+        # Dates and ISO 8601 times, including unquoted YAML dates
+        schedule = {"schedule": [
+            {"time": date(2024, 7, 1), "percentage": "10"},
+            {"time": "2024-07-02", "percentage": 50},
+            {"time": "2024-07-03T00:00:00+00:00", "percentage": 100}]}
+        self.assertEqual(get_rollout_percentage(schedule, jun_30), 0)
+        self.assertEqual(get_rollout_percentage(schedule, jul_1), 10)
+        self.assertEqual(get_rollout_percentage(schedule, jul_2), 50)
+        self.assertEqual(get_rollout_percentage(schedule, jul_3), 100)
+
+        # Invalid specs admit no devices
+        for invalid in ({"percentage": "ten"},
+                        {"percentage": None},
+                        {"schedule": [{"time": "July 1", "percentage": 10}]},
+                        {"schedule": [{"time": "2024-07-01"}]},
+                        {"schedule": [{"time": "2024-07-01",
+                                       "percentage": "all"}]},
+                        {"schedule": "2024-07-01"},
+                        ["percentage", 100]):
+            self.assertEqual(get_rollout_percentage(invalid, jul_3), 0,
+                             invalid)
+            self.assertFalse(is_admitted("device", invalid, jul_3))
+
+    def test_is_admitted(self):
+        bucket = get_rollout_bucket("device")
+        self.assertTrue(is_admitted("device", None))
+        self.assertTrue(is_admitted("device", {"percentage": bucket + 0.1}))
+        self.assertFalse(is_admitted("device", {"percentage": bucket}))
+        self.assertFalse(is_admitted("device", {"halted": True}))
+
+        # Unknown device is only excluded from halted rollouts
+        self.assertTrue(is_admitted(None, {"percentage": 1}))
+        self.assertFalse(is_admitted(None, {"percentage": 0}))
+
+
+class VerifyTests(unittest.TestCase):
+    def test_build_and_verify_manifest(self):
+        _, file_path = mkstemp()
+        with open(file_path, 'wb') as f:
+            f.write(urandom(10 * 1024 + 100))
+        manifest = build_manifest(file_path, chunk_size=1024, workers=4)
+        self.assertEqual(manifest['size'], 10 * 1024 + 100)
+        self.assertEqual(len(manifest['chunks']), 11)
+        self.assertEqual(verify_file(file_path, manifest), [])
+
+        # Corrupt chunks
+        with open(file_path, 'r+b') as f:
+            f.seek(1024 * 3)
+            f.write(b'corrupt')
+            f.seek(1024 * 7 + 5)
+            f.write(b'corrupt')
+        self.assertEqual(verify_file(file_path, manifest), [3, 7])
+        self.assertEqual(verify_file(file_path, manifest, [1, 3]), [3])
+
+        # Truncated file
+        with open(file_path, 'r+b') as f:
+            f.truncate(1024 * 9)
+        self.assertEqual(verify_file(file_path, manifest), [3, 7, 9, 10])
+
+        # Extra data
+        manifest = build_manifest(file_path, chunk_size=1024)
+        with open(file_path, 'ab') as f:
+            f.write(b'extra')
+        self.assertEqual(verify_file(file_path, manifest), [8])
+
+        # Missing file
+        remove(file_path)
+        self.assertEqual(verify_file(file_path, manifest, [2]), [2])
+
 
 if __name__ == '__main__':
     unittest.main()